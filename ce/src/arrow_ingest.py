@@ -0,0 +1,88 @@
+# =============================================================
+# file: ce/src/arrow_ingest.py
+# Purpose: Arrow-native loading with dtypes fixed at the source
+#  - read_arrow: record batches from DataSource.iter_batches, each cast on
+#    arrival to the target dtypes (float32 / int8 / int16) with string columns
+#    dictionary-encoded, so no full-width int64 / float64 / object copy of a
+#    table ever exists (peak ~ cast table + one raw batch)
+#  - to_frame: Arrow -> pandas with split blocks + self_destruct (each column
+#    converted once and its Arrow buffer released); dictionary columns become
+#    categoricals, numerics stay float32 / small ints, no object columns
+#  - load_encoded: the training splits through read_arrow, vocab fitted and
+#    categoricals encoded on the Arrow columns (CategoryEncoder.encode_arrow)
+# =============================================================
+
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from data_source import DataSource
+from encoding import CategoryEncoder, VocabBuilder
+from perf import span
+
+
+def cast_batch(batch: pa.RecordBatch, dtypes: Dict[str, type]) -> pa.RecordBatch:
+    """Columns in `dtypes` cast (unchecked, like astype), other string columns dictionary-encoded."""
+    cols = []
+    for name, col in zip(batch.schema.names, batch.columns):
+        if name in dtypes:
+            col = pc.cast(col, pa.from_numpy_dtype(np.dtype(dtypes[name])), safe=False)
+        elif pa.types.is_string(col.type) or pa.types.is_large_string(col.type):
+            col = pc.dictionary_encode(col)
+        cols.append(col)
+    return pa.RecordBatch.from_arrays(cols, names=batch.schema.names)
+
+
+def read_arrow(source: DataSource,
+               table: str,
+               columns: List[str],
+               dtypes: Dict[str, type],
+               chunk_rows: int = 1_000_000,
+               **filters) -> pa.Table:
+    """`columns` of `table` (read() filters: date / date_range / split / shard), cast batch by batch."""
+    with span("load") as sp:
+        batches = [cast_batch(b, dtypes) for b in source.iter_batches(table, columns=columns,
+                                                                     chunk_rows=chunk_rows, **filters)]
+        if not batches:
+            return pa.table({c: pa.array([], type=pa.from_numpy_dtype(np.dtype(dtypes.get(c, np.float64))))
+                             for c in columns})
+        out = pa.Table.from_batches(batches)
+        sp.rows = out.num_rows
+    return out
+
+
+def to_frame(table: pa.Table) -> pd.DataFrame:
+    """pandas view for the model libraries (dates as datetime64, dictionaries as categoricals)."""
+    return table.to_pandas(split_blocks=True, self_destruct=True, date_as_object=False)
+
+
+def load_encoded(source: DataSource,
+                 table: str,
+                 features: List[str],
+                 label: str,
+                 dtypes: Dict[str, type],
+                 cat_cols: List[str],
+                 splits: List[str],
+                 encoder: Optional[CategoryEncoder] = None,
+                 shard: Optional[Tuple[int, int]] = None
+                 ) -> Tuple[Dict[str, pd.DataFrame], Dict[str, np.ndarray], CategoryEncoder]:
+    """Encoded X and float32 y per split; the vocab is fitted on splits[0] unless `encoder` is given.
+
+    `shard=(i, n)` keeps only series slice i of n (sharding.py), e.g. one data-parallel worker's rows.
+    """
+    tables = {s: read_arrow(source, table, features + [label], dict(dtypes, **{label: np.float32}), split=s,
+                          shard=shard)
+              for s in splits}
+    X, y = {}, {}
+    with span("encode", rows=sum(t.num_rows for t in tables.values())):
+        if encoder is None:
+            encoder = CategoryEncoder(VocabBuilder(cat_cols).update(tables[splits[0]]).vocab)
+        for s in splits:
+            t = tables.pop(s)
+            y[s] = t.column(label).to_numpy()
+            X[s] = to_frame(encoder.encode_arrow(t.select(features), cat_cols))
+            del t
+    return X, y, encoder
@@ -0,0 +1,377 @@
+# =============================================================
+# file: ce/src/bench.py
+# Purpose: Scaling benchmark for load / encode / train / sweep / write
+#  - Data: synth.py tables per scale under --data_root/<scale> (reused if present)
+#  - Each (scale, stage) runs in its own forked process, so peak RSS is the
+#    stage's own; stages call the real training / sweep functions
+#  - Per stage: rows/s, per-call latency (p50 / p95; calls = splits for
+#    load / encode, one for train, days for sweep / write), peak RSS, and
+#    the perf.py spans recorded inside it; train rows count once per round
+#  - Results are appended as JSON lines tagged with the git commit; each run
+#    is compared against the latest earlier commit at the same scale / stage
+#  - A stage child killed without a result (e.g. OOM at 10M+ rows) is
+#    recorded as failed (error="exit -9") and the scale's later stages are skipped
+# =============================================================
+
+#!/usr/bin/env python3
+import os, argparse, importlib, json, platform, subprocess, time, traceback
+import multiprocessing as mp
+from contextlib import contextmanager
+from queue import Empty
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from perf import Span, peak_rss_mb, span, tracer
+from result_store import ResultStore
+from synth import format_rows, parse_rows, write_tables
+
+STAGES = ["load", "encode", "train", "sweep", "write"]
+SPLITS = ["train", "valid", "test"]
+
+# Training / sweep entry points per model family
+MODELS = {
+    "xgb": dict(train="xgboost_train", sweep="policy_sweep_xgb_cat", fit="cast_and_categorize_train",
+                apply="apply_categories", model_file="model.json"),
+    "lgb": dict(train="lightgbm_train_cat", sweep="policy_sweep_lgb_cat", fit="cast_and_fit_vocab_train",
+                apply="apply_vocab", model_file="model.txt"),
+}
+
+
+class StageTimer:
+    """Per-call wall times and rows of one stage, plus its peak-RSS growth."""
+
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.rows = 0
+        self._rss0: Optional[float] = None
+
+    @contextmanager
+    def call(self, rows: int = 0):
+        if self._rss0 is None:
+            self._rss0 = peak_rss_mb()
+        sp = Span("call", rows)
+        t0 = time.perf_counter()
+        yield sp
+        self.latencies.append(time.perf_counter() - t0)
+        self.rows += int(sp.rows or 0)
+
+    def result(self) -> Dict[str, object]:
+        lat = np.asarray(self.latencies) * 1000.0
+        secs = float(np.sum(self.latencies))
+        return {
+            "calls": len(lat),
+            "rows": self.rows,
+            "seconds": secs,
+            "rows_per_s": self.rows / secs if secs > 0 else None,
+            "p50_ms": float(np.percentile(lat, 50)) if len(lat) else None,
+            "p95_ms": float(np.percentile(lat, 95)) if len(lat) else None,
+            "peak_rss_mb": peak_rss_mb(),
+            "peak_rss_delta_mb": peak_rss_mb() - (self._rss0 or peak_rss_mb()),
+            "spans": tracer.snapshot(),
+        }
+
+
+class BenchContext:
+    def __init__(self, args, scale: str):
+        self.args = args
+        self.scale = scale
+        self.data_dir = os.path.join(args.data_root, scale)
+        self.work_dir = os.path.join(args.work_root, f"{scale}_{args.model}")
+        self.spec = MODELS[args.model]
+        self.grid = [float(x) for x in args.discount_grid.split(",") if x.strip() != ""]
+
+    @property
+    def model_path(self) -> str:
+        return os.path.join(self.work_dir, self.spec["model_file"])
+
+    @property
+    def vocab_path(self) -> str:
+        return os.path.join(self.work_dir, "vocab.json")
+
+    def source(self):
+        from data_source import ParquetSource
+        return ParquetSource(self.data_dir)
+
+    def train_module(self):
+        return importlib.import_module(self.spec["train"])
+
+    def sweep_module(self):
+        return importlib.import_module(self.spec["sweep"])
+
+    def test_days(self) -> List[str]:
+        return self.source().partitions("scoring_frame_test")
+
+
+# ---------- stages (each runs in a fresh forked process) ----------
+def stage_load(ctx: BenchContext) -> StageTimer:
+    mod, src, st = ctx.train_module(), ctx.source(), StageTimer()
+    for split in SPLITS:
+        with st.call() as c:
+            c.rows = len(mod.load_split(src, split, mod.FEATURES))
+    return st
+
+
+def stage_encode(ctx: BenchContext) -> StageTimer:
+    mod, src, st = ctx.train_module(), ctx.source(), StageTimer()
+    frames = {s: mod.load_split(src, s, mod.FEATURES) for s in SPLITS}
+    with st.call(len(frames["train"])):
+        _, encoder = getattr(mod, ctx.spec["fit"])(frames["train"])
+    for s in SPLITS[1:]:
+        with st.call(len(frames[s])):
+            getattr(mod, ctx.spec["apply"])(frames[s], encoder)
+    return st
+
+
+def stage_train(ctx: BenchContext) -> StageTimer:
+    mod, src, st = ctx.train_module(), ctx.source(), StageTimer()
+    df_tr, df_va = (mod.load_split(src, s, mod.FEATURES) for s in SPLITS[:2])
+    Xtr, encoder = getattr(mod, ctx.spec["fit"])(df_tr)
+    Xva = getattr(mod, ctx.spec["apply"])(df_va, encoder)
+    ytr = df_tr[mod.LABEL].astype(np.float32).values
+    yva = df_va[mod.LABEL].astype(np.float32).values
+    del df_tr, df_va
+    params = dict(mod.PARAMS)
+    with st.call(len(Xtr) * ctx.args.rounds):
+        if ctx.args.model == "xgb":
+            import xgboost as xgb
+            with span("dmatrix", rows=len(Xtr) + len(Xva)):
+                dtrain = xgb.DMatrix(Xtr, label=ytr, enable_categorical=True)
+                dvalid = xgb.DMatrix(Xva, label=yva, enable_categorical=True)
+            booster = xgb.train(params, dtrain, num_boost_round=ctx.args.rounds,
+                                evals=[(dvalid, "valid")], verbose_eval=False,
+                                callbacks=[mod.IterationSpans(len(Xtr))])
+        else:
+            import lightgbm as lgb
+            dtrain = lgb.Dataset(Xtr, label=ytr, categorical_feature=mod.CAT_COLS, free_raw_data=False)
+            dvalid = lgb.Dataset(Xva, label=yva, categorical_feature=mod.CAT_COLS, free_raw_data=False)
+            with span("dataset", rows=len(Xtr)):
+                dtrain.construct()
+            booster = lgb.train(params, dtrain, num_boost_round=ctx.args.rounds, valid_sets=[dvalid],
+                                callbacks=mod.iteration_spans(len(Xtr)))
+    os.makedirs(ctx.work_dir, exist_ok=True)
+    booster.save_model(ctx.model_path)
+    encoder.save(ctx.vocab_path)
+    return st
+
+
+def stage_sweep(ctx: BenchContext) -> StageTimer:
+    from encoding import CategoryEncoder
+    from forest import PriceIncrementalPredictor, from_booster, load_booster
+    from sweep_engine import tiled_predictor
+    assert os.path.exists(ctx.model_path), f"{ctx.model_path} missing: run the train stage first"
+    mod, src, st = ctx.sweep_module(), ctx.source(), StageTimer()
+    booster = load_booster(ctx.model_path)
+    encoder = CategoryEncoder.load(ctx.vocab_path)
+    predict_grid = None
+    if ctx.args.predictor == "incremental":
+        predict_grid = PriceIncrementalPredictor(from_booster(booster, encoder.vocab))
+    elif ctx.args.predictor == "compiled":
+        predict_grid = tiled_predictor(from_booster(booster, encoder.vocab).predict_frame)
+    out_dir = os.path.join(ctx.work_dir, "sweep")
+    os.makedirs(out_dir, exist_ok=True)
+    for d in ctx.test_days():
+        with st.call() as c:
+            base = mod.load_scoring_frame(src, d)
+            out = mod.day_sweep(booster, encoder, base, ctx.grid, predict_grid=predict_grid)
+            c.rows = len(base)
+        out.to_parquet(os.path.join(out_dir, f"{d}.parquet"), index=False)
+    return st
+
+
+def stage_write(ctx: BenchContext) -> StageTimer:
+    st = StageTimer()
+    sweep_dir = os.path.join(ctx.work_dir, "sweep")
+    days = ctx.test_days()
+    assert all(os.path.exists(os.path.join(sweep_dir, f"{d}.parquet")) for d in days), \
+        f"{sweep_dir} incomplete: run the sweep stage first"
+    store = ResultStore(ctx.work_dir, "policy_eval")
+    for d in days:
+        df = pd.read_parquet(os.path.join(sweep_dir, f"{d}.parquet"))
+        # Same call as the sweeps' per-day result write (BQ loads are not benchmarked locally)
+        with st.call(len(df)):
+            store.write_day(d, df)
+    return st
+
+
+STAGE_FNS: Dict[str, Callable[[BenchContext], StageTimer]] = {
+    "load": stage_load, "encode": stage_encode, "train": stage_train,
+    "sweep": stage_sweep, "write": stage_write,
+}
+
+
+class ChildDied(RuntimeError):
+    """The benchmark child exited (killed / crashed) without posting a result."""
+
+
+def run_isolated(fn: Callable[[], object], poll_s: float = 5.0):
+    """Run fn() in a forked child and return its result (re-raising its error; ChildDied if it was killed)."""
+    mpc = mp.get_context("fork")
+    q = mpc.Queue()
+
+    def target():
+        try:
+            q.put(("ok", fn()))
+        except BaseException:
+            q.put(("error", traceback.format_exc()))
+
+    p = mpc.Process(target=target)
+    p.start()
+    exited_polls = 0
+    while True:
+        try:
+            status, value = q.get(timeout=poll_s)
+            break
+        except Empty:
+            # Exited without a result: killed (OOM -> -9) or crashed; one extra poll lets a result drain
+            if p.exitcode is not None:
+                exited_polls += 1
+                if p.exitcode != 0 or exited_polls > 1:
+                    p.join()
+                    raise ChildDied(f"exit {p.exitcode}")
+    p.join()
+    if status != "ok":
+        raise RuntimeError(f"benchmark child failed:\n{value}")
+    return value
+
+
+def ensure_data(args, scale: str) -> Dict[str, int]:
+    """Generate the scale's tables once; a marker file records the row counts."""
+    root = os.path.join(args.data_root, scale)
+    marker = os.path.join(root, "_SYNTH.json")
+    if os.path.exists(marker) and not args.regen:
+        with open(marker) as f:
+            return json.load(f)
+    counts = run_isolated(lambda: write_tables(root, parse_rows(scale), seed=args.seed))
+    with open(marker, "w") as f:
+        json.dump(counts, f)
+    return counts
+
+
+# ---------- results store ----------
+def git_state() -> Dict[str, object]:
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=here, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=here,
+                                    capture_output=True, text=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        commit, dirty = "unknown", False
+    return {"commit": commit, "dirty": dirty}
+
+
+def host_info() -> Dict[str, object]:
+    info = {"python": platform.python_version(), "cpus": os.cpu_count(), "machine": platform.machine()}
+    for lib in ("numpy", "pandas", "pyarrow", "duckdb", "xgboost", "lightgbm"):
+        try:
+            info[lib] = importlib.import_module(lib).__version__
+        except ImportError:
+            pass
+    return info
+
+
+def load_results(path: str) -> List[Dict[str, object]]:
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _key(r: Dict[str, object]):
+    # Only the sweep stage depends on the predictor
+    return (r["scale"], r["stage"], r["model"], r["predictor"] if r["stage"] == "sweep" else None)
+
+
+def compare(current: List[Dict[str, object]],
+            history: List[Dict[str, object]],
+            tolerance: float) -> List[str]:
+    """Print current vs the latest record of an earlier commit per (scale, stage); return regressions."""
+    regressions = []
+    print(f"\n{'scale':>6} {'stage':<7} {'rows/s':>12} {'vs prev':>8} {'p95 ms':>9} {'peak MB':>8} "
+          f"{'vs prev':>8}  prev commit")
+    for r in current:
+        prev = next((h for h in reversed(history)
+                     if _key(h) == _key(r) and h["commit"] != r["commit"] and not h.get("error")), None)
+        d_rate = d_mem = None
+        if prev is not None and prev.get("rows_per_s") and r.get("rows_per_s"):
+            d_rate = r["rows_per_s"] / prev["rows_per_s"] - 1.0
+            d_mem = r["peak_rss_mb"] / prev["peak_rss_mb"] - 1.0
+        fmt = lambda v: "" if v is None else f"{v:+.0%}"
+        flag = ""
+        if r.get("error"):
+            flag = f"  FAILED ({r['error']})"
+            regressions.append(f"{r['scale']} {r['stage']}")
+        elif d_rate is not None and (d_rate < -tolerance or d_mem > tolerance):
+            flag = "  REGRESSION"
+            regressions.append(f"{r['scale']} {r['stage']}")
+        print(f"{r['scale']:>6} {r['stage']:<7} {r['rows_per_s'] or 0:>12,.0f} {fmt(d_rate):>8} "
+              f"{r['p95_ms'] or 0:>9,.1f} {r['peak_rss_mb'] or 0:>8,.0f} {fmt(d_mem):>8}  "
+              f"{prev['commit'] if prev else '-'}{flag}")
+    return regressions
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Scaling benchmark on synthetic Favorita-shaped data")
+    ap.add_argument("--scales", default="100k,1M", help="features_split rows per scale, e.g. 100k,1M,10M,30M")
+    ap.add_argument("--stages", default=",".join(STAGES))
+    ap.add_argument("--model", choices=sorted(MODELS), default="xgb")
+    ap.add_argument("--predictor", choices=["native", "compiled", "incremental"], default="native")
+    ap.add_argument("--rounds", type=int, default=50, help="Boosting rounds in the train stage")
+    ap.add_argument("--discount_grid", default="0.0,0.1,0.2,0.3,0.4,0.5")
+    ap.add_argument("--data_root", default="data/bench", help="Synthetic data per scale (generated once)")
+    ap.add_argument("--work_root", default="outputs/bench", help="Models / sweep outputs of the runs")
+    ap.add_argument("--results", default="reports/bench/results.jsonl", help="Append-only results store")
+    ap.add_argument("--regen", action="store_true", help="Regenerate the synthetic data")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--tolerance", type=float, default=0.10,
+                    help="Flag a regression when rows/s drops or peak RSS grows by more than this")
+    ap.add_argument("--fail_on_regression", action="store_true")
+    args = ap.parse_args()
+
+    scales = [format_rows(parse_rows(s)) for s in args.scales.split(",") if s.strip()]
+    stages = [s.strip() for s in args.stages.split(",") if s.strip()]
+    assert all(s in STAGE_FNS for s in stages), f"--stages must be a subset of {STAGES}"
+
+    history = load_results(args.results)
+    run = dict(ts=pd.Timestamp.now(tz="UTC").isoformat(), **git_state(), host=host_info(),
+               model=args.model, predictor=args.predictor, rounds=args.rounds)
+    current = []
+    for scale in scales:
+        counts = ensure_data(args, scale)
+        ctx = BenchContext(args, scale)
+        failed = None
+        for stage in stages:
+            if failed:
+                print(f"[{scale} {stage}] skipped: {failed} failed")
+                continue
+            def measure(stage=stage):
+                tracer.reset()
+                return STAGE_FNS[stage](ctx).result()
+            try:
+                res = run_isolated(measure)
+            except ChildDied as e:
+                failed = stage
+                res = dict(calls=0, rows=0, seconds=None, rows_per_s=None, p50_ms=None, p95_ms=None,
+                           peak_rss_mb=None, peak_rss_delta_mb=None, spans={}, error=str(e))
+            rec = dict(run, scale=scale, rows_target=parse_rows(scale), table_rows=counts, stage=stage, **res)
+            current.append(rec)
+            if rec.get("error"):
+                print(f"[{scale} {stage}] FAILED: child {rec['error']} without a result")
+            else:
+                print(f"[{scale} {stage}] {rec['rows']:,} rows in {rec['seconds']:.2f}s "
+                      f"({rec['rows_per_s'] or 0:,.0f} rows/s, p95 {rec['p95_ms'] or 0:,.1f} ms, "
+                      f"peak {rec['peak_rss_mb']:,.0f} MB)")
+            os.makedirs(os.path.dirname(args.results) or ".", exist_ok=True)
+            with open(args.results, "a") as f:
+                f.write(json.dumps(rec, default=str) + "\n")
+
+    regressions = compare(current, history, args.tolerance)
+    print(f"\nResults appended to {args.results}")
+    if regressions and args.fail_on_regression:
+        raise SystemExit(f"Regressions: {', '.join(regressions)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+# =============================================================
+# file: ce/src/bq_writer.py
+# Purpose: Batched BigQuery writer for the per-day sweep results
+#  - One bigquery.Client for the whole run (was: a new client + pandas-gbq
+#    connection per day)
+#  - Days are buffered and flushed every `batch_days`: each day is one load job
+#    into its partition decorator `table$YYYYMMDD` with WRITE_TRUNCATE, so a
+#    rerun replaces the day (no DML DELETE, no duplicate rows)
+#  - Payload is Parquet (the result-store file, or the frame via to_arrow):
+#    typed DATE / FLOAT columns instead of pandas-gbq's CSV round trip
+#  - A batch's jobs are submitted together and awaited together; any client
+#    with load_table_from_file(file, destination, job_config=...) works,
+#    e.g. a local fake that records the calls
+# =============================================================
+
+import io
+from typing import Dict, List, Optional, Tuple, Union
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+from result_store import to_arrow
+
+Payload = Union[str, pd.DataFrame]
+
+
+def partition_decorator(table_fq: str, date: str) -> str:
+    """project.dataset.table + 2017-08-01 -> project.dataset.table$20170801"""
+    return f"{table_fq}${str(date).replace('-', '')}"
+
+
+def load_job_config(partition_field: str = "date"):
+    """Parquet load that replaces the target partition (creates a DATE-partitioned table if missing)."""
+    from google.cloud import bigquery
+    return bigquery.LoadJobConfig(
+        source_format=bigquery.SourceFormat.PARQUET,
+        write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+        time_partitioning=bigquery.TimePartitioning(type_=bigquery.TimePartitioningType.DAY,
+                                                    field=partition_field),
+    )
+
+
+def parquet_bytes(payload: Payload) -> bytes:
+    if isinstance(payload, str):
+        with open(payload, "rb") as f:
+            return f.read()
+    buf = io.BytesIO()
+    pq.write_table(to_arrow(payload), buf, compression="zstd")
+    return buf.getvalue()
+
+
+class BQPartitionWriter:
+    """Buffers per-day results and loads them into `project.dataset.table` partitions in batches."""
+
+    def __init__(self, project: str, table: str, batch_days: int = 7, client=None, job_config=None):
+        self.project = project
+        self.table_fq = table if table.count(".") == 2 else f"{project}.{table}"
+        self.batch_days = max(1, int(batch_days))
+        self._client = client
+        self._job_config = job_config
+        self._pending: List[Tuple[str, Payload, int]] = []
+        self.jobs = 0
+
+    @property
+    def client(self):
+        if self._client is None:
+            from google.cloud import bigquery
+            self._client = bigquery.Client(project=self.project)
+        return self._client
+
+    @property
+    def job_config(self):
+        if self._job_config is None:
+            self._job_config = load_job_config()
+        return self._job_config
+
+    def write_day(self, date: str, payload: Payload, rows: Optional[int] = None):
+        """Queue one day (a Parquet file path or the result frame); flushes when the batch is full."""
+        if rows is None:
+            rows = len(payload) if isinstance(payload, pd.DataFrame) else pq.ParquetFile(payload).metadata.num_rows
+        # A day queued twice keeps only its latest payload
+        self._pending = [p for p in self._pending if p[0] != date] + [(date, payload, rows)]
+        if len(self._pending) >= self.batch_days:
+            self.flush()
+
+    def flush(self) -> Dict[str, int]:
+        """Submit one load job per buffered day, then wait for all of them; returns {date: rows}."""
+        pending, self._pending = self._pending, []
+        jobs = []
+        for date, payload, rows in pending:
+            job = self.client.load_table_from_file(io.BytesIO(parquet_bytes(payload)),
+                                                   partition_decorator(self.table_fq, date),
+                                                   job_config=self.job_config)
+            jobs.append((date, rows, job))
+        self.jobs += len(jobs)
+        for date, rows, job in jobs:
+            job.result()
+            print(f"[{date}] wrote {rows:,} rows to {self.table_fq}")
+        return {date: rows for date, rows, _ in jobs}
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self) -> "BQPartitionWriter":
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # On error, drop the buffer: reruns are idempotent and the local store has every day
+        if exc_type is None:
+            self.close()
+        else:
+            self._pending = []
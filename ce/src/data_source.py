@@ -0,0 +1,293 @@
+# =============================================================
+# file: ce/src/data_source.py
+# Purpose: Pluggable read access to the ML tables used by training,
+#          sweeps and reporting
+#  - BigQuerySource: one client per source, parameterized SQL
+#  - ParquetSource: local date-partitioned Parquet read through DuckDB
+#    (root/<table>/date=YYYY-MM-DD/*.parquet)
+#  - Both support column projection and predicates on date / split / shard
+#    (shard = the BQML FARM_FINGERPRINT slice, see sharding.py)
+#  - iter_chunks streams the same result in bounded DataFrame chunks,
+#    iter_batches as Arrow record batches (arrow_ingest.py)
+#  - fingerprint identifies query + data version (dataset_cache.py keys)
+#  - `python ce/src/data_source.py ...` mirrors a BQ table to local Parquet
+# =============================================================
+
+#!/usr/bin/env python3
+import os, argparse, glob, hashlib
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import pandas as pd
+import pyarrow as pa
+
+from sharding import shard_ids
+
+
+DEFAULT_DATASET = "dynamic_pricing_ml"
+DATE_PART = "date="
+
+
+class DataSource:
+    """Read-only access to one dataset of ML tables."""
+
+    def read(self,
+             table: str,
+             columns: Optional[List[str]] = None,
+             date: Optional[str] = None,
+             date_range: Optional[Tuple[str, str]] = None,
+             split: Optional[str] = None,
+             shard: Optional[Tuple[int, int]] = None) -> pd.DataFrame:
+        """Return `columns` of `table`, filtered to one date / inclusive date range / split /
+        (shard_id, num_shards) slice of (store_nbr, item_nbr)."""
+        raise NotImplementedError
+
+    def iter_chunks(self,
+                    table: str,
+                    columns: Optional[List[str]] = None,
+                    date_range: Optional[Tuple[str, str]] = None,
+                    split: Optional[str] = None,
+                    chunk_rows: int = 1_000_000) -> Iterator[pd.DataFrame]:
+        """Same rows as read(), in order, as DataFrames of about `chunk_rows` rows."""
+        raise NotImplementedError
+
+    def iter_batches(self,
+                     table: str,
+                     columns: Optional[List[str]] = None,
+                     date: Optional[str] = None,
+                     date_range: Optional[Tuple[str, str]] = None,
+                     split: Optional[str] = None,
+                     shard: Optional[Tuple[int, int]] = None,
+                     chunk_rows: int = 1_000_000) -> Iterator[pa.RecordBatch]:
+        """Same rows as read(), as Arrow record batches (no pandas conversion)."""
+        raise NotImplementedError
+
+    def fingerprint(self,
+                    table: str,
+                    columns: Optional[List[str]] = None,
+                    split: Optional[str] = None) -> str:
+        """Hash of the query and of the table's data version; changes when read() could return other rows."""
+        raise NotImplementedError
+
+
+class BigQuerySource(DataSource):
+    """Reads `{project}.{dataset}.{table}`; the client is built once and reused."""
+
+    def __init__(self, project: str, dataset: str = DEFAULT_DATASET):
+        self.project = project
+        self.dataset = dataset
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            from google.cloud import bigquery
+            self._client = bigquery.Client(project=self.project)
+        return self._client
+
+    def table_id(self, table: str) -> str:
+        return table if table.count(".") == 2 else f"{self.project}.{self.dataset}.{table}"
+
+    def _query(self, table, columns, date, date_range, split, shard=None):
+        from google.cloud import bigquery
+        where, params = [], []
+        if date is not None:
+            where.append("date = @d")
+            params.append(bigquery.ScalarQueryParameter("d", "DATE", date))
+        if date_range is not None:
+            where.append("date BETWEEN @d0 AND @d1")
+            params.append(bigquery.ScalarQueryParameter("d0", "DATE", date_range[0]))
+            params.append(bigquery.ScalarQueryParameter("d1", "DATE", date_range[1]))
+        if split is not None:
+            where.append("split = @split")
+            params.append(bigquery.ScalarQueryParameter("split", "STRING", split))
+        if shard is not None:
+            where.append("MOD(ABS(FARM_FINGERPRINT(CONCAT(CAST(store_nbr AS STRING), '|', "
+                         "CAST(item_nbr AS STRING)))), @num_shards) = @shard")
+            params.append(bigquery.ScalarQueryParameter("shard", "INT64", shard[0]))
+            params.append(bigquery.ScalarQueryParameter("num_shards", "INT64", shard[1]))
+        sql = f"""
+        SELECT {", ".join(columns) if columns else "*"}
+        FROM `{self.table_id(table)}`
+        {("WHERE " + " AND ".join(where)) if where else ""}
+        """
+        return self.client.query(sql, job_config=bigquery.QueryJobConfig(query_parameters=params))
+
+    def read(self, table, columns=None, date=None, date_range=None, split=None, shard=None) -> pd.DataFrame:
+        job = self._query(table, columns, date, date_range, split, shard)
+        # Use BQ Storage API to stream efficiently
+        return job.result().to_dataframe(create_bqstorage_client=True)
+
+    def iter_chunks(self, table, columns=None, date_range=None, split=None, chunk_rows=1_000_000):
+        from google.cloud import bigquery_storage
+        job = self._query(table, columns, None, date_range, split)
+        # Storage API streams; chunk size follows the read-stream pages
+        yield from job.result(page_size=chunk_rows).to_dataframe_iterable(
+            bqstorage_client=bigquery_storage.BigQueryReadClient())
+
+    def iter_batches(self, table, columns=None, date=None, date_range=None, split=None, shard=None,
+                     chunk_rows=1_000_000):
+        from google.cloud import bigquery_storage
+        job = self._query(table, columns, date, date_range, split, shard)
+        yield from job.result(page_size=chunk_rows).to_arrow_iterable(
+            bqstorage_client=bigquery_storage.BigQueryReadClient())
+
+    def fingerprint(self, table, columns=None, split=None) -> str:
+        t = self.client.get_table(self.table_id(table))
+        return _digest(self.table_id(table), columns, split, t.modified.isoformat(), t.num_rows)
+
+
+class ParquetSource(DataSource):
+    """Local mirror of the dataset: root/<table>/date=YYYY-MM-DD/*.parquet (or root/<table>/*.parquet)."""
+
+    def __init__(self, root: str):
+        self.root = root
+        self._con = None
+        self._partitions: Dict[str, List[str]] = {}
+
+    @property
+    def con(self):
+        if self._con is None:
+            import duckdb
+            self._con = duckdb.connect()
+        return self._con
+
+    def partitions(self, table: str) -> List[str]:
+        """Sorted partition dates of a date-partitioned table ([] if unpartitioned)."""
+        if table not in self._partitions:
+            tdir = os.path.join(self.root, table)
+            names = os.listdir(tdir) if os.path.isdir(tdir) else []
+            self._partitions[table] = sorted(n[len(DATE_PART):] for n in names if n.startswith(DATE_PART))
+        return self._partitions[table]
+
+    def _files(self, table, date, date_range) -> List[str]:
+        tdir = os.path.join(self.root, table)
+        parts = self.partitions(table)
+        if not parts:
+            return sorted(glob.glob(os.path.join(tdir, "*.parquet")))
+        # Partition pruning on date happens here, before DuckDB opens anything
+        if date is not None:
+            parts = [p for p in parts if p == str(date)]
+        if date_range is not None:
+            lo, hi = str(date_range[0]), str(date_range[1])
+            parts = [p for p in parts if lo <= p <= hi]
+        files: List[str] = []
+        for p in parts:
+            files.extend(sorted(glob.glob(os.path.join(tdir, DATE_PART + p, "*.parquet"))))
+        return files
+
+    def _execute(self, files, columns, split):
+        sql = f"SELECT {', '.join(columns) if columns else '*'} FROM read_parquet($files)"
+        params = {"files": files}
+        if split is not None:
+            # Pushed into the Parquet row-group statistics by DuckDB
+            sql += " WHERE split = $split"
+            params["split"] = split
+        return self.con.execute(sql, params)
+
+    def read(self, table, columns=None, date=None, date_range=None, split=None, shard=None) -> pd.DataFrame:
+        files = self._files(table, date, date_range)
+        if not files:
+            return pd.DataFrame(columns=columns or [])
+        df = self._execute(files, _with_keys(columns, shard), split).df()
+        if shard is not None:
+            # Same slice as the BQ predicate; hashed here since DuckDB has no FARM_FINGERPRINT
+            df = df[shard_ids(df["store_nbr"], df["item_nbr"], shard[1]) == shard[0]].reset_index(drop=True)
+            df = df[columns] if columns else df
+        return df
+
+    def iter_chunks(self, table, columns=None, date_range=None, split=None, chunk_rows=1_000_000):
+        files = self._files(table, None, date_range)
+        if not files:
+            return
+        reader = self._execute(files, columns, split).fetch_record_batch(chunk_rows)
+        for batch in reader:
+            yield batch.to_pandas()
+
+    def iter_batches(self, table, columns=None, date=None, date_range=None, split=None, shard=None,
+                     chunk_rows=1_000_000):
+        files = self._files(table, date, date_range)
+        if not files:
+            return
+        for batch in self._execute(files, _with_keys(columns, shard), split).fetch_record_batch(chunk_rows):
+            if shard is not None:
+                ids = shard_ids(batch.column("store_nbr").to_numpy(zero_copy_only=False),
+                                batch.column("item_nbr").to_numpy(zero_copy_only=False), shard[1])
+                batch = batch.filter(pa.array(ids == shard[0]))
+                batch = batch.select(columns) if columns else batch
+            yield batch
+
+    def fingerprint(self, table, columns=None, split=None) -> str:
+        files = self._files(table, None, None)
+        stats = [(os.path.relpath(f, self.root), os.path.getsize(f), os.stat(f).st_mtime_ns) for f in files]
+        return _digest(os.path.abspath(os.path.join(self.root, table)), columns, split, stats)
+
+
+def _with_keys(columns: Optional[List[str]], shard) -> Optional[List[str]]:
+    """`columns` plus the series keys the shard filter hashes."""
+    if shard is None or not columns:
+        return columns
+    return columns + [c for c in ["store_nbr","item_nbr"] if c not in columns]
+
+
+def _digest(*parts) -> str:
+    return hashlib.sha1(repr(parts).encode()).hexdigest()[:16]
+
+
+def export_table(src: DataSource,
+                 root: str,
+                 table: str,
+                 start_date: str,
+                 end_date: str,
+                 columns: Optional[List[str]] = None,
+                 chunk_days: int = 31) -> int:
+    """Mirror a date-partitioned table from `src` into root/<table>/date=.../part-0.parquet."""
+    n = 0
+    days = pd.date_range(start_date, end_date, freq="D")
+    for i in range(0, len(days), chunk_days):
+        lo, hi = days[i].date().isoformat(), days[min(i + chunk_days, len(days)) - 1].date().isoformat()
+        df = src.read(table, columns=columns, date_range=(lo, hi))
+        if df.empty:
+            continue
+        for d, part in df.groupby(pd.to_datetime(df["date"]).dt.date.astype(str), sort=True):
+            pdir = os.path.join(root, table, DATE_PART + d)
+            os.makedirs(pdir, exist_ok=True)
+            part.to_parquet(os.path.join(pdir, "part-0.parquet"), index=False)
+            n += len(part)
+        print(f"[{table} {lo}..{hi}] rows={len(df):,}")
+    return n
+
+
+def add_source_args(ap: argparse.ArgumentParser) -> None:
+    ap.add_argument("--source", choices=["bq", "parquet"], default="bq",
+                    help="Where to read ML tables from: BigQuery or a local Parquet mirror")
+    ap.add_argument("--data_dir", default="data", help="Root of the local Parquet mirror (--source parquet)")
+    ap.add_argument("--dataset", default=os.getenv("ML_DATASET", DEFAULT_DATASET),
+                    help="BigQuery dataset containing the ML tables (--source bq)")
+
+
+def source_from_args(args) -> DataSource:
+    if args.source == "parquet":
+        return ParquetSource(args.data_dir)
+    assert args.project, "Missing --project (required for --source bq)"
+    return BigQuerySource(args.project, args.dataset)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Mirror BigQuery tables to local date-partitioned Parquet")
+    ap.add_argument("--project", default=os.getenv("PROJECT"), help="GCP project ID")
+    ap.add_argument("--dataset", default=os.getenv("ML_DATASET", DEFAULT_DATASET))
+    ap.add_argument("--tables", default="features_split,scoring_frame_test")
+    ap.add_argument("--start_date", default="2013-01-01")
+    ap.add_argument("--end_date", default="2017-08-15")
+    ap.add_argument("--out", default="data", help="Local Parquet root")
+    args = ap.parse_args()
+
+    assert args.project, "Missing --project (or set PROJECT env var)"
+    src = BigQuerySource(args.project, args.dataset)
+    for t in [t.strip() for t in args.tables.split(",") if t.strip()]:
+        n = export_table(src, args.out, t, args.start_date, args.end_date)
+        print(f"Exported {n:,} rows of {t} to {os.path.join(args.out, t)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+# =============================================================
+# file: ce/src/dataset_cache.py
+# Purpose: Content-addressed on-disk cache of encoded / binned training data
+#  - Key = sha1 of everything the training matrix is a function of: the
+#    source fingerprint of each split (DataSource.fingerprint: query + data
+#    version), features, dtype casts / encoding code, library and binning params
+#  - Entry = <root>/<key>/: vocab.json, the encoded splits in the SpilledSplit
+#    layout (train_stream.py; memory-mapped on load) and, for LightGBM, the
+#    constructed train / valid Datasets as binaries (train.bin / valid.bin)
+#  - Entries are built in a temp dir and renamed into place when complete;
+#    manifest.json marks a finished entry and its mtime is the last use
+#  - Past max_gb, the least recently used entries are removed
+# =============================================================
+
+import os, hashlib, inspect, json, shutil, time
+from typing import Callable, List, Optional, Tuple
+
+MANIFEST = "manifest.json"
+TMP_PREFIX = ".tmp-"
+
+
+def code_hash(*fns: Callable) -> str:
+    """Hash of the source of the functions that shape the data (casts, encoding)."""
+    h = hashlib.sha1()
+    for fn in fns:
+        h.update(inspect.getsource(fn).encode())
+    return h.hexdigest()[:16]
+
+
+def dir_bytes(path: str) -> int:
+    return sum(os.path.getsize(os.path.join(d, f)) for d, _, fs in os.walk(path) for f in fs)
+
+
+class DatasetCache:
+    """<root>/<key>/ entries, capped at max_gb (LRU)."""
+
+    def __init__(self, root: str, max_gb: float = 20.0):
+        self.root = root
+        self.max_bytes = int(max_gb * 2**30)
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def key(**parts) -> str:
+        return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()[:20]
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    def get(self, key: str) -> Optional[str]:
+        """Entry dir of a complete entry (and mark it used), else None."""
+        entry = self.path(key)
+        manifest = os.path.join(entry, MANIFEST)
+        if not os.path.exists(manifest):
+            return None
+        os.utime(manifest)
+        with open(manifest) as f:
+            info = json.load(f)
+        print(f"[dataset_cache] hit {key} ({info.get('bytes', 0) / 2**30:.2f} GB) <- {entry}")
+        return entry
+
+    def build(self, key: str) -> str:
+        """Empty temp dir to build the entry in; finish with commit() or abort()."""
+        tmp = os.path.join(self.root, f"{TMP_PREFIX}{key}-{os.getpid()}")
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        return tmp
+
+    def commit(self, key: str, tmp: str, **info) -> str:
+        """Seal the temp dir as entry `key`; a concurrent writer that got there first wins."""
+        info = dict(info, key=key, bytes=dir_bytes(tmp), created=time.strftime("%Y-%m-%dT%H:%M:%S"))
+        with open(os.path.join(tmp, MANIFEST), "w") as f:
+            json.dump(info, f, indent=2, default=str)
+        entry = self.path(key)
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+            return entry
+        print(f"[dataset_cache] stored {key} ({info['bytes'] / 2**30:.2f} GB) -> {entry}")
+        self.evict(keep=key)
+        return entry
+
+    def abort(self, tmp: str):
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    def entries(self) -> List[Tuple[str, int, float]]:
+        """(key, bytes, last use) of every complete entry."""
+        out = []
+        for name in os.listdir(self.root):
+            manifest = os.path.join(self.root, name, MANIFEST)
+            if name.startswith(TMP_PREFIX) or not os.path.exists(manifest):
+                continue
+            with open(manifest) as f:
+                size = json.load(f).get("bytes", 0)
+            out.append((name, size, os.path.getmtime(manifest)))
+        return out
+
+    def evict(self, keep: Optional[str] = None):
+        """Remove least recently used entries until the total fits in max_bytes."""
+        entries = sorted(self.entries(), key=lambda e: e[2])
+        total = sum(e[1] for e in entries)
+        for key, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self.path(key), ignore_errors=True)
+            total -= size
+            print(f"[dataset_cache] evicted {key} ({size / 2**30:.2f} GB)")
+
+
+def add_cache_args(ap, default_dir: str = "cache/datasets") -> None:
+    ap.add_argument("--dataset_cache", default=default_dir,
+                    help="Dir of cached encoded / binned splits ('' = off)")
+    ap.add_argument("--dataset_cache_gb", type=float, default=20.0, help="Size cap of --dataset_cache (LRU)")
+
+
+def cache_from_args(args) -> Optional[DatasetCache]:
+    return DatasetCache(args.dataset_cache, args.dataset_cache_gb) if args.dataset_cache else None
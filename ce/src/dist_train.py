@@ -0,0 +1,368 @@
+# =============================================================
+# file: ce/src/dist_train.py
+# Purpose: Data-parallel training of the XGBoost / LightGBM models over
+#          worker processes on one host (several hosts via --hosts)
+#  - Worker r of W reads only its slice of the train split: the series
+#    partition of sharding.py (FARM_FINGERPRINT of store|item, pushed into
+#    BQ / filtered per Arrow batch for Parquet)
+#  - One vocab for every worker (fitted once by host 0 from the categorical
+#    columns, or --cat_vocab_in), so category codes agree across workers
+#  - XGBoost: RabitTracker on hosts[0] + xgb.collective in each worker; the
+#    quantile sketch, histograms and eval metrics are allreduced, so valid is
+#    partitioned like train
+#  - LightGBM: tree_learner=data over its socket network (machines = every
+#    worker's host:port); each worker evaluates the full valid split so
+#    early stopping stops every worker at the same round
+#  - Rank 0 writes the model; the parent scores valid / test in one process
+#  - --parity: also trains single-process on the same data / vocab and
+#    compares metrics + predictions; --scaling 1,2,4,8: one run per worker
+#    count -> JSON scaling report (wall / train seconds, s per round, speedup)
+# =============================================================
+
+#!/usr/bin/env python3
+import os, argparse, importlib, json, socket, time, traceback
+import multiprocessing as mp
+from queue import Empty
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import mlflow
+
+from data_source import add_source_args, source_from_args
+from arrow_ingest import load_encoded
+from encoding import CategoryEncoder
+from train_stream import fit_vocab
+from perf import peak_rss_mb, span, tracer
+
+MODELS = {
+    "xgb": dict(module="xgboost_train", experiment="peri-price-xgb-cat", model_out="models/xgb_cat_dist.json"),
+    "lgb": dict(module="lightgbm_train_cat", experiment="peri-price-lgbm-cat", model_out="models/lgbm_cat_dist.txt"),
+}
+
+
+def free_ports(n: int) -> List[int]:
+    """n currently free localhost ports (single host: back-to-back runs never hit TIME_WAIT)."""
+    socks = [socket.socket() for _ in range(n)]
+    for s in socks:
+        s.bind(("127.0.0.1", 0))
+    ports = [s.getsockname()[1] for s in socks]
+    for s in socks:
+        s.close()
+    return ports
+
+
+def layout(hosts: List[str], host_index: int, workers: int, port: int) -> Tuple[int, List[int], List[str]]:
+    """(world size, global ranks on this host, LightGBM machines list host:port in rank order)."""
+    world = len(hosts) * workers
+    ranks = list(range(host_index * workers, (host_index + 1) * workers))
+    if port:
+        machines = [f"{h}:{port + i}" for h in hosts for i in range(workers)]
+    else:
+        machines = [f"{hosts[0]}:{p}" for p in free_ports(workers)]
+    return world, ranks, machines
+
+
+def _train_xgb(mod, cfg: Dict, rank: int, X, y, Xva, yva) -> Tuple[object, Dict]:
+    import xgboost as xgb
+    params = dict(mod.PARAMS, **cfg["params"], nthread=cfg["threads"])
+    rounds = cfg["max_rounds"] or mod.NUM_BOOST_ROUND
+
+    def fit():
+        with span("dmatrix", rows=len(y)):
+            dtrain = xgb.QuantileDMatrix(X, label=y, max_bin=params["max_bin"], enable_categorical=True)
+            dvalid = xgb.QuantileDMatrix(Xva, label=yva, ref=dtrain, max_bin=params["max_bin"],
+                                         enable_categorical=True)
+        t0 = time.time()
+        booster = xgb.train(params, dtrain, num_boost_round=rounds, evals=[(dvalid, "valid")],
+                            early_stopping_rounds=50, verbose_eval=50 if rank == 0 else False)
+        return booster, time.time() - t0
+
+    if cfg["world"] == 1:
+        booster, secs = fit()
+    else:
+        # Rank = our shard id (sortby="task" on the tracker)
+        with xgb.collective.CommunicatorContext(**cfg["comm"], dmlc_task_id=str(rank)):
+            booster, secs = fit()
+    return booster, dict(train_s=secs, rounds=booster.num_boosted_rounds(),
+                         best_iteration=int(booster.best_iteration), valid_rmse=float(booster.best_score))
+
+
+def _train_lgb(mod, cfg: Dict, rank: int, X, y, Xva, yva) -> Tuple[object, Dict]:
+    import lightgbm as lgb
+    params = dict(mod.PARAMS, **cfg["params"], num_threads=cfg["threads"])
+    if cfg["world"] > 1:
+        machines = cfg["comm"]["machines"]
+        params.update(tree_learner="data", num_machines=cfg["world"], machines=",".join(machines),
+                      local_listen_port=int(machines[rank].rsplit(":", 1)[1]), pre_partition=True,
+                      time_out=cfg["comm"]["timeout_min"])
+    # Constructed inside lgb.train, after the network is up (bin mappers are found across workers)
+    dtrain = lgb.Dataset(X, label=y, categorical_feature=mod.CAT_COLS, params=params)
+    dvalid = lgb.Dataset(Xva, label=yva, categorical_feature=mod.CAT_COLS, params=params, reference=dtrain)
+    t0 = time.time()
+    # lgb.train truncates the returned booster to best_iteration: count the rounds actually trained here
+    trained = [0]
+
+    def count_rounds(env):
+        trained[0] = env.iteration - env.begin_iteration + 1
+
+    callbacks = [count_rounds, lgb.early_stopping(stopping_rounds=100, verbose=rank == 0)]
+    if rank == 0:
+        callbacks.append(lgb.log_evaluation(period=100))
+    booster = lgb.train(params, dtrain, num_boost_round=cfg["max_rounds"] or mod.NUM_BOOST_ROUND,
+                        valid_sets=[dvalid], valid_names=["valid"], callbacks=callbacks)
+    return booster, dict(train_s=time.time() - t0, rounds=trained[0],
+                         best_iteration=int(booster.best_iteration or booster.current_iteration()),
+                         valid_rmse=float(booster.best_score["valid"]["rmse"]))
+
+
+def _worker(cfg: Dict, rank: int, queue) -> None:
+    """One data-parallel worker: load its slice, train in the collective, rank 0 saves."""
+    try:
+        mod = importlib.import_module(MODELS[cfg["model"]]["module"])
+        source = source_from_args(cfg["source_args"])
+        encoder = CategoryEncoder(cfg["vocab"])
+        world = cfg["world"]
+        shard = (rank, world) if world > 1 else None
+        t0 = time.time()
+        X, y, _ = load_encoded(source, mod.SPLIT_TABLE, mod.FEATURES, mod.LABEL, mod.DTYPES, mod.CAT_COLS,
+                               ["train"], encoder=encoder, shard=shard)
+        # XGBoost allreduces eval metrics -> partitioned valid; LightGBM evaluates locally -> full valid
+        va_shard = shard if cfg["model"] == "xgb" else None
+        Xv, yv, _ = load_encoded(source, mod.SPLIT_TABLE, mod.FEATURES, mod.LABEL, mod.DTYPES, mod.CAT_COLS,
+                                 ["valid"], encoder=encoder, shard=va_shard)
+        load_s = time.time() - t0
+        train = _train_xgb if cfg["model"] == "xgb" else _train_lgb
+        booster, stats = train(mod, cfg, rank, X["train"], y["train"], Xv["valid"], yv["valid"])
+        if rank == 0 and cfg["model_out"]:
+            booster.save_model(cfg["model_out"])
+        queue.put(dict(stats, rank=rank, rows=len(y["train"]), load_s=load_s, peak_rss_mb=peak_rss_mb(),
+                       perf=tracer.snapshot()))
+    except Exception:
+        queue.put(dict(rank=rank, error=traceback.format_exc()))
+
+
+def run_workers(cfg: Dict, ranks: List[int], tracker_host: Optional[str], port: int,
+                poll_s: float = 5.0) -> List[Dict]:
+    """Start this host's workers (plus the XGBoost tracker on host 0); per-worker stats in rank order.
+    A worker that raises or dies without a result fails the run: the others and the tracker are stopped."""
+    ctx = mp.get_context("spawn")  # no inherited OpenMP / tracker threads in the workers
+    tracker = None
+    if cfg["model"] == "xgb" and cfg["world"] > 1:
+        if tracker_host is not None:
+            from xgboost.tracker import RabitTracker
+            tracker = RabitTracker(n_workers=cfg["world"], host_ip=tracker_host, port=port, sortby="task")
+            tracker.start()
+            cfg = dict(cfg, comm=tracker.worker_args())
+        else:
+            cfg = dict(cfg, comm=dict(dmlc_tracker_uri=cfg["hosts"][0], dmlc_tracker_port=port))
+    queue = ctx.Queue()
+    procs = {r: ctx.Process(target=_worker, args=(cfg, r, queue), daemon=True) for r in ranks}
+    for p in procs.values():
+        p.start()
+    results, ok = [], False
+    try:
+        exited: Dict[int, int] = {}  # rank -> polls since it exited without a result
+        while len(results) < len(procs):
+            try:
+                res = queue.get(timeout=poll_s)
+            except Empty:
+                # A killed worker (OOM, segfault) never posts: one extra poll lets a clean exit's result drain
+                done = {r["rank"] for r in results}
+                for r, p in procs.items():
+                    if r not in done and p.exitcode is not None:
+                        exited[r] = exited.get(r, 0) + 1
+                        if p.exitcode != 0 or exited[r] > 1:
+                            raise RuntimeError(f"worker {r} exited with code {p.exitcode} without a result")
+                continue
+            if "error" in res:
+                raise RuntimeError(f"worker {res['rank']} failed:\n{res['error']}")
+            results.append(res)
+        ok = True
+    finally:
+        for p in procs.values():
+            if not ok and p.is_alive():
+                p.terminate()
+            p.join()
+        if tracker is not None:
+            if ok:
+                tracker.wait_for()
+            else:
+                tracker.free()  # stop the tracker the remaining ranks were blocked on
+    for res in results:
+        tracer.merge(res.pop("perf"))
+    return sorted(results, key=lambda r: r["rank"])
+
+
+def summarize(results: List[Dict], wall_s: float) -> Dict:
+    train_s = max(r["train_s"] for r in results)
+    rounds = results[0]["rounds"]
+    return dict(workers=len(results), wall_s=wall_s, load_s=max(r["load_s"] for r in results), train_s=train_s,
+                rounds=rounds, s_per_round=train_s / max(rounds, 1), best_iteration=results[0]["best_iteration"],
+                valid_rmse=results[0]["valid_rmse"], rows=[r["rows"] for r in results],
+                peak_rss_mb=max(r["peak_rss_mb"] for r in results))
+
+
+def predict(model: str, path: str, X) -> np.ndarray:
+    if model == "xgb":
+        import xgboost as xgb
+        return xgb.Booster(model_file=path).predict(xgb.DMatrix(X, enable_categorical=True))
+    import lightgbm as lgb
+    booster = lgb.Booster(model_file=path)
+    return booster.predict(X, num_iteration=booster.best_iteration or None)
+
+
+def evaluate(model: str, path: str, X: Dict, y: Dict) -> Tuple[Dict[str, float], Dict[str, np.ndarray]]:
+    preds = {s: predict(model, path, X[s]) for s in X}
+    metrics = {}
+    for s, p in preds.items():
+        metrics[f"{s}_rmse"] = float(np.sqrt(np.mean((y[s] - p) ** 2)))
+        metrics[f"{s}_mae"] = float(np.mean(np.abs(y[s] - p)))
+    return metrics, preds
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Data-parallel XGBoost / LightGBM training over worker processes")
+    ap.add_argument("--project", default=os.getenv("PROJECT"))
+    ap.add_argument("--mlflow_server", required=True)
+    ap.add_argument("--model", choices=list(MODELS), default="xgb")
+    ap.add_argument("--experiment", default=None, help="MLflow experiment (default: the trainer's)")
+    ap.add_argument("--workers", type=int, default=2, help="Worker processes on this host")
+    ap.add_argument("--threads", type=int, default=0, help="Threads per worker (0 = CPUs / --workers)")
+    ap.add_argument("--hosts", default="127.0.0.1",
+                    help="Comma-separated hosts, each running --workers workers; hosts[0] runs the tracker")
+    ap.add_argument("--host_index", type=int, default=0, help="Position of this host in --hosts")
+    ap.add_argument("--port", type=int, default=0,
+                    help="XGBoost tracker port on hosts[0]; LightGBM listens on port + local worker index "
+                         "(0 = free ports, single host only)")
+    ap.add_argument("--timeout_min", type=int, default=10, help="LightGBM network timeout (minutes)")
+    ap.add_argument("--model_out", default=None)
+    ap.add_argument("--cat_vocab_out", default=None, help="Vocab written by host 0 (default: <model_out>_vocab.json)")
+    ap.add_argument("--cat_vocab_in", default=None, help="Vocab to use (required on hosts other than hosts[0])")
+    ap.add_argument("--params_json", default=None,
+                    help="Search results JSON (hparam_search.py); its best_params override PARAMS")
+    ap.add_argument("--max_rounds", type=int, default=None, help="Boosting rounds cap (default: the trainer's)")
+    ap.add_argument("--chunk_rows", type=int, default=1_000_000)
+    ap.add_argument("--parity", action="store_true", help="Also train single-process and compare")
+    ap.add_argument("--parity_tol", type=float, default=0.05,
+                    help="Max relative test RMSE difference (the distributed quantile sketch differs)")
+    ap.add_argument("--scaling", default=None, help="Worker counts to time, e.g. 1,2,4,8 (single host)")
+    ap.add_argument("--report", default=None,
+                    help="JSON run / scaling report (default: reports/dist_train/<model>_<mode>.json)")
+    add_source_args(ap)
+    args = ap.parse_args()
+
+    spec = MODELS[args.model]
+    mod = importlib.import_module(spec["module"])
+    hosts = args.hosts.split(",")
+    if len(hosts) > 1 and not args.port:
+        raise SystemExit("--port is required with several --hosts")
+    model_out = args.model_out or spec["model_out"]
+    vocab_out = args.cat_vocab_out or os.path.splitext(model_out)[0] + "_vocab.json"
+    for p in [model_out, vocab_out]:
+        os.makedirs(os.path.dirname(p) or ".", exist_ok=True)
+    params = {}
+    if args.params_json:
+        with open(args.params_json) as f:
+            params = json.load(f)["best_params"]
+    source = source_from_args(args)
+
+    # One vocab for every worker on every host
+    if args.cat_vocab_in:
+        encoder = CategoryEncoder.load(args.cat_vocab_in)
+    elif args.host_index == 0:
+        encoder = CategoryEncoder(fit_vocab(source, mod.SPLIT_TABLE, "train", mod.CAT_COLS, args.chunk_rows))
+        encoder.save(vocab_out)
+    else:
+        raise SystemExit("--cat_vocab_in is required on hosts other than hosts[0] (use host 0's vocab file)")
+
+    def run(workers: int, out: Optional[str]) -> Dict:
+        world, ranks, machines = layout(hosts, args.host_index, workers, args.port)
+        threads = args.threads or max(1, (os.cpu_count() or 1) // workers)
+        cfg = dict(model=args.model, source_args=args, vocab=encoder.vocab, world=world, hosts=hosts,
+                   comm=dict(machines=machines, timeout_min=args.timeout_min), threads=threads,
+                   params=params, max_rounds=args.max_rounds, model_out=out)
+        print(f"[dist] {args.model}: {world} workers ({len(ranks)} on this host) x {threads} threads")
+        t0 = time.time()
+        results = run_workers(cfg, ranks, hosts[0] if args.host_index == 0 else None, args.port)
+        summary = summarize(results, time.time() - t0)
+        print(f"[dist] {world} workers: train {summary['train_s']:.1f}s ({summary['rounds']} rounds, "
+              f"{summary['s_per_round'] * 1000:.0f} ms/round, best {summary['best_iteration']}) "
+              f"valid_rmse={summary['valid_rmse']:.4f} "
+              f"wall {summary['wall_s']:.1f}s")
+        return dict(summary, threads=threads, world=world)
+
+    if args.host_index != 0:
+        # Other hosts only contribute workers; host 0 logs, evaluates and writes the reports
+        run(args.workers, None)
+        return
+
+    mode = "scaling" if args.scaling else "train"
+    report_path = args.report or os.path.join("reports", "dist_train", f"{args.model}_{mode}.json")
+    os.makedirs(os.path.dirname(report_path) or ".", exist_ok=True)
+    mlflow.set_tracking_uri(f"http://{args.mlflow_server}:5000")
+    mlflow.set_experiment(args.experiment or spec["experiment"])
+
+    with mlflow.start_run(run_name=f"{args.model}_cat_dist_{mode}"):
+        mlflow.log_params(dict(workers=args.workers, hosts=args.hosts, threads=args.threads or "auto",
+                               max_rounds=args.max_rounds or mod.NUM_BOOST_ROUND, **params))
+        if args.scaling:
+            if len(hosts) > 1:
+                raise SystemExit("--scaling runs on one host")
+            runs = []
+            for n in [int(v) for v in args.scaling.split(",")]:
+                runs.append(run(n, None))
+            base = runs[0]["train_s"]
+            for r in runs:
+                r["speedup"] = base / r["train_s"] if r["train_s"] else 0.0
+                for k in ["train_s", "wall_s", "s_per_round", "speedup", "valid_rmse"]:
+                    mlflow.log_metric(f"scaling_{k}", r[k], step=r["workers"])
+            print(f"{'workers':>8} {'threads':>8} {'wall_s':>8} {'train_s':>8} {'rounds':>7} {'best':>6} "
+                  f"{'ms/round':>9} {'speedup':>8} {'valid_rmse':>11}")
+            for r in runs:
+                print(f"{r['workers']:>8} {r['threads']:>8} {r['wall_s']:>8.1f} {r['train_s']:>8.1f} "
+                      f"{r['rounds']:>7} {r['best_iteration']:>6} {r['s_per_round'] * 1000:>9.0f} "
+                      f"{r['speedup']:>8.2f} {r['valid_rmse']:>11.4f}")
+            rep = dict(model=args.model, cpus=os.cpu_count(), runs=runs)
+        else:
+            dist = run(args.workers, model_out)
+            with span("evaluate"):
+                X, y, _ = load_encoded(source, mod.SPLIT_TABLE, mod.FEATURES, mod.LABEL, mod.DTYPES, mod.CAT_COLS,
+                                       ["valid","test"], encoder=encoder)
+                metrics, preds = evaluate(args.model, model_out, X, y)
+            print("Eval:", metrics)
+            mlflow.log_metrics(dict(metrics, train_s=dist["train_s"], best_iteration=dist["best_iteration"]))
+            mlflow.log_artifact(model_out)
+            mlflow.log_artifact(vocab_out)
+            rep = dict(model=args.model, dist=dist, metrics=metrics)
+            if args.parity:
+                single_out = os.path.splitext(model_out)[0] + "_single" + os.path.splitext(model_out)[1]
+                single = run(1, single_out) if len(hosts) == 1 else None
+                if single is None:
+                    raise SystemExit("--parity runs on one host")
+                s_metrics, s_preds = evaluate(args.model, single_out, {"test": X["test"]}, {"test": y["test"]})
+                rel = abs(metrics["test_rmse"] - s_metrics["test_rmse"]) / s_metrics["test_rmse"]
+                corr = float(np.corrcoef(preds["test"], s_preds["test"])[0, 1])
+                ok = rel <= args.parity_tol
+                rep["parity"] = dict(single=single, single_test_rmse=s_metrics["test_rmse"],
+                                     test_rmse=metrics["test_rmse"], rel_diff=rel, pred_corr=corr,
+                                     mean_abs_pred_diff=float(np.mean(np.abs(preds["test"] - s_preds["test"]))),
+                                     tol=args.parity_tol, ok=ok)
+                mlflow.log_metrics({"parity_rel_diff": rel, "parity_pred_corr": corr})
+                print(f"[parity] test_rmse {metrics['test_rmse']:.4f} ({dist['world']} workers) vs "
+                      f"{s_metrics['test_rmse']:.4f} (single) rel_diff={rel:.2%} pred_corr={corr:.4f} "
+                      f"-> {'OK' if ok else 'FAIL'} (tol {args.parity_tol:.0%})")
+
+        with open(report_path, "w") as f:
+            json.dump(rep, f, indent=2, default=str)
+        mlflow.log_artifact(report_path)
+        perf_path = os.path.splitext(report_path)[0] + "_perf.json"
+        tracer.write_json(perf_path, script=os.path.basename(__file__), args=vars(args))
+        mlflow.log_metrics(tracer.metrics())
+        mlflow.log_artifact(perf_path)
+    print(f"[dist] report -> {report_path}")
+    if "parity" in rep and not rep["parity"]["ok"]:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+# =============================================================
+# file: ce/src/encoding.py
+# Purpose: One categorical encoder for training, sweeps and the array forest
+#  - Vocab = TRAIN values in first-seen order, saved as models/*_cat_vocab.json
+#  - Codes = position in the vocab; unseen / missing -> __UNK__ (last code)
+#  - Lookup tables are hash indexes built once per vocab: string columns go
+#    through Index.get_indexer, integer columns through an int64 index of the
+#    vocab's integer entries, categoricals through their (few) categories;
+#    no per-row str() objects on those paths
+#  - Codes are identical to the old astype(str) / isin / __UNK__ encoding
+#  - Arrow tables (arrow_ingest.py) fit / encode the same way, dictionary
+#    columns through their dictionary; encode_arrow keeps the result in Arrow
+#  - extend: new values appended after the existing ones (codes of known
+#    values never move; only __UNK__ shifts to the new end)
+# =============================================================
+
+import json
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+
+UNK = "__UNK__"
+
+
+def _as_str_values(s: pd.Series) -> List[str]:
+    """First-seen distinct values of `s` as the strings astype(str) would produce
+    (unique first, so only the distinct values are stringified)."""
+    return pd.Series(pd.unique(s), dtype=s.dtype).astype(str).tolist()
+
+
+def _distinct_arrow(col: pa.ChunkedArray) -> pd.Series:
+    """First-seen distinct values of an Arrow column (dictionary chunks: only the entries in use)."""
+    parts = []
+    for chunk in col.chunks:
+        if pa.types.is_dictionary(chunk.type):
+            used = pc.unique(chunk.indices).drop_null()
+            parts.append(chunk.dictionary.take(used).to_pandas())
+            if chunk.null_count:
+                parts.append(pd.Series([None], dtype=object))
+        else:
+            parts.append(pc.unique(chunk).to_pandas())
+    if not parts:
+        return pd.Series([], dtype=object)
+    return pd.Series(pd.unique(pd.concat(parts, ignore_index=True)))
+
+
+class VocabBuilder:
+    """Accumulates first-seen vocabularies over one frame or a stream of chunks."""
+
+    def __init__(self, cat_cols: List[str], vocab: Optional[Dict[str, List[str]]] = None):
+        self.cat_cols = list(cat_cols)
+        # Seeded with an existing vocab, new values are appended after it
+        self._seen: Dict[str, Dict[str, None]] = {c: dict.fromkeys((vocab or {}).get(c, [])) for c in cat_cols}
+
+    def update(self, df) -> "VocabBuilder":
+        """Add the values of a DataFrame or a pyarrow Table."""
+        for c in self.cat_cols:
+            seen = self._seen[c]
+            col = _distinct_arrow(df.column(c)) if isinstance(df, pa.Table) else df[c]
+            for v in _as_str_values(col):
+                seen.setdefault(v, None)
+        return self
+
+    @property
+    def vocab(self) -> Dict[str, List[str]]:
+        return {c: list(self._seen[c]) for c in self.cat_cols}
+
+
+class CategoryEncoder:
+    """Maps raw categorical columns to int32 codes / pandas categoricals with a fixed vocab + __UNK__."""
+
+    def __init__(self, vocab: Dict[str, List[str]]):
+        self.vocab = {c: [str(v) for v in vals] for c, vals in vocab.items()}
+        self.dtypes: Dict[str, pd.CategoricalDtype] = {}
+        self._index: Dict[str, pd.Index] = {}
+        self._int_index: Dict[str, pd.Index] = {}
+        self._int_codes: Dict[str, np.ndarray] = {}
+        self._nan_code: Dict[str, int] = {}
+        for c, vals in self.vocab.items():
+            self.dtypes[c] = pd.CategoricalDtype(vals + [UNK])
+            self._index[c] = pd.Index(vals, dtype=object)
+            # Vocab entries that are canonical ints ("44", not "044" / "44.0") for int columns
+            ints, codes = [], []
+            for i, v in enumerate(vals):
+                try:
+                    iv = int(v)
+                except ValueError:
+                    continue
+                if str(iv) == v:
+                    ints.append(iv)
+                    codes.append(i)
+            self._int_index[c] = pd.Index(np.asarray(ints, dtype=np.int64))
+            self._int_codes[c] = np.append(np.asarray(codes, dtype=np.int32), np.int32(len(vals)))
+            # astype(str) turns NaN into "nan", which only matches if TRAIN had it too
+            self._nan_code[c] = vals.index("nan") if "nan" in vals else len(vals)
+        self._arrow_dict: Dict[str, pa.Array] = {}
+
+    # ---------- construction ----------
+    @classmethod
+    def fit(cls, df: pd.DataFrame, cat_cols: List[str]) -> "CategoryEncoder":
+        """Vocab from TRAIN in first-seen order (same as pd.Index(s.astype(str).unique()))."""
+        return cls(VocabBuilder(cat_cols).update(df).vocab)
+
+    def extend(self, df) -> "CategoryEncoder":
+        """Encoder over this vocab + the unseen values of `df` (DataFrame / Arrow table), appended."""
+        return CategoryEncoder(VocabBuilder(self.cat_cols, self.vocab).update(df).vocab)
+
+    def added(self, other: "CategoryEncoder") -> Dict[str, List[str]]:
+        """Values `other` (an extend() of this encoder) has beyond this vocab, per column."""
+        return {c: other.vocab[c][len(self.vocab[c]):] for c in self.cat_cols}
+
+    @classmethod
+    def load(cls, path: str) -> "CategoryEncoder":
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def save(self, path: str) -> None:
+        with open(path, "w") as f:
+            json.dump(self.vocab, f, indent=2)
+
+    @property
+    def cat_cols(self) -> List[str]:
+        return list(self.vocab)
+
+    def unk_code(self, col: str) -> int:
+        return len(self.vocab[col])
+
+    # ---------- encoding ----------
+    def codes(self, col: str, values: Iterable) -> np.ndarray:
+        """int32 codes of raw values (str / int / categorical / anything str()-able); unseen -> UNK."""
+        s = values if isinstance(values, pd.Series) else pd.Series(values)
+        unk = self.unk_code(col)
+        if isinstance(s.dtype, pd.CategoricalDtype):
+            # Encode the categories once, then gather by the row codes (-1 = NaN)
+            lut = np.append(self.codes(col, pd.Series(s.cat.categories)), np.int32(self._nan_code[col]))
+            return lut[s.cat.codes.to_numpy()]
+        if pd.api.types.is_integer_dtype(s.dtype) and not s.hasnans:
+            pos = self._int_index[col].get_indexer(s.to_numpy(dtype=np.int64))
+            return self._int_codes[col][pos]  # pos -1 -> trailing UNK
+        if s.dtype == object and pd.api.types.infer_dtype(s, skipna=False) == "string":
+            out = self._index[col].get_indexer(s.to_numpy()).astype(np.int32)
+        else:
+            out = self._index[col].get_indexer(s.astype(str).to_numpy()).astype(np.int32)
+        out[out < 0] = unk
+        return out
+
+    def arrow_codes(self, col: str, values: pa.ChunkedArray) -> np.ndarray:
+        """codes() of an Arrow column, chunk by chunk; dictionary chunks encode their dictionary once
+        and gather by index (null -> the code of "nan")."""
+        out = []
+        for chunk in values.chunks:
+            if pa.types.is_dictionary(chunk.type):
+                lut = np.append(self.codes(col, chunk.dictionary.to_pandas()), np.int32(self._nan_code[col]))
+                out.append(lut[chunk.indices.fill_null(-1).to_numpy()])
+            else:
+                out.append(self.codes(col, chunk.to_pandas()))
+        return np.concatenate(out) if out else np.zeros(0, dtype=np.int32)
+
+    def encode_arrow(self, table: pa.Table, cols: Optional[List[str]] = None) -> pa.Table:
+        """Table with each vocab column as dictionary<int32, string> over vocab + [__UNK__];
+        to_pandas() turns those into the same categoricals as encode()."""
+        for c in [c for c in (cols or self.cat_cols) if c in table.column_names]:
+            if c not in self._arrow_dict:
+                self._arrow_dict[c] = pa.array(self.vocab[c] + [UNK], type=pa.string())
+            codes = pa.array(self.arrow_codes(c, table.column(c)), type=pa.int32())
+            table = table.set_column(table.column_names.index(c), c,
+                                     pa.DictionaryArray.from_arrays(codes, self._arrow_dict[c]))
+        return table
+
+    def encode(self, X: pd.DataFrame, cols: Optional[List[str]] = None) -> pd.DataFrame:
+        """Copy of X with each vocab column as a pandas categorical over vocab + [__UNK__]."""
+        cols = [c for c in (cols or self.cat_cols) if c in X]
+        return X.assign(**{c: pd.Categorical.from_codes(self.codes(c, X[c]), dtype=self.dtypes[c])
+                           for c in cols})
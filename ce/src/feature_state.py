@@ -0,0 +1,310 @@
+# =============================================================
+# file: ce/src/feature_state.py
+# Purpose: Incremental rolling-feature state for next-day scoring
+#  - Per (store, item) key: a 28-slot ring of log_sales and promo flags, the
+#    row count (ring head = count % 28), last applied day and the catalog
+#    columns; arrays are .npy files opened as np.memmap under --state_dir
+#  - apply(): one day of features_clean rows -> O(1) scatter per key; rows of
+#    days already applied to a key are skipped, so reruns are idempotent
+#  - bootstrap(): last 28 rows per series from the full history in one sort
+#    (features.sort_order), same ring layout as applying day by day
+#  - scoring_frame(): the next day's features_enriched.sql columns straight
+#    from the rings, plus calendar / time_to_expiry / baseline ladder for the
+#    policy_setup_1_scoring_frame.sql columns
+#  - Daily cost ~ one day of rows instead of rescanning the whole history
+# =============================================================
+
+#!/usr/bin/env python3
+import os, argparse, json, shutil, tempfile, time
+from typing import Dict, Optional
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from data_source import add_source_args, source_from_args
+from features import FEATURE_COLS, LAGS, MIN_HISTORY, PROMO_WINDOW, ROLLING, enrich, segment_pos, sort_order
+from result_store import ResultStore
+from pricing_rules import DEFAULT_SHELF_LIFE_DAYS, SHELF_LIFE_DAYS, discount_ladder, effective_price, time_to_expiry
+
+WINDOW = max(max(LAGS), max(ROLLING.values()), PROMO_WINDOW)
+KEY_COLS = ["store_nbr","item_nbr"]
+ATTR_COLS = ["family","class","cluster"]
+STATE_COLS = KEY_COLS + ATTR_COLS + ["date","log_sales","discount_pct","base_price"]
+# name -> (dtype, per-key shape)
+ARRAYS = {
+    "log_sales": (np.float64, (WINDOW,)),
+    "promo": (np.int8, (WINDOW,)),
+    "count": (np.int64, ()),
+    "last_day": (np.int64, ()),
+    "base_price": (np.float64, ()),
+}
+NO_DAY = np.iinfo(np.int64).min
+SCORING_SCHEMA = pa.schema(
+    [pa.field("date", pa.date32())]
+    + [pa.field(c, pa.dictionary(pa.int32(), pa.string())) for c in KEY_COLS]
+    + [pa.field("base_price", pa.float64()), pa.field("time_to_expiry", pa.int64())]
+    + [pa.field(c, pa.float64()) for c in FEATURE_COLS[:-1]]
+    + [pa.field(c, pa.int64()) for c in ["promo_in_last_7d","dow","month","year"]]
+    + [pa.field(c, pa.dictionary(pa.int32(), pa.string())) for c in ATTR_COLS + ["store_nbr_cat"]]
+    + [pa.field(c, pa.float64()) for c in ["baseline_discount_pct","baseline_effective_price","observed_unit_sales"]]
+)
+
+
+def day_number(date) -> np.ndarray:
+    """Days since epoch of a date scalar / column."""
+    return np.asarray(pd.to_datetime(date)).astype("datetime64[D]").astype(np.int64)
+
+
+def pair_keys(store, item) -> pd.Index:
+    return pd.Index(pd.Series(store).astype(str).to_numpy(dtype=object) + "|"
+                    + pd.Series(item).astype(str).to_numpy(dtype=object))
+
+
+class FeatureState:
+    """Ring-buffer feature state under `root` (keys.parquet, meta.json, one .npy memmap per array)."""
+
+    def __init__(self, root: str):
+        self.root = root
+        self.keys = pd.DataFrame(columns=KEY_COLS + ATTR_COLS, dtype=object)
+        self.last_date: Optional[str] = None
+        self.arrays: Dict[str, np.ndarray] = {}
+        self._index: Optional[pd.Index] = None
+        meta = os.path.join(root, "meta.json")
+        if os.path.exists(meta):
+            with open(meta) as f:
+                m = json.load(f)
+            assert m["window"] == WINDOW, f"state window {m['window']} != {WINDOW}; rebuild the state"
+            self.last_date = m["last_date"]
+            self.keys = pd.read_parquet(os.path.join(root, "keys.parquet")).iloc[:m["n_keys"]]
+            self.arrays = {name: np.load(self._path(name), mmap_mode="r+") for name in ARRAYS}
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.root, f"{name}.npy")
+
+    @property
+    def index(self) -> pd.Index:
+        if self._index is None:
+            self._index = pair_keys(self.keys["store_nbr"], self.keys["item_nbr"])
+        return self._index
+
+    def _reserve(self, n: int):
+        """Grow the memmaps to hold n keys (capacity doubles, files are rewritten only then)."""
+        cap = len(self.arrays["count"]) if self.arrays else 0
+        if n <= cap:
+            return
+        new_cap = max(1024, 2 * cap, n)
+        os.makedirs(self.root, exist_ok=True)
+        for name, (dtype, shape) in ARRAYS.items():
+            tmp = self._path(name) + ".tmp"
+            mm = np.lib.format.open_memmap(tmp, mode="w+", dtype=dtype, shape=(new_cap,) + shape)
+            mm[:] = NO_DAY if name == "last_day" else (np.nan if name in ("log_sales", "base_price") else 0)
+            if cap:
+                mm[:cap] = self.arrays[name]
+            mm.flush()
+            del mm
+            os.replace(tmp, self._path(name))
+            self.arrays[name] = np.load(self._path(name), mmap_mode="r+")
+
+    def slots(self, df: pd.DataFrame) -> np.ndarray:
+        """Key slot of every row; unseen (store, item) pairs get new slots."""
+        idx = self.index.get_indexer(pair_keys(df["store_nbr"], df["item_nbr"]))
+        new = idx < 0
+        if new.any():
+            add = df.loc[new, KEY_COLS + ATTR_COLS].astype(str).drop_duplicates(KEY_COLS)
+            self._reserve(len(self.keys) + len(add))
+            self.keys = pd.concat([self.keys, add], ignore_index=True)
+            self._index = None
+            idx[new] = self.index.get_indexer(pair_keys(df.loc[new, "store_nbr"], df.loc[new, "item_nbr"]))
+        return idx
+
+    def apply_day(self, day_df: pd.DataFrame) -> int:
+        """Push one day of features_clean rows onto the rings; returns the rows applied."""
+        days = day_number(day_df["date"])
+        assert len(np.unique(days)) <= 1, "apply_day takes a single date (use apply for several)"
+        if day_df.empty:
+            return 0
+        day = int(days[0])
+        df = day_df.drop_duplicates(KEY_COLS, keep="last")
+        idx = self.slots(df)
+        a = self.arrays
+        fresh = a["last_day"][idx] < day
+        idx, df = idx[fresh], df[fresh]
+        pos = a["count"][idx] % WINDOW
+        a["log_sales"][idx, pos] = df["log_sales"].to_numpy(dtype=np.float64)
+        a["promo"][idx, pos] = df["discount_pct"].to_numpy(dtype=np.float64) > 0
+        a["count"][idx] += 1
+        a["last_day"][idx] = day
+        a["base_price"][idx] = df["base_price"].to_numpy(dtype=np.float64)
+        return len(idx)
+
+    def apply(self, df: pd.DataFrame) -> int:
+        """apply_day over every date in `df`, oldest first, then persist."""
+        days = day_number(df["date"])
+        n = 0
+        for d in np.unique(days):
+            n += self.apply_day(df[days == d])
+        if len(days):
+            self.save(str(np.datetime64(int(days.max()), "D")))
+        return n
+
+    def bootstrap(self, history: pd.DataFrame):
+        """Fresh state from a full history: the last WINDOW rows of each series go into its ring."""
+        t0 = time.time()
+        shutil.rmtree(self.root, ignore_errors=True)
+        self.__init__(self.root)
+        order, start = sort_order(history["store_nbr"], history["item_nbr"], history["date"])
+        pos = segment_pos(start)
+        seg = np.cumsum(start) - 1
+        length = np.bincount(seg)
+        last = np.flatnonzero(np.r_[start[1:], True])
+        keep = pos >= length[seg] - WINDOW
+        # Keys are looked up once per series (its last row), ring rows reuse the slot of their series
+        tail = history.take(order[last])
+        tidx = self.slots(tail)
+        idx = tidx[seg[keep]]
+        a = self.arrays
+        ring_pos = pos[keep] % WINDOW
+        a["log_sales"][idx, ring_pos] = history["log_sales"].to_numpy(dtype=np.float64)[order[keep]]
+        a["promo"][idx, ring_pos] = history["discount_pct"].to_numpy(dtype=np.float64)[order[keep]] > 0
+        a["count"][tidx] = length
+        a["last_day"][tidx] = day_number(tail["date"])
+        a["base_price"][tidx] = tail["base_price"].to_numpy(dtype=np.float64)
+        self.save(str(np.datetime64(int(day_number(history["date"]).max()), "D")) if len(history) else None)
+        print(f"[state] bootstrapped {len(self):,} series from {len(history):,} rows in {time.time() - t0:.1f}s")
+
+    def save(self, last_date: Optional[str]):
+        """Flush the memmaps, then keys + meta (meta last: it marks the state consistent)."""
+        os.makedirs(self.root, exist_ok=True)
+        for mm in self.arrays.values():
+            mm.flush()
+        self.keys.to_parquet(os.path.join(self.root, "keys.parquet"), index=False)
+        self.last_date = max(filter(None, [self.last_date, last_date]), default=None)
+        meta = os.path.join(self.root, "meta.json")
+        with open(meta + ".tmp", "w") as f:
+            json.dump({"n_keys": len(self), "window": WINDOW, "last_date": self.last_date}, f)
+        os.replace(meta + ".tmp", meta)
+
+    def features(self, date: str, active_days: int = 28, min_history: int = MIN_HISTORY) -> pd.DataFrame:
+        """features_enriched.sql columns for a next-day row of every key seen within `active_days`
+        before `date` with > min_history rows of history."""
+        day = int(day_number(date))
+        a = self.arrays
+        n = len(self)
+        if n == 0:
+            return pd.DataFrame(columns=KEY_COLS + ATTR_COLS + ["base_price"] + FEATURE_COLS)
+        last, count = a["last_day"][:n], a["count"][:n]
+        k = np.flatnonzero((last < day) & (last >= day - active_days) & (count >= min_history))
+        # Ring slots most recent first: column j = LAG(j + 1)
+        slots = (count[k, None] - 1 - np.arange(WINDOW)) % WINDOW
+        hist = a["log_sales"][k[:, None], slots]
+        out = self.keys.iloc[k].reset_index(drop=True)
+        out["base_price"] = a["base_price"][k]
+        have = np.arange(WINDOW) < count[k, None]
+        for lg in LAGS:
+            out[f"lag{lg}_log_sales"] = np.where(have[:, lg - 1], hist[:, lg - 1], np.nan)
+        for name, w in ROLLING.items():
+            h = hist[:, :w]
+            ok = have[:, :w] & ~np.isnan(h)
+            c = ok.sum(axis=1)
+            s = np.where(ok, h, 0.0).sum(axis=1)
+            out[name] = np.where(c > 0, s / np.maximum(c, 1), np.nan)
+        promo = a["promo"][k[:, None], slots[:, :PROMO_WINDOW]] * have[:, :PROMO_WINDOW]
+        out["promo_in_last_7d"] = promo.max(axis=1).astype(np.int64)
+        return out
+
+    def scoring_frame(self, date: str, max_tte: int = 2, active_days: int = 28) -> pd.DataFrame:
+        """policy_setup_1_scoring_frame.sql columns for `date` (observed_unit_sales is unknown: NULL)."""
+        df = self.features(date, active_days)
+        ts = pd.Timestamp(date)
+        shelf = df["family"].map(SHELF_LIFE_DAYS).fillna(DEFAULT_SHELF_LIFE_DAYS).to_numpy(dtype=np.int64)
+        tte = time_to_expiry(df["store_nbr"], df["item_nbr"], ts.strftime("%Y-%m-%d"), shelf)
+        df.insert(0, "date", ts)
+        df.insert(4, "time_to_expiry", tte)
+        df = df[tte <= max_tte].reset_index(drop=True)
+        disc = discount_ladder(df["time_to_expiry"].to_numpy())
+        df["dow"], df["month"], df["year"] = (ts.dayofweek + 1) % 7 + 1, ts.month, ts.year
+        df["store_nbr_cat"] = df["store_nbr"]
+        df["baseline_discount_pct"] = disc
+        df["baseline_effective_price"] = effective_price(df["base_price"], disc)
+        df["observed_unit_sales"] = np.nan
+        return df[SCORING_SCHEMA.names]
+
+
+def check_parity(history: pd.DataFrame, date: str, pairs: int = 200, seed: int = 0, atol: float = 1e-9) -> None:
+    """State built from rows before `date` vs features.enrich() rows of `date`, on `pairs` random series."""
+    keys = history.loc[day_number(history["date"]) == day_number(date), KEY_COLS].drop_duplicates()
+    assert len(keys), f"no rows on {date} to check against"
+    pick = keys.sample(min(pairs, len(keys)), random_state=seed)
+    sub = history.merge(pick, on=KEY_COLS)
+    ref = enrich(sub)
+    ref = ref[day_number(ref["date"]) == day_number(date)]
+    # Bootstrap on the first half of the history, apply the rest day by day: both paths are checked
+    days = day_number(sub["date"])
+    past = days[days < day_number(date)]
+    mid = (past.min() + past.max()) // 2 if len(past) else 0
+    tmp = tempfile.mkdtemp(prefix="feature_state_")
+    try:
+        st = FeatureState(tmp)
+        st.bootstrap(sub[days <= mid])
+        st.apply(sub[(days > mid) & (days < day_number(date))])
+        ours = st.features(date, active_days=10**6)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    ours = ours.merge(ref[KEY_COLS], on=KEY_COLS).sort_values(KEY_COLS).reset_index(drop=True)
+    ref = ref.sort_values(KEY_COLS).reset_index(drop=True)
+    assert len(ours) == len(ref), f"row count {len(ours):,} != enrich {len(ref):,}"
+    for c in FEATURE_COLS:
+        a, b = ours[c].to_numpy(dtype=np.float64), ref[c].to_numpy(dtype=np.float64)
+        assert (np.isnan(a) == np.isnan(b)).all(), f"{c}: NULL pattern differs from enrich()"
+        err = np.nanmax(np.abs(a - b)) if len(a) and not np.isnan(a).all() else 0.0
+        assert err <= atol, f"{c}: max abs diff {err:.3g} vs enrich()"
+    print(f"[state] parity with features.enrich OK on {date}: {len(ours):,} series")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Rolling-feature state -> next-day scoring frame")
+    ap.add_argument("--project", default=os.getenv("PROJECT"))
+    ap.add_argument("--in_table", default="features_clean")
+    ap.add_argument("--state_dir", default="state/features")
+    ap.add_argument("--date", required=True, help="Last day of sales to apply (YYYY-MM-DD); scores the day after")
+    ap.add_argument("--rebuild", action="store_true", help="Bootstrap the state from the full history up to --date")
+    ap.add_argument("--out_dir", default="data", help="Parquet root for the scoring frame")
+    ap.add_argument("--out_table", default="scoring_frame_next")
+    ap.add_argument("--max_tte", type=int, default=2, help="Keep rows with time_to_expiry <= this")
+    ap.add_argument("--active_days", type=int, default=28, help="Score keys with a sales row in this many days")
+    ap.add_argument("--check_pairs", type=int, default=0,
+                    help="Series checked against features.enrich on --date (0 = skip; reads their full history)")
+    add_source_args(ap)
+    args = ap.parse_args()
+
+    source = source_from_args(args)
+    st = FeatureState(args.state_dir)
+    t0 = time.time()
+    if args.rebuild or st.last_date is None:
+        hist = source.read(args.in_table, columns=STATE_COLS, date_range=("1900-01-01", args.date))
+        print(f"Loaded {len(hist):,} rows of {args.in_table} in {time.time() - t0:.1f}s")
+        if args.check_pairs > 0:
+            check_parity(hist, args.date, args.check_pairs)
+        st.bootstrap(hist)
+    elif st.last_date < args.date:
+        start = str(np.datetime64(st.last_date) + 1)
+        new = source.read(args.in_table, columns=STATE_COLS, date_range=(start, args.date))
+        n = st.apply(new)
+        st.save(args.date)
+        print(f"[state] applied {n:,} rows ({start}..{args.date}) to {len(st):,} series in {time.time() - t0:.1f}s")
+    else:
+        print(f"[state] up to date ({st.last_date})")
+
+    t0 = time.time()
+    next_day = str(np.datetime64(args.date) + 1)
+    frame = st.scoring_frame(next_day, args.max_tte, args.active_days)
+    path = ResultStore(args.out_dir, args.out_table, SCORING_SCHEMA).write_day(next_day, frame)
+    print(f"Wrote {len(frame):,} scoring rows for {next_day} in {time.time() - t0:.1f}s -> {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+# =============================================================
+# file: ce/src/features.py
+# Purpose: Local, vectorized equivalent of ml/feature_build/features_enriched.sql
+#  - lag{1,7,14,28}_log_sales, rm7/rm28_log_sales, promo_in_last_7d and the
+#    rn_item_store > 28 history filter, from a features_clean-shaped frame
+#  - One sort on a packed (store, item, date) int64 key; every window is then
+#    array arithmetic over contiguous (store, item) segments: shifts for LAG,
+#    cumulative-sum differences clipped at the segment start for the
+#    ROWS BETWEEN k PRECEDING AND 1 PRECEDING windows (AVG skips NULLs)
+#  - --check_pairs N runs features_enriched.sql itself through DuckDB on N
+#    random (store, item) series and asserts the columns match
+#  - Output: Parquet mirror layout (root/<table>/date=YYYY-MM-DD/part-0.parquet)
+# =============================================================
+
+#!/usr/bin/env python3
+import os, argparse, re, shutil, time
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from data_source import DATE_PART, add_source_args, source_from_args
+
+LAGS = [1, 7, 14, 28]
+ROLLING = {"rm7_log_sales": 7, "rm28_log_sales": 28}
+PROMO_WINDOW = 7
+MIN_HISTORY = 28  # rn_item_store > 28
+FEATURE_COLS = [f"lag{k}_log_sales" for k in LAGS] + list(ROLLING) + ["promo_in_last_7d"]
+SQL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "ml", "feature_build",
+                        "features_enriched.sql")
+
+
+def sort_order(store: pd.Series, item: pd.Series, date: pd.Series) -> Tuple[np.ndarray, np.ndarray]:
+    """Row order by (store, item, date) and the segment start flag of each sorted row."""
+    s_codes, s_uniq = pd.factorize(store, sort=True)
+    i_codes, i_uniq = pd.factorize(item, sort=True)
+    days = pd.to_datetime(date).to_numpy().astype("datetime64[D]").astype(np.int64)
+    d0 = days.min() if len(days) else 0
+    pair = s_codes.astype(np.int64) * len(i_uniq) + i_codes
+    key = pair * (int(days.max() - d0) + 1 if len(days) else 1) + (days - d0)
+    order = np.argsort(key, kind="stable")
+    p = pair[order]
+    start = np.ones(len(p), dtype=bool)
+    start[1:] = p[1:] != p[:-1]
+    return order, start
+
+
+def segment_pos(start: np.ndarray) -> np.ndarray:
+    """0-based row number within each segment (ROW_NUMBER() - 1)."""
+    idx = np.arange(len(start))
+    return idx - np.maximum.accumulate(np.where(start, idx, 0))
+
+
+def lag(x: np.ndarray, k: int, pos: np.ndarray) -> np.ndarray:
+    """LAG(x, k): value k rows earlier in the segment, NaN before that."""
+    out = np.full(len(x), np.nan)
+    out[k:] = x[:-k]
+    out[pos < k] = np.nan
+    return out
+
+
+def preceding_sum(x: np.ndarray, k: int, pos: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """(SUM, COUNT of non-NULL) over ROWS BETWEEN k PRECEDING AND 1 PRECEDING within the segment."""
+    ok = ~np.isnan(x)
+    cs = np.concatenate([[0.0], np.cumsum(np.where(ok, x, 0.0))])
+    cn = np.concatenate([[0], np.cumsum(ok)])
+    hi = np.arange(len(x))
+    lo = hi - np.minimum(pos, k)
+    return cs[hi] - cs[lo], cn[hi] - cn[lo]
+
+
+def enrich(df: pd.DataFrame, min_history: int = MIN_HISTORY) -> pd.DataFrame:
+    """features_clean rows -> features_enriched rows (sorted by store, item, date)."""
+    t0 = time.time()
+    order, start = sort_order(df["store_nbr"], df["item_nbr"], df["date"])
+    pos = segment_pos(start)
+    log_sales = df["log_sales"].to_numpy(dtype=np.float64)[order]
+    promo = (df["discount_pct"].to_numpy(dtype=np.float64)[order] > 0).astype(np.float64)
+
+    feats: Dict[str, np.ndarray] = {}
+    for k in LAGS:
+        feats[f"lag{k}_log_sales"] = lag(log_sales, k, pos)
+    for name, w in ROLLING.items():
+        s, c = preceding_sum(log_sales, w, pos)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            feats[name] = np.where(c > 0, s / np.maximum(c, 1), np.nan)
+    s, _ = preceding_sum(promo, PROMO_WINDOW, pos)
+    feats["promo_in_last_7d"] = np.where(pos > 0, (s > 0).astype(np.float64), np.nan)
+
+    keep = pos >= min_history
+    out = df.take(order[keep]).reset_index(drop=True)
+    for c, v in feats.items():
+        out[c] = v[keep]
+    if min_history > 0:
+        # Every kept row has a full 7-day window, so the flag is never NULL
+        out["promo_in_last_7d"] = out["promo_in_last_7d"].astype(np.int64)
+    print(f"[features] {len(df):,} rows -> {len(out):,} ({int(start.sum()):,} series) in {time.time() - t0:.1f}s")
+    return out
+
+
+def sql_enrich(df: pd.DataFrame, sql_path: str = SQL_PATH) -> pd.DataFrame:
+    """Run features_enriched.sql itself (BigQuery dialect, DuckDB-compatible windows) over `df`."""
+    import duckdb
+    with open(sql_path) as f:
+        sql = f.read()
+    sql = re.sub(r"--[^\n]*", "", sql)
+    sql = re.sub(r"CREATE OR REPLACE TABLE\s+`[^`]+`\s+AS", "", sql, flags=re.I)
+    sql = re.sub(r"`[^`]*features_clean`", "features_clean", sql)
+    con = duckdb.connect()
+    con.register("features_clean", df)
+    return con.execute(sql).df()
+
+
+def check_parity(df: pd.DataFrame, pairs: int = 200, seed: int = 0, atol: float = 1e-9) -> None:
+    """enrich() vs features_enriched.sql on `pairs` random (store, item) series; raises on mismatch."""
+    keys = df[["store_nbr", "item_nbr"]].drop_duplicates()
+    pick = keys.sample(min(pairs, len(keys)), random_state=seed)
+    sub = df.merge(pick, on=["store_nbr", "item_nbr"])
+    cols = ["date", "store_nbr", "item_nbr"] + FEATURE_COLS
+    ours = enrich(sub)[cols]
+    ref = sql_enrich(sub)[cols]
+    key = ["store_nbr", "item_nbr", "date"]
+    for frame in (ours, ref):
+        frame["date"] = pd.to_datetime(frame["date"])
+    ours = ours.sort_values(key).reset_index(drop=True)
+    ref = ref.sort_values(key).reset_index(drop=True)
+    assert len(ours) == len(ref), f"row count {len(ours):,} != SQL {len(ref):,}"
+    assert (ours[key].astype(str).to_numpy() == ref[key].astype(str).to_numpy()).all(), "row keys differ from SQL"
+    for c in FEATURE_COLS:
+        a, b = ours[c].to_numpy(dtype=np.float64), ref[c].to_numpy(dtype=np.float64)
+        assert (np.isnan(a) == np.isnan(b)).all(), f"{c}: NULL pattern differs from SQL"
+        err = np.nanmax(np.abs(a - b)) if len(a) and not np.isnan(a).all() else 0.0
+        assert err <= atol, f"{c}: max abs diff {err:.3g} vs SQL"
+    print(f"[features] parity with {os.path.basename(SQL_PATH)} OK: {len(pick)} series, {len(ours):,} rows")
+
+
+def write_partitioned(df: pd.DataFrame, root: str, table: str) -> int:
+    """Write root/<table>/date=YYYY-MM-DD/part-0.parquet (replaces the table)."""
+    tdir = os.path.join(root, table)
+    shutil.rmtree(tdir, ignore_errors=True)
+    days = pd.to_datetime(df["date"]).to_numpy().astype("datetime64[D]")
+    order = np.argsort(days, kind="stable")
+    tbl = pa.Table.from_pandas(df, preserve_index=False).take(pa.array(order))
+    days = days[order]
+    bounds = np.flatnonzero(np.r_[True, days[1:] != days[:-1], True])
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        pdir = os.path.join(tdir, DATE_PART + str(days[lo]))
+        os.makedirs(pdir, exist_ok=True)
+        pq.write_table(tbl.slice(lo, hi - lo), os.path.join(pdir, "part-0.parquet"))
+    return len(bounds) - 1
+
+
+def main():
+    ap = argparse.ArgumentParser(description="features_clean -> features_enriched, locally")
+    ap.add_argument("--project", default=os.getenv("PROJECT"))
+    ap.add_argument("--in_table", default="features_clean")
+    ap.add_argument("--start_date", default=None, help="Optional date window of the input (YYYY-MM-DD)")
+    ap.add_argument("--end_date", default=None)
+    ap.add_argument("--out_dir", default="data", help="Parquet root for the output table")
+    ap.add_argument("--out_table", default="features_enriched")
+    ap.add_argument("--min_history", type=int, default=MIN_HISTORY, help="Keep rows with rn_item_store > this")
+    ap.add_argument("--check_pairs", type=int, default=200,
+                    help="Series checked against features_enriched.sql in DuckDB (0 = skip)")
+    add_source_args(ap)
+    args = ap.parse_args()
+
+    source = source_from_args(args)
+    date_range: Optional[Tuple[str, str]] = None
+    if args.start_date or args.end_date:
+        date_range = (args.start_date or "1900-01-01", args.end_date or "2999-12-31")
+    t0 = time.time()
+    df = source.read(args.in_table, date_range=date_range)
+    print(f"Loaded {len(df):,} rows of {args.in_table} in {time.time() - t0:.1f}s")
+
+    if args.check_pairs > 0:
+        check_parity(df, args.check_pairs)
+    out = enrich(df, args.min_history)
+    t0 = time.time()
+    n_days = write_partitioned(out, args.out_dir, args.out_table)
+    print(f"Wrote {len(out):,} rows / {n_days} days to {os.path.join(args.out_dir, args.out_table)} "
+          f"in {time.time() - t0:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
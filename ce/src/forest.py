@@ -0,0 +1,560 @@
+# =============================================================
+# file: ce/src/forest.py
+# Purpose: Array-backed view of a trained XGBoost / LightGBM booster
+#  - Flat node arrays (feature, threshold, children, leaf value,
+#    default direction, categorical bitsets) for all trees
+#  - Vectorized NumPy traversal of (row, tree) pairs
+#  - PriceIncrementalPredictor: walk every row's non-price splits once,
+#    then re-walk only the price-dependent subtrees per candidate
+#  - save_forest / load_forest: compiled model = one .npy per array + meta.json
+#    (feature names, base score, cat_vocab), loaded with mmap in every worker
+#  - `python ce/src/forest.py --model_path ... --out ...` compiles a booster
+#    and checks parity against its native predict
+# =============================================================
+
+#!/usr/bin/env python3
+import os, argparse, json
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+from encoding import UNK, CategoryEncoder
+
+
+PRICE_FEATURES = ("effective_price","discount_pct")
+FORMAT_VERSION = 1
+ARRAYS = [
+    "roots","feature","threshold","left","right","value",
+    "nan_left","nan_to_zero","zero_missing",
+    "cat_offset","cat_nwords","cat_in_left","cat_bits"
+]
+# Objectives whose prediction is the raw tree sum (the only ones the array predictor supports)
+IDENTITY_OBJECTIVES = {"reg:squarederror","reg:absoluteerror","reg:pseudohubererror",
+                       "regression","regression_l1","huber","fair","quantile"}
+
+
+class Forest:
+    """Sum-of-trees regressor; node i goes left iff x[feature[i]] < threshold[i] (or category test)."""
+
+    def __init__(self,
+                 feature_names: List[str],
+                 roots: np.ndarray,
+                 feature: np.ndarray,
+                 threshold: np.ndarray,
+                 left: np.ndarray,
+                 right: np.ndarray,
+                 value: np.ndarray,
+                 nan_left: np.ndarray,
+                 nan_to_zero: np.ndarray,
+                 zero_missing: np.ndarray,
+                 cat_offset: np.ndarray,
+                 cat_nwords: np.ndarray,
+                 cat_in_left: np.ndarray,
+                 cat_bits: np.ndarray,
+                 base_score: float = 0.0,
+                 cat_vocab: Optional[Dict[str, List[str]]] = None):
+        self.feature_names = list(feature_names)
+        self.roots = roots
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        self.value = value
+        self.nan_left = nan_left
+        self.nan_to_zero = nan_to_zero
+        self.zero_missing = zero_missing
+        self.cat_offset = cat_offset
+        self.cat_nwords = cat_nwords
+        self.cat_in_left = cat_in_left
+        self.cat_bits = cat_bits
+        self.base_score = float(base_score)
+        self.cat_vocab = cat_vocab
+        self.encoder = CategoryEncoder(cat_vocab) if cat_vocab else None
+        self._has_zero_missing = bool(zero_missing.any())
+        self._has_nan_to_zero = bool(nan_to_zero.any())
+        self._has_cats = bool((cat_offset >= 0).any())
+        # [right | left] so that child = _children[node + N * go_left]
+        self._n_nodes = len(feature)
+        self._children = np.concatenate([right, left])
+        self._internal = feature >= 0
+        # Same with leaves pointing to themselves: a walk can then take a fixed number of steps
+        idx = np.arange(self._n_nodes)
+        self._children_fixed = np.concatenate([np.where(self._internal, right, idx),
+                                               np.where(self._internal, left, idx)])
+        self._feature0 = np.maximum(feature, 0)
+        leaf_depth = self._leaf_depths()
+        self._max_depth = int(leaf_depth.max()) if leaf_depth.size else 0
+        # Balanced (depth-wise grown) trees: fixed steps beat shrinking the active set each level
+        self._fixed_depth = leaf_depth.size > 0 and self._max_depth <= 1.5 * leaf_depth.mean()
+
+    @property
+    def num_trees(self) -> int:
+        return len(self.roots)
+
+    def _leaf_depths(self) -> np.ndarray:
+        depths, level, d = [], np.asarray(self.roots), 0
+        while level.size:
+            inner = self._internal[level]
+            depths.append(np.full(int((~inner).sum()), d))
+            level = np.concatenate([self.left[level[inner]], self.right[level[inner]]])
+            d += 1
+        return np.concatenate(depths) if depths else np.zeros(0)
+
+    # ---------- traversal ----------
+    def _go_left(self, nd: np.ndarray, vals: np.ndarray) -> np.ndarray:
+        if self._has_nan_to_zero:
+            vals = np.where(np.isnan(vals) & self.nan_to_zero[nd], 0.0, vals)
+        missing = np.isnan(vals)
+        if self._has_zero_missing:
+            missing |= self.zero_missing[nd] & (vals == 0.0)
+        go_left = vals < self.threshold[nd]
+        if self._has_cats:
+            cat = np.flatnonzero(self.cat_offset[nd] >= 0)
+            if cat.size:
+                cn = nd[cat]
+                cv = vals[cat]
+                code = np.where(np.isnan(cv), -1, cv).astype(np.int64)
+                ok = (code >= 0) & (code < self.cat_nwords[cn] * 32)
+                code = np.where(ok, code, 0)
+                word = self.cat_bits[self.cat_offset[cn] + (code >> 5)]
+                in_set = ok & (((word >> (code & 31).astype(np.uint32)) & 1) == 1)
+                go_left[cat] = in_set == self.cat_in_left[cn]
+        if missing.any():
+            go_left = np.where(missing, self.nan_left[nd], go_left)
+        return go_left
+
+    def descend(self,
+                node: np.ndarray,
+                row: np.ndarray,
+                X: np.ndarray,
+                stop: Optional[np.ndarray] = None) -> np.ndarray:
+        """Walk (row, node) pairs down to a leaf, or to the first node whose feature is in `stop`."""
+        node = node.copy()
+        F = X.shape[1]
+        Xf = X.reshape(-1)
+        internal = self._internal if stop is None else self._internal & ~stop[np.maximum(self.feature, 0)]
+        act = np.flatnonzero(internal[node])
+        while act.size:
+            nd = node[act]
+            nxt = self._children[nd + self._n_nodes * self._go_left(nd, Xf[row[act] * F + self.feature[nd]])]
+            node[act] = nxt
+            act = act[internal[nxt]]
+        return node
+
+    def _walk_fixed(self, node: np.ndarray, row: np.ndarray, X: np.ndarray) -> np.ndarray:
+        """Walk every (row, node) pair max_depth steps; pairs already at a leaf stay put."""
+        base = row * X.shape[1]
+        Xf = X.reshape(-1)
+        for _ in range(self._max_depth):
+            node = self._children_fixed[node + self._n_nodes * self._go_left(node, Xf[base + self._feature0[node]])]
+        return node
+
+    def predict(self, X: np.ndarray, chunk_rows: int = 8192) -> np.ndarray:
+        """Predict raw scores for a dense float matrix in `feature_names` order (categoricals as codes)."""
+        n, T = len(X), self.num_trees
+        out = np.full(n, self.base_score, dtype=np.float64)
+        for s in range(0, n, chunk_rows):
+            e = min(s + chunk_rows, n)
+            m = e - s
+            row = np.repeat(np.arange(s, e), T)
+            if self._fixed_depth:
+                leaf = self._walk_fixed(np.tile(self.roots, m), row, X)
+            else:
+                leaf = self.descend(np.tile(self.roots, m), row, X)
+            out[s:e] += self.value[leaf].reshape(m, T).sum(axis=1)
+        return out
+
+    def predict_frame(self, X: pd.DataFrame) -> np.ndarray:
+        """Predict a DataFrame (pandas categoricals, or raw values encoded with the bundled vocab), as float32."""
+        return self.predict(to_matrix(X, self.feature_names, self.encoder)).astype(np.float32)
+
+    def feature_mask(self, names: Sequence[str]) -> np.ndarray:
+        return np.isin(np.array(self.feature_names), list(names))
+
+
+# ---------- inputs ----------
+def to_matrix(X: pd.DataFrame,
+              feature_names: List[str],
+              encoder: Optional[CategoryEncoder] = None) -> np.ndarray:
+    """Dense float64 matrix in model feature order; categorical columns become codes (-1 -> NaN).
+
+    Raw (non-categorical) columns known to `encoder` get its vocab codes (unseen -> __UNK__).
+    """
+    M = np.empty((len(X), len(feature_names)), dtype=np.float64)
+    for j, c in enumerate(feature_names):
+        s = X[c]
+        if isinstance(s.dtype, pd.CategoricalDtype):
+            codes = s.cat.codes.to_numpy()
+            M[:, j] = np.where(codes < 0, np.nan, codes)
+        elif encoder is not None and c in encoder.vocab:
+            M[:, j] = encoder.codes(c, s)
+        else:
+            M[:, j] = s.to_numpy(dtype=np.float64, na_value=np.nan)
+    return M
+
+
+# ---------- builders ----------
+def _pack_bits(cat_sets: List[Optional[List[int]]]):
+    offset = np.full(len(cat_sets), -1, dtype=np.int64)
+    nwords = np.zeros(len(cat_sets), dtype=np.int64)
+    words: List[np.ndarray] = []
+    pos = 0
+    for i, cats in enumerate(cat_sets):
+        if cats is None:
+            continue
+        nw = (max(cats) // 32 + 1) if cats else 1
+        w = np.zeros(nw, dtype=np.uint32)
+        for c in cats:
+            w[c >> 5] |= np.uint32(1 << (c & 31))
+        offset[i], nwords[i] = pos, nw
+        words.append(w)
+        pos += nw
+    bits = np.concatenate(words) if words else np.zeros(0, dtype=np.uint32)
+    return offset, nwords, bits
+
+
+def from_xgboost(booster, cat_vocab: Optional[Dict[str, List[str]]] = None) -> Forest:
+    """Flatten an xgboost.Booster (all boosted rounds, like Booster.predict)."""
+    model = json.loads(booster.save_raw("json"))
+    learner = model["learner"]
+    objective = learner["objective"]["name"]
+    if objective not in IDENTITY_OBJECTIVES:
+        raise ValueError(f"Objective {objective!r} has a non-identity link; not supported by Forest")
+    names = learner["feature_names"]
+    base_score = float(str(learner["learner_model_param"]["base_score"]).strip("[]"))
+
+    roots, feat, thr, left, right, val, dleft, cat_sets = [], [], [], [], [], [], [], []
+    off = 0
+    for t in learner["gradient_booster"]["model"]["trees"]:
+        lc, rc = t["left_children"], t["right_children"]
+        n = len(lc)
+        cats = {nid: t["categories"][s:s + z] for nid, s, z in
+                zip(t["categories_nodes"], t["categories_segments"], t["categories_sizes"])}
+        roots.append(off)
+        for i in range(n):
+            is_leaf = lc[i] == -1
+            feat.append(-1 if is_leaf else t["split_indices"][i])
+            thr.append(t["split_conditions"][i])
+            left.append(-1 if is_leaf else lc[i] + off)
+            right.append(-1 if is_leaf else rc[i] + off)
+            val.append(t["split_conditions"][i] if is_leaf else 0.0)
+            dleft.append(bool(t["default_left"][i]))
+            cat_sets.append(cats.get(i) if (not is_leaf and t["split_type"][i] == 1) else None)
+        off += n
+
+    N = len(feat)
+    # xgboost stores float32 thresholds and compares in float32
+    threshold = np.asarray(thr, dtype=np.float32).astype(np.float64)
+    cat_offset, cat_nwords, cat_bits = _pack_bits(cat_sets)
+    return Forest(
+        feature_names=names,
+        roots=np.asarray(roots, dtype=np.int64),
+        feature=np.asarray(feat, dtype=np.int64),
+        threshold=threshold,
+        left=np.asarray(left, dtype=np.int64),
+        right=np.asarray(right, dtype=np.int64),
+        value=np.asarray(val, dtype=np.float32).astype(np.float64),
+        nan_left=np.asarray(dleft, dtype=bool),
+        nan_to_zero=np.zeros(N, dtype=bool),
+        zero_missing=np.zeros(N, dtype=bool),
+        cat_offset=cat_offset,
+        cat_nwords=cat_nwords,
+        cat_in_left=np.zeros(N, dtype=bool),  # xgboost: listed categories go right
+        cat_bits=cat_bits,
+        base_score=base_score,
+        cat_vocab=cat_vocab,
+    )
+
+
+def from_lightgbm(booster, cat_vocab: Optional[Dict[str, List[str]]] = None) -> Forest:
+    """Flatten a lightgbm.Booster up to best_iteration (like predict(num_iteration=best_iteration))."""
+    model = booster.dump_model(num_iteration=booster.best_iteration)
+    objective = str(model.get("objective", "regression")).split()[0]
+    if objective not in IDENTITY_OBJECTIVES:
+        raise ValueError(f"Objective {objective!r} has a non-identity link; not supported by Forest")
+    names = model["feature_names"]
+    cols = {k: [] for k in ["feat","thr","left","right","val","nan_left","nan_to_zero","zero_missing","cats"]}
+    roots: List[int] = []
+
+    def add(node) -> int:
+        i = len(cols["feat"])
+        for k in cols:
+            cols[k].append(None)
+        if "split_index" not in node:
+            cols["feat"][i], cols["thr"][i], cols["val"][i] = -1, 0.0, node["leaf_value"]
+            cols["left"][i] = cols["right"][i] = -1
+            cols["nan_left"][i] = cols["nan_to_zero"][i] = cols["zero_missing"][i] = False
+            return i
+        cols["feat"][i], cols["val"][i] = node["split_feature"], 0.0
+        mt = node.get("missing_type", "None")
+        if node["decision_type"] == "==":
+            cols["thr"][i] = 0.0
+            cols["cats"][i] = [int(c) for c in str(node["threshold"]).split("||")]
+            cols["nan_left"][i] = False  # NaN / negative categories go right
+            cols["nan_to_zero"][i] = cols["zero_missing"][i] = False
+        else:
+            # x <= t  <=>  x < nextafter(t, +inf)
+            cols["thr"][i] = np.nextafter(float(node["threshold"]), np.inf)
+            cols["nan_left"][i] = bool(node["default_left"])
+            cols["nan_to_zero"][i] = mt != "NaN"
+            cols["zero_missing"][i] = mt == "Zero"
+        cols["left"][i] = add(node["left_child"])
+        cols["right"][i] = add(node["right_child"])
+        return i
+
+    for t in model["tree_info"]:
+        roots.append(add(t["tree_structure"]))
+
+    cat_offset, cat_nwords, cat_bits = _pack_bits(cols["cats"])
+    return Forest(
+        feature_names=names,
+        roots=np.asarray(roots, dtype=np.int64),
+        feature=np.asarray(cols["feat"], dtype=np.int64),
+        threshold=np.asarray(cols["thr"], dtype=np.float64),
+        left=np.asarray(cols["left"], dtype=np.int64),
+        right=np.asarray(cols["right"], dtype=np.int64),
+        value=np.asarray(cols["val"], dtype=np.float64),
+        nan_left=np.asarray(cols["nan_left"], dtype=bool),
+        nan_to_zero=np.asarray(cols["nan_to_zero"], dtype=bool),
+        zero_missing=np.asarray(cols["zero_missing"], dtype=bool),
+        cat_offset=cat_offset,
+        cat_nwords=cat_nwords,
+        cat_in_left=np.ones(len(cols["feat"]), dtype=bool),  # lightgbm: listed categories go left
+        cat_bits=cat_bits,
+        cat_vocab=cat_vocab,
+    )
+
+
+def from_booster(booster, cat_vocab: Optional[Dict[str, List[str]]] = None) -> Forest:
+    if type(booster).__module__.startswith("xgboost"):
+        return from_xgboost(booster, cat_vocab)
+    return from_lightgbm(booster, cat_vocab)
+
+
+def load_booster(model_path: str):
+    """XGBoost JSON/UBJ or LightGBM text model, by extension."""
+    if model_path.endswith((".json", ".ubj")):
+        import xgboost as xgb
+        booster = xgb.Booster()
+        booster.load_model(model_path)
+        return booster
+    import lightgbm as lgb
+    return lgb.Booster(model_file=model_path)
+
+
+# ---------- compiled format ----------
+def save_forest(forest: Forest, path: str, source: str = "") -> None:
+    """Write `path/<array>.npy` for every node array plus `path/meta.json`."""
+    os.makedirs(path, exist_ok=True)
+    for name in ARRAYS:
+        np.save(os.path.join(path, f"{name}.npy"), np.ascontiguousarray(getattr(forest, name)))
+    meta = {
+        "format_version": FORMAT_VERSION,
+        "source": source,
+        "feature_names": forest.feature_names,
+        "base_score": forest.base_score,
+        "num_trees": forest.num_trees,
+        "num_nodes": int(len(forest.feature)),
+        "cat_vocab": forest.cat_vocab,
+    }
+    # meta.json last: its presence marks a complete model directory
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+
+def load_forest(path: str, mmap: bool = True) -> Forest:
+    """Open a compiled model; with mmap the node arrays are shared page cache across processes."""
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    if meta["format_version"] != FORMAT_VERSION:
+        raise ValueError(f"{path}: format_version {meta['format_version']} != {FORMAT_VERSION}")
+    arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode=("r" if mmap else None))
+              for name in ARRAYS}
+    return Forest(feature_names=meta["feature_names"], base_score=meta["base_score"],
+                  cat_vocab=meta.get("cat_vocab"), **arrays)
+
+
+# ---------- parity ----------
+def native_predict(booster, X: pd.DataFrame) -> np.ndarray:
+    if type(booster).__module__.startswith("xgboost"):
+        import xgboost as xgb
+        return booster.predict(xgb.DMatrix(X, enable_categorical=True))
+    return booster.predict(X, num_iteration=booster.best_iteration)
+
+
+def probe_frame(forest: Forest, n_rows: int = 20000, seed: int = 0) -> pd.DataFrame:
+    """Random rows that hit every split boundary: values drawn from the model's own thresholds
+    (exactly, and nudged either side), some NaN; categoricals over vocab + __UNK__."""
+    rng = np.random.default_rng(seed)
+    vocab = forest.cat_vocab or {}
+    internal = forest.feature >= 0
+    cols = {}
+    for j, c in enumerate(forest.feature_names):
+        if c in vocab:
+            cats = list(vocab[c]) + [UNK]
+            codes = rng.integers(0, len(cats), n_rows)
+            cols[c] = pd.Categorical.from_codes(codes, categories=cats)
+            continue
+        thr = np.asarray(forest.threshold[internal & (forest.feature == j)], dtype=np.float64)
+        thr = thr[np.isfinite(thr)]
+        if thr.size == 0:
+            thr = np.zeros(1)
+        v = rng.choice(thr, n_rows) + rng.choice([-1e-3, 0.0, 0.0, 1e-3], n_rows) * np.maximum(1.0, np.abs(thr).max())
+        v[rng.random(n_rows) < 0.05] = np.nan
+        # float32-representable, so native and array predictors see identical inputs
+        cols[c] = v.astype(np.float32).astype(np.float64)
+    return pd.DataFrame(cols)
+
+
+def check_parity(booster, forest: Forest, X: pd.DataFrame, atol: float = 1e-4, rtol: float = 1e-5) -> float:
+    """Max |native - forest| over X; raises AssertionError beyond atol + rtol * |native|
+    (xgboost sums leaves in float32, the array predictor in float64)."""
+    ref = np.asarray(native_predict(booster, X), dtype=np.float64)
+    got = forest.predict(to_matrix(X, forest.feature_names, forest.encoder))
+    diff = np.abs(ref - got)
+    bad = int((diff > atol + rtol * np.abs(ref)).sum())
+    err = float(diff.max()) if len(X) else 0.0
+    assert bad == 0, f"forest parity failed on {bad:,} rows: max abs diff {err:.3g}"
+    return err
+
+
+
+# ---------- price-only incremental evaluation ----------
+class PriceIncrementalPredictor:
+    """Grid predictor (see sweep_engine.GridPredictor) that shares non-price tree work across candidates.
+
+    Each (row, tree) is walked through its non-price splits once. Below a price split, candidates
+    are tracked as an interval of positions along the row's price-sorted grid: along that order every
+    price feature is monotone, so a split `x < t` cuts the interval in two and each reachable leaf
+    adds its value to a contiguous run of candidates. Cost is ~one prediction plus O(n x k) adds.
+    Rows whose candidate prices are not monotone (or are NaN) fall back to a plain tiled walk.
+    """
+
+    def __init__(self, forest: Forest, price_features: Sequence[str] = PRICE_FEATURES, chunk_rows: int = 8192):
+        self.forest = forest
+        self.price_features = list(price_features)
+        self.stop = forest.feature_mask(self.price_features)
+        self.slot = np.full(len(forest.feature_names), -1, dtype=np.int64)
+        for j, c in enumerate(self.price_features):
+            self.slot[forest.feature_names.index(c)] = j
+        price_nodes = forest._internal & self.stop[np.maximum(forest.feature, 0)]
+        # Interval cuts need plain numeric `<` splits on the price features
+        self.exact = not (forest.zero_missing[price_nodes].any() or (forest.cat_offset[price_nodes] >= 0).any())
+        self.chunk_rows = chunk_rows
+
+    def __call__(self, X: pd.DataFrame, prices: Dict[str, np.ndarray]) -> np.ndarray:
+        return self.predict_grid(to_matrix(X, self.forest.feature_names), prices)
+
+    def predict_grid(self, M: np.ndarray, prices: Dict[str, np.ndarray]) -> np.ndarray:
+        n, k = next(iter(prices.values())).shape
+        P = [np.asarray(prices[c], dtype=np.float64) for c in self.price_features]
+
+        # Sort each row's candidates by the first price feature; all others must follow monotonically
+        order = np.argsort(P[0], axis=1, kind="stable")
+        sv = [np.take_along_axis(p, order, axis=1) for p in P]
+        d = [np.diff(v, axis=1) for v in sv]
+        asc = np.column_stack([(x >= 0).all(axis=1) for x in d])
+        desc = np.column_stack([(x <= 0).all(axis=1) for x in d])
+        ok = (asc | desc).all(axis=1) & np.isfinite(sv[0]).all(axis=1)
+        if not self.exact:
+            ok[:] = False
+
+        out = np.empty((n, k), dtype=np.float64)
+        good = np.flatnonzero(ok)
+        if good.size:
+            acc = np.empty((good.size, k), dtype=np.float64)
+            for s in range(0, good.size, self.chunk_rows):
+                rows = good[s:s + self.chunk_rows]
+                acc[s:s + rows.size] = self._sorted_grid(M, rows, [v[rows] for v in sv], asc[rows])
+            out[good] = _unsort(acc, order[good])
+        bad = np.flatnonzero(~ok)
+        if bad.size:
+            out[bad] = self._tiled(M, bad, P)
+        return out.astype(np.float32)
+
+    def _sorted_grid(self, M, rows, sv, asc) -> np.ndarray:
+        """Predictions for `rows` along their sorted candidate axis (m x k)."""
+        f = self.forest
+        m, k = len(rows), sv[0].shape[1]
+        T = f.num_trees
+        local = np.repeat(np.arange(m), T)
+
+        # 1) Non-price part of every tree, once per row
+        node = f.descend(np.tile(f.roots, m), rows[local], M, stop=self.stop)
+        done = f.feature[node] < 0
+        fixed = np.bincount(local[done], weights=f.value[node[done]], minlength=m)
+
+        # 2) Price subtrees: carry [lo, hi) candidate intervals, resolve non-price splits on the way
+        diff = np.zeros(m * (k + 1), dtype=np.float64)
+        pend = np.flatnonzero(~done)
+        r, nd = local[pend], node[pend]
+        lo, hi = np.zeros(pend.size, dtype=np.int64), np.full(pend.size, k, dtype=np.int64)
+        while r.size:
+            nd = f.descend(nd, rows[r], M, stop=self.stop)
+            leaf = f.feature[nd] < 0
+            if leaf.any():
+                v, base = f.value[nd[leaf]], r[leaf] * (k + 1)
+                diff += np.bincount(base + lo[leaf], weights=v, minlength=diff.size)
+                diff -= np.bincount(base + hi[leaf], weights=v, minlength=diff.size)
+            split = np.flatnonzero(~leaf)
+            r, nd, lo, hi = r[split], nd[split], lo[split], hi[split]
+            j = self.slot[f.feature[nd]]
+            # number of candidates with value < threshold (they go left)
+            cnt = np.zeros(r.size, dtype=np.int64)
+            a = np.zeros(r.size, dtype=bool)
+            for s, v in enumerate(sv):
+                m_s = j == s
+                cnt[m_s] = (v[r[m_s]] < f.threshold[nd[m_s], None]).sum(axis=1)
+                a[m_s] = asc[r[m_s], s]
+            # ascending: left = [0, cnt); descending: left = [k - cnt, k)
+            cut = np.where(a, cnt, k - cnt)
+            l_lo, l_hi = np.where(a, lo, np.maximum(lo, cut)), np.where(a, np.minimum(hi, cut), hi)
+            r_lo, r_hi = np.where(a, np.maximum(lo, cut), lo), np.where(a, hi, np.minimum(hi, cut))
+            lk, rk = l_lo < l_hi, r_lo < r_hi
+            r = np.concatenate([r[lk], r[rk]])
+            nd = np.concatenate([f.left[nd[lk]], f.right[nd[rk]]])
+            lo = np.concatenate([l_lo[lk], r_lo[rk]])
+            hi = np.concatenate([l_hi[lk], r_hi[rk]])
+        varying = np.cumsum(diff.reshape(m, k + 1), axis=1)[:, :k]
+        return f.base_score + fixed[:, None] + varying
+
+    def _tiled(self, M, rows, P) -> np.ndarray:
+        """General path: full walk of every (row, candidate)."""
+        k = P[0].shape[1]
+        Mt = np.repeat(M[rows], k, axis=0)
+        for c, p in zip(self.price_features, P):
+            Mt[:, self.forest.feature_names.index(c)] = p[rows].reshape(-1)
+        return self.forest.predict(Mt, chunk_rows=self.chunk_rows).reshape(rows.size, k)
+
+
+def _unsort(sorted_vals: np.ndarray, order: np.ndarray) -> np.ndarray:
+    out = np.empty_like(sorted_vals)
+    np.put_along_axis(out, order, sorted_vals, axis=1)
+    return out
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Compile a trained booster + cat vocab into array form")
+    ap.add_argument("--model_path", default="models/xgb_cat.json", help="XGBoost .json/.ubj or LightGBM .txt")
+    ap.add_argument("--cat_vocab_path", default="models/xgb_cat_vocab.json")
+    ap.add_argument("--out", default=None, help="Output directory (default: <model_path stem>.forest)")
+    ap.add_argument("--check_rows", type=int, default=20000, help="Parity probe rows (0 = skip)")
+    ap.add_argument("--atol", type=float, default=1e-4)
+    ap.add_argument("--rtol", type=float, default=1e-5)
+    args = ap.parse_args()
+
+    out = args.out or os.path.splitext(args.model_path)[0] + ".forest"
+    booster = load_booster(args.model_path)
+    forest = from_booster(booster, CategoryEncoder.load(args.cat_vocab_path).vocab)
+    save_forest(forest, out, source=os.path.basename(args.model_path))
+    print(f"Compiled {forest.num_trees} trees / {len(forest.feature):,} nodes -> {out}")
+
+    if args.check_rows:
+        err = check_parity(booster, load_forest(out), probe_frame(forest, args.check_rows),
+                           args.atol, args.rtol)
+        print(f"Parity vs native predict on {args.check_rows:,} probe rows: max abs diff {err:.2e}")
+
+
+if __name__ == "__main__":
+    main()
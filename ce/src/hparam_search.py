@@ -0,0 +1,263 @@
+# =============================================================
+# file: ce/src/hparam_search.py
+# Purpose: Hyperparameter search over one loaded, binned training matrix
+#  - Splits are loaded / encoded once (arrow_ingest.load_encoded) with the
+#    training script's features and dtypes (xgboost_train.py / lightgbm_train_cat.py)
+#  - The binned matrix (QuantileDMatrix / constructed lgb.Dataset) depends
+#    only on max_bin: trials are grouped by it and each group shares one
+#    matrix, built once and freed before the next group
+#  - Up to --concurrency trials train at once on threads (both libraries
+#    release the GIL), each with cores / concurrency threads
+#  - MedianPruner: every --prune_every rounds a trial's best validation RMSE
+#    is compared with the other trials' at the same round; worse than the
+#    median -> stopped (after --prune_warmup rounds)
+#  - Each trial is a nested MLflow run (params, final metrics, validation
+#    curve); the best params go to --out for `--params_json` in the trainers
+# =============================================================
+
+#!/usr/bin/env python3
+import os, argparse, importlib, itertools, json, threading, time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional
+
+import numpy as np
+import mlflow
+
+from data_source import add_source_args, source_from_args
+from arrow_ingest import load_encoded
+from perf import span, tracer
+
+MODELS = {
+    "xgb": dict(module="xgboost_train", experiment="peri-price-xgb-cat"),
+    "lgb": dict(module="lightgbm_train_cat", experiment="peri-price-lgbm-cat"),
+}
+# Default search spaces: name -> candidate values
+SPACES = {
+    "xgb": {"max_depth": [6, 8, 10, 12], "max_bin": [128, 256], "learning_rate": [0.03, 0.05, 0.1, 0.2],
+            "subsample": [0.6, 0.8, 1.0], "colsample_bytree": [0.6, 0.8, 1.0]},
+    "lgb": {"num_leaves": [63, 127, 255, 511], "max_bin": [127, 255], "learning_rate": [0.03, 0.05, 0.08, 0.15],
+            "bagging_fraction": [0.6, 0.8, 1.0], "feature_fraction": [0.6, 0.8, 1.0]},
+}
+
+
+def sample_trials(space: Dict[str, list], n: int, seed: int = 0) -> List[Dict]:
+    """n distinct configurations drawn uniformly from the grid of `space`."""
+    names = sorted(space)
+    sizes = [len(space[k]) for k in names]
+    total = int(np.prod(sizes))
+    rng = np.random.default_rng(seed)
+    picks = rng.choice(total, size=min(n, total), replace=False)
+    trials = []
+    for p in picks:
+        idx = np.unravel_index(int(p), sizes)
+        trials.append({k: space[k][i] for k, i in zip(names, idx)})
+    return trials
+
+
+class MedianPruner:
+    """Shared across trial threads: prune when the best-so-far metric (lower is better) at a checkpoint
+    round is worse than the median of the other trials' best-so-far at that round."""
+
+    def __init__(self, every: int = 25, warmup: int = 50, min_peers: int = 2):
+        self.every = max(1, every)
+        self.warmup = warmup
+        self.min_peers = min_peers
+        self._at: Dict[int, Dict[int, float]] = {}  # round -> {trial: best so far}
+        self._lock = threading.Lock()
+
+    def should_prune(self, trial: int, rnd: int, best: float) -> bool:
+        if (rnd + 1) % self.every:
+            return False
+        with self._lock:
+            at = self._at.setdefault(rnd, {})
+            at[trial] = best
+            peers = [v for t, v in at.items() if t != trial]
+        return rnd + 1 >= self.warmup and len(peers) >= self.min_peers and best > float(np.median(peers))
+
+
+class TrialCurve:
+    """Validation curve + prune flag of one trial."""
+
+    def __init__(self, trial: int, pruner: Optional[MedianPruner]):
+        self.trial = trial
+        self.pruner = pruner
+        self.curve: List[float] = []
+        self.pruned = False
+
+    def step(self, rnd: int, value: float) -> bool:
+        """Record round `rnd`; True = stop the trial."""
+        self.curve.append(float(value))
+        if self.pruner is not None and self.pruner.should_prune(self.trial, rnd, min(self.curve)):
+            self.pruned = True
+        return self.pruned
+
+
+def xgb_matrices(Xtr, ytr, Xva, yva, max_bin: int):
+    import xgboost as xgb
+    dtrain = xgb.QuantileDMatrix(Xtr, label=ytr, max_bin=max_bin, enable_categorical=True)
+    dvalid = xgb.QuantileDMatrix(Xva, label=yva, ref=dtrain, max_bin=max_bin, enable_categorical=True)
+    return dtrain, dvalid
+
+
+def lgb_matrices(Xtr, ytr, Xva, yva, max_bin: int, cat_cols: List[str]):
+    import lightgbm as lgb
+    ds_params = {"max_bin": max_bin, "verbosity": -1}
+    dtrain = lgb.Dataset(Xtr, label=ytr, categorical_feature=cat_cols, params=ds_params, free_raw_data=False)
+    dvalid = lgb.Dataset(Xva, label=yva, categorical_feature=cat_cols, params=ds_params, reference=dtrain,
+                         free_raw_data=False)
+    dtrain.construct()
+    dvalid.construct()
+    return dtrain, dvalid
+
+
+def run_xgb_trial(mod, params: Dict, dtrain, dvalid, rounds: int, curve: TrialCurve) -> Dict:
+    import xgboost as xgb
+
+    class Prune(xgb.callback.TrainingCallback):
+        def after_iteration(self, model, epoch, evals_log) -> bool:
+            return curve.step(epoch, evals_log["valid"]["rmse"][-1])
+
+    booster = xgb.train(params, dtrain, num_boost_round=rounds, evals=[(dvalid, "valid")],
+                        early_stopping_rounds=50, verbose_eval=False, callbacks=[Prune()])
+    return {"valid_rmse": float(booster.best_score), "best_iteration": int(booster.best_iteration)}
+
+
+def run_lgb_trial(mod, params: Dict, dtrain, dvalid, rounds: int, curve: TrialCurve) -> Dict:
+    import lightgbm as lgb
+
+    def prune(env):
+        res = {name: value for data, name, value, _ in env.evaluation_result_list if data == "valid"}
+        if curve.step(env.iteration - env.begin_iteration, res["rmse"]):
+            # Stop at the best round so far, like XGBoost's best_score, not the round pruned at
+            best_rnd = int(np.argmin(curve.curve))
+            raise lgb.callback.EarlyStopException(env.begin_iteration + best_rnd,
+                                                  [("valid", "rmse", curve.curve[best_rnd], False)])
+
+    booster = lgb.train(params, dtrain, num_boost_round=rounds, valid_sets=[dvalid], valid_names=["valid"],
+                        callbacks=[lgb.early_stopping(stopping_rounds=100, verbose=False), prune])
+    best = booster.best_score.get("valid", {})
+    rmse = best.get("rmse", min(curve.curve) if curve.curve else float("nan"))
+    return {"valid_rmse": float(rmse), "best_iteration": int(booster.best_iteration or len(curve.curve))}
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Parallel hyperparameter search on one binned training matrix")
+    ap.add_argument("--project", default=os.getenv("PROJECT"))
+    ap.add_argument("--mlflow_server", required=True)
+    ap.add_argument("--model", choices=list(MODELS), default="xgb")
+    ap.add_argument("--experiment", default=None, help="MLflow experiment (default: the trainer's)")
+    ap.add_argument("--trials", type=int, default=16)
+    ap.add_argument("--space", default=None, help="JSON file {param: [values]} replacing the default space")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--max_rounds", type=int, default=None, help="Boosting rounds cap (default: the trainer's)")
+    ap.add_argument("--concurrency", type=int, default=2, help="Trials training at the same time")
+    ap.add_argument("--cores", type=int, default=0, help="Threads shared by the trials (0 = all CPUs)")
+    ap.add_argument("--prune_every", type=int, default=25, help="Rounds between pruning checks (0 = no pruning)")
+    ap.add_argument("--prune_warmup", type=int, default=50, help="No pruning before this many rounds")
+    ap.add_argument("--out", default=None, help="Search results JSON (default: models/<model>_search.json)")
+    add_source_args(ap)
+    args = ap.parse_args()
+    if args.trials < 1:
+        raise SystemExit("--trials must be >= 1")
+
+    spec = MODELS[args.model]
+    mod = importlib.import_module(spec["module"])
+    space = SPACES[args.model]
+    if args.space:
+        with open(args.space) as f:
+            space = json.load(f)
+    rounds = args.max_rounds or mod.NUM_BOOST_ROUND
+    cores = args.cores or os.cpu_count() or 1
+    concurrency = max(1, min(args.concurrency, cores, args.trials))
+    threads = max(1, cores // concurrency)
+    out_path = args.out or os.path.join("models", f"{args.model}_search.json")
+
+    mlflow.set_tracking_uri(f"http://{args.mlflow_server}:5000")
+    mlflow.set_experiment(args.experiment or spec["experiment"])
+    source = source_from_args(args)
+
+    trials = sample_trials(space, args.trials, args.seed)
+    if not trials:
+        raise SystemExit(f"search space has no configurations: {json.dumps(space)}")
+    pruner = MedianPruner(args.prune_every, args.prune_warmup) if args.prune_every > 0 else None
+    results: List[Dict] = []
+
+    with mlflow.start_run(run_name=f"{args.model}_cat_search"):
+        mlflow.log_params({"trials": len(trials), "concurrency": concurrency, "threads_per_trial": threads,
+                           "max_rounds": rounds, "space": json.dumps(space)})
+
+        # 1) Load + encode once (train / valid only; test stays untouched by the search)
+        X, y, _ = load_encoded(source, mod.SPLIT_TABLE, mod.FEATURES, mod.LABEL, mod.DTYPES, mod.CAT_COLS,
+                               ["train","valid"])
+        (Xtr, Xva), (ytr, yva) = [X["train"], X["valid"]], [y["train"], y["valid"]]
+        print(f"[search] {len(trials)} trials on {len(ytr):,} train / {len(yva):,} valid rows, "
+              f"{concurrency} at a time x {threads} threads")
+
+        # 2) One binned matrix per max_bin, shared by that group's trials
+        default_bin = mod.PARAMS.get("max_bin", 256)
+        groups = itertools.groupby(sorted(enumerate(trials), key=lambda t: t[1].get("max_bin", default_bin)),
+                                   key=lambda t: t[1].get("max_bin", default_bin))
+        for max_bin, group in groups:
+            group = list(group)
+            with span("dataset", rows=len(ytr) + len(yva)):
+                if args.model == "xgb":
+                    dtrain, dvalid = xgb_matrices(Xtr, ytr, Xva, yva, max_bin)
+                else:
+                    dtrain, dvalid = lgb_matrices(Xtr, ytr, Xva, yva, max_bin, mod.CAT_COLS)
+
+            def run(i: int, cfg: Dict):
+                params = {**mod.PARAMS, **cfg, "max_bin": max_bin}
+                if args.model == "xgb":
+                    params["nthread"] = threads
+                    fn = run_xgb_trial
+                else:
+                    params["num_threads"] = threads
+                    fn = run_lgb_trial
+                curve = TrialCurve(i, pruner)
+                t0 = time.time()
+                with span("trial", rows=len(ytr)):
+                    res = fn(mod, params, dtrain, dvalid, rounds, curve)
+                res.update(rounds=len(curve.curve), pruned=curve.pruned, seconds=time.time() - t0)
+                return i, cfg, res, curve.curve
+
+            # 3) Bounded concurrent trials; MLflow logging stays on this thread
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                futs = [pool.submit(run, i, cfg) for i, cfg in group]
+                for fut in as_completed(futs):
+                    i, cfg, res, curve = fut.result()
+                    results.append(dict(trial=i, params=cfg, **res))
+                    print(f"[trial {i:03d}] {json.dumps(cfg)} valid_rmse={res['valid_rmse']:.4f} "
+                          f"rounds={res['rounds']}{' (pruned)' if res['pruned'] else ''} {res['seconds']:.1f}s")
+                    with mlflow.start_run(run_name=f"trial-{i:03d}", nested=True):
+                        mlflow.log_params(dict(cfg, max_bin=max_bin))
+                        mlflow.log_metrics({"valid_rmse": res["valid_rmse"], "best_iteration": res["best_iteration"],
+                                            "rounds": res["rounds"], "pruned": int(res["pruned"]),
+                                            "seconds": res["seconds"]})
+                        for step, v in enumerate(curve):
+                            mlflow.log_metric("valid_rmse_curve", v, step=step)
+            del dtrain, dvalid
+
+        # 4) Best params -> JSON for the trainers' --params_json
+        results.sort(key=lambda r: r["valid_rmse"])
+        best = results[0]
+        rep = {"model": args.model, "best_params": dict(best["params"]), "best_valid_rmse": best["valid_rmse"],
+               "best_iteration": best["best_iteration"], "trials": results,
+               "pruned": sum(r["pruned"] for r in results)}
+        os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+        with open(out_path, "w") as f:
+            json.dump(rep, f, indent=2, default=str)
+        mlflow.log_params({f"best_{k}": v for k, v in best["params"].items()})
+        mlflow.log_metric("best_valid_rmse", best["valid_rmse"])
+        mlflow.log_artifact(out_path)
+
+        perf_path = os.path.splitext(out_path)[0] + "_perf.json"
+        tracer.write_json(perf_path, script=os.path.basename(__file__), args=vars(args))
+        mlflow.log_metrics(tracer.metrics())
+        mlflow.log_artifact(perf_path)
+
+    print(f"Best trial {best['trial']:03d}: valid_rmse={best['valid_rmse']:.4f} {json.dumps(best['params'])} "
+          f"({rep['pruned']} of {len(results)} pruned) -> {out_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+# =============================================================
+# file: ce/src/incremental_train.py
+# Purpose: Warm-start refresh of a trained XGBoost / LightGBM model on newly
+#          arrived days instead of a full retrain
+#  - Parent = the saved model + vocab (+ <model>_lineage.json when the parent
+#    was itself a refresh); new days = --new_from .. --new_to, by default the
+#    day after the parent's data_through .. the latest day in the table
+#  - Refresh data = the new days + --context_days of recent history before
+#    them; the last --holdout_days new days are held out (early stopping,
+#    parent vs refreshed metrics)
+#  - Vocab: new stores / families / ... are appended to the parent vocab, so
+#    existing codes never move and the old trees route them as before.
+#    XGBoost only continues a model on its own category set: for xgb the new
+#    values stay __UNK__ and are kept as vocab_pending in the lineage until
+#    the next full retrain
+#  - --mode boost: at most --rounds more trees at --learning_rate (init_model /
+#    xgb_model); --mode refit: tree structure kept, leaf values refreshed on
+#    the refresh data (LightGBM refit with --decay_rate, XGBoost refresh updater)
+#  - Lineage (parent model hash / MLflow run, data window, rounds, vocab
+#    additions, history) written next to the model and logged to MLflow
+# =============================================================
+
+#!/usr/bin/env python3
+import os, argparse, hashlib, importlib, json, time
+from datetime import date, timedelta
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import mlflow
+
+from data_source import DataSource, add_source_args, source_from_args
+from arrow_ingest import read_arrow, to_frame
+from encoding import CategoryEncoder
+from perf import span, tracer
+
+MODELS = {
+    "xgb": dict(module="xgboost_train", experiment="peri-price-xgb-cat",
+                model="models/xgb_cat.json", vocab="models/xgb_cat_vocab.json",
+                model_out="models/xgb_cat_inc.json", vocab_out="models/xgb_cat_inc_vocab.json"),
+    "lgb": dict(module="lightgbm_train_cat", experiment="peri-price-lgbm-cat",
+                model="models/lgbm_cat.txt", vocab="models/lgbm_cat_vocab.json",
+                model_out="models/lgbm_cat_inc.txt", vocab_out="models/lgbm_cat_inc_vocab.json"),
+}
+OPEN_END = "9999-12-31"
+
+
+def lineage_path(model_path: str) -> str:
+    return os.path.splitext(model_path)[0] + "_lineage.json"
+
+
+def file_sha1(path: str) -> str:
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()[:16]
+
+
+def load_lineage(model_path: str) -> Optional[Dict]:
+    path = lineage_path(model_path)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def load_window(source: DataSource, mod, lo: str, hi: str, chunk_rows: int) -> pa.Table:
+    """FEATURES + label + date of every split between lo and hi, cast to the trainer's DTYPES."""
+    return read_arrow(source, mod.SPLIT_TABLE, mod.FEATURES + [mod.LABEL, "date"],
+                      dict(mod.DTYPES, **{mod.LABEL: np.float32}), chunk_rows, date_range=(lo, hi))
+
+
+def split_holdout(table: pa.Table, holdout_days: int) -> Tuple[pa.Table, Optional[pa.Table], date]:
+    """(refresh rows, rows of the last `holdout_days` days or None, last day)."""
+    last = pc.max(table.column("date")).as_py()
+    if not holdout_days:
+        return table, None, last
+    cutoff = pa.scalar(last - timedelta(days=holdout_days - 1), type=table.schema.field("date").type)
+    held = pc.greater_equal(table.column("date"), cutoff)
+    return table.filter(pc.invert(held)), table.filter(held), last
+
+
+def encode(table: pa.Table, mod, encoder: CategoryEncoder) -> Tuple[pd.DataFrame, np.ndarray]:
+    y = table.column(mod.LABEL).to_numpy()
+    return to_frame(encoder.encode_arrow(table.select(mod.FEATURES), mod.CAT_COLS)), y
+
+
+def rmse(y: np.ndarray, yhat: np.ndarray) -> float:
+    return float(np.sqrt(np.mean((y - yhat) ** 2)))
+
+
+def refresh_xgb(mod, parent_path: str, params: Dict, args, X, y, Xh, yh):
+    """(refreshed booster, parent booster) - boost: up to --rounds more trees; refit: leaves refreshed."""
+    import xgboost as xgb
+    parent = xgb.Booster(model_file=parent_path)
+    dtrain = xgb.DMatrix(X, label=y, enable_categorical=True)
+    evals = [(xgb.DMatrix(Xh, label=yh, enable_categorical=True), "holdout")] if Xh is not None else []
+    if args.mode == "boost":
+        booster = xgb.train(dict(params, learning_rate=args.learning_rate), dtrain, num_boost_round=args.rounds,
+                            evals=evals, early_stopping_rounds=args.early_stopping if evals else None,
+                            verbose_eval=25, xgb_model=parent_path)
+        if evals:
+            booster = booster[: booster.best_iteration + 1]
+    else:
+        # The refresh updater replaces tree_method; each round revisits one parent tree
+        refit = {k: v for k, v in params.items() if k != "tree_method"}
+        booster = xgb.train(dict(refit, process_type="update", updater="refresh", refresh_leaf=True), dtrain,
+                            num_boost_round=parent.num_boosted_rounds(), xgb_model=parent_path)
+    return booster, parent
+
+
+def refresh_lgb(mod, parent_path: str, params: Dict, args, X, y, Xh, yh):
+    import lightgbm as lgb
+    parent = lgb.Booster(model_file=parent_path)
+    if args.mode == "refit":
+        # New leaf value = decay_rate * old + (1 - decay_rate) * fitted on the refresh data
+        return parent.refit(X, y, decay_rate=args.decay_rate), parent
+    params = dict(params, learning_rate=args.learning_rate)
+    dtrain = lgb.Dataset(X, label=y, categorical_feature=mod.CAT_COLS, params=params)
+    valid_sets, callbacks = [], [lgb.log_evaluation(period=25)]
+    if Xh is not None:
+        valid_sets = [lgb.Dataset(Xh, label=yh, categorical_feature=mod.CAT_COLS, params=params, reference=dtrain)]
+        callbacks.append(lgb.early_stopping(stopping_rounds=args.early_stopping))
+    booster = lgb.train(params, dtrain, num_boost_round=args.rounds, init_model=parent,
+                        valid_sets=valid_sets, valid_names=["holdout"] * len(valid_sets), callbacks=callbacks)
+    return booster, parent
+
+
+def n_trees(model: str, booster) -> int:
+    return booster.num_boosted_rounds() if model == "xgb" else booster.current_iteration()
+
+
+def predict(model: str, booster, X: pd.DataFrame) -> np.ndarray:
+    if model == "xgb":
+        import xgboost as xgb
+        return booster.predict(xgb.DMatrix(X, enable_categorical=True))
+    return booster.predict(X)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Warm-start refresh of a trained model on newly arrived days")
+    ap.add_argument("--project", default=os.getenv("PROJECT"))
+    ap.add_argument("--mlflow_server", required=True)
+    ap.add_argument("--model", choices=list(MODELS), default="xgb")
+    ap.add_argument("--experiment", default=None, help="MLflow experiment (default: the trainer's)")
+    ap.add_argument("--init_model", default=None, help="Parent model (default: the trainer's --model_out)")
+    ap.add_argument("--cat_vocab_in", default=None, help="Parent vocab (default: the trainer's --cat_vocab_out)")
+    ap.add_argument("--model_out", default=None, help="Refreshed model (may be --init_model to refresh in place)")
+    ap.add_argument("--cat_vocab_out", default=None)
+    ap.add_argument("--parent_run_id", default=None,
+                    help="MLflow run of the parent (default: the run recorded in its lineage, if any)")
+    ap.add_argument("--new_from", default=None,
+                    help="First new day (default: the day after the parent lineage's data_through)")
+    ap.add_argument("--new_to", default=None, help="Last new day (default: latest available)")
+    ap.add_argument("--context_days", type=int, default=28, help="Days before --new_from also refreshed on")
+    ap.add_argument("--holdout_days", type=int, default=1,
+                    help="Last new days held out for early stopping / parent vs refreshed metrics (0 = none)")
+    ap.add_argument("--mode", choices=["boost","refit"], default="boost",
+                    help="boost: add trees; refit: keep the trees, refresh leaf values")
+    ap.add_argument("--rounds", type=int, default=100, help="Max trees added (--mode boost)")
+    ap.add_argument("--learning_rate", type=float, default=0.05, help="Learning rate of the added trees")
+    ap.add_argument("--early_stopping", type=int, default=20, help="Rounds without holdout improvement")
+    ap.add_argument("--decay_rate", type=float, default=0.9, help="LightGBM refit: weight of the old leaf values")
+    ap.add_argument("--params_json", default=None,
+                    help="Search results JSON (hparam_search.py); its best_params override PARAMS")
+    ap.add_argument("--chunk_rows", type=int, default=1_000_000)
+    add_source_args(ap)
+    args = ap.parse_args()
+
+    spec = MODELS[args.model]
+    mod = importlib.import_module(spec["module"])
+    init_model = args.init_model or spec["model"]
+    vocab_in = args.cat_vocab_in or spec["vocab"]
+    model_out = args.model_out or spec["model_out"]
+    vocab_out = args.cat_vocab_out or spec["vocab_out"]
+    for p in [model_out, vocab_out]:
+        os.makedirs(os.path.dirname(p) or ".", exist_ok=True)
+
+    parent_lineage = load_lineage(init_model)
+    parent_sha1 = file_sha1(init_model)  # before a refresh in place overwrites it
+    if args.new_from:
+        new_from = args.new_from
+    elif parent_lineage:
+        new_from = (date.fromisoformat(parent_lineage["data_through"]) + timedelta(days=1)).isoformat()
+    else:
+        raise SystemExit(f"{init_model} has no lineage file; pass --new_from (first day after its training data)")
+    lo = (date.fromisoformat(new_from) - timedelta(days=args.context_days)).isoformat()
+    hi = args.new_to or OPEN_END
+
+    params = dict(mod.PARAMS)
+    if args.params_json:
+        with open(args.params_json) as f:
+            params.update(json.load(f)["best_params"])
+    source = source_from_args(args)
+    t0 = time.time()
+
+    # 1) Refresh window: context days + new days; nothing new -> nothing to do
+    table = load_window(source, mod, lo, hi, args.chunk_rows)
+    new_rows = 0
+    if table.num_rows:
+        first = pa.scalar(date.fromisoformat(new_from), type=table.schema.field("date").type)
+        new_rows = int(pc.sum(pc.greater_equal(table.column("date"), first)).as_py() or 0)
+    if not new_rows:
+        print(f"[incremental] no rows on or after {new_from}; {init_model} is up to date")
+        return
+    refresh, holdout, last = split_holdout(table, args.holdout_days)
+    if holdout is not None and holdout.num_rows >= new_rows:
+        raise SystemExit("--holdout_days covers every new day; lower it or wait for more days")
+    print(f"[incremental] {args.model} {args.mode}: new days {new_from}..{last} ({new_rows:,} rows) "
+          f"+ {args.context_days} context days; holdout {args.holdout_days} day(s)")
+
+    # 2) Vocab: appended (LightGBM) or frozen with the new values pending (XGBoost)
+    parent_enc = CategoryEncoder.load(vocab_in)
+    seen = parent_enc.extend(table)
+    added = {c: v for c, v in parent_enc.added(seen).items() if v}
+    encoder = seen if args.model == "lgb" else parent_enc
+    pending = {}
+    if args.model == "xgb":
+        pending = {c: list(dict.fromkeys((parent_lineage or {}).get("vocab_pending", {}).get(c, []) + v))
+                   for c, v in added.items()}
+    for c, v in added.items():
+        print(f"[incremental] {c}: {len(v)} new value(s) {'appended' if args.model == 'lgb' else 'kept as __UNK__'}")
+    with span("encode", rows=table.num_rows):
+        X, y = encode(refresh, mod, encoder)
+        Xh, yh = encode(holdout, mod, encoder) if holdout is not None else (None, None)
+    del table, refresh, holdout
+
+    parent_run_id = args.parent_run_id or (parent_lineage or {}).get("run_id")
+    mlflow.set_tracking_uri(f"http://{args.mlflow_server}:5000")
+    mlflow.set_experiment(args.experiment or spec["experiment"])
+    with mlflow.start_run(run_name=f"{args.model}_cat_incremental_{args.mode}") as run:
+        if parent_run_id:
+            mlflow.set_tag("parent_run_id", parent_run_id)
+        mlflow.set_tags({"parent_model_sha1": parent_sha1, "data_through": last.isoformat()})
+        mlflow.log_params(dict(mode=args.mode, init_model=init_model, new_from=new_from, new_to=last.isoformat(),
+                               context_days=args.context_days, holdout_days=args.holdout_days,
+                               rounds=args.rounds, learning_rate=args.learning_rate, decay_rate=args.decay_rate))
+
+        # 3) Continue boosting / refresh leaves from the parent
+        with span("train", rows=len(y)):
+            train = refresh_xgb if args.model == "xgb" else refresh_lgb
+            booster, parent = train(mod, init_model, params, args, X, y, Xh, yh)
+        rounds_added = n_trees(args.model, booster) - n_trees(args.model, parent)
+        metrics = {"refresh_rows": len(y), "new_rows": new_rows, "rounds_added": rounds_added,
+                   "total_rounds": n_trees(args.model, booster), "refresh_seconds": time.time() - t0}
+        metrics.update({f"vocab_added_{c}": len(v) for c, v in added.items()})
+        if Xh is not None:
+            with span("predict", rows=2 * len(yh)):
+                metrics["parent_holdout_rmse"] = rmse(yh, predict(args.model, parent, Xh))
+                metrics["holdout_rmse"] = rmse(yh, predict(args.model, booster, Xh))
+        mlflow.log_metrics(metrics)
+
+        # 4) Model + vocab + lineage
+        with span("write"):
+            booster.save_model(model_out)
+            encoder.save(vocab_out)
+        lineage = dict(model=args.model, model_path=model_out, sha1=file_sha1(model_out),
+                       run_id=run.info.run_id if run else None, mode=args.mode,
+                       window=[lo, last.isoformat()], new_from=new_from, data_through=last.isoformat(),
+                       vocab_path=vocab_out, vocab_added=added, vocab_pending=pending, metrics=metrics,
+                       parent=dict(model_path=init_model, sha1=parent_sha1, run_id=parent_run_id,
+                                   data_through=(parent_lineage or {}).get("data_through")),
+                       history=((parent_lineage or {}).get("history", [])
+                                + ([{k: v for k, v in parent_lineage.items() if k != "history"}]
+                                   if parent_lineage else [])))
+        with open(lineage_path(model_out), "w") as f:
+            json.dump(lineage, f, indent=2, default=str)
+        for p in [model_out, vocab_out, lineage_path(model_out)]:
+            mlflow.log_artifact(p)
+        perf_path = os.path.splitext(model_out)[0] + "_perf.json"
+        tracer.write_json(perf_path, script=os.path.basename(__file__), metrics=metrics)
+        mlflow.log_metrics(tracer.metrics())
+        mlflow.log_artifact(perf_path)
+
+    print("Refresh:", metrics)
+    print(f"[incremental] {model_out} (+{rounds_added} rounds, data through {last}) lineage -> "
+          f"{lineage_path(model_out)}")
+
+
+if __name__ == "__main__":
+    main()
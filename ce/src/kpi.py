@@ -0,0 +1,164 @@
+# =============================================================
+# file: ce/src/kpi.py
+# Purpose: Policy KPIs accumulated while the sweep runs
+#  - Same numbers as ml/bqml/policy_kpis.sql (overall, by date, by expiry
+#    bucket, discount distribution) without rescanning *_policy_eval_test or
+#    joining scoring_frame_test: each day / shard result is folded in next to
+#    the time_to_expiry of its rows
+#  - State is sums / counts per key plus co-moments for CORR(discount, expiry),
+#    all mergeable: forked workers ship a snapshot() with each task and the
+#    parent merge()s it (same pattern as perf.tracer)
+#  - write_json: small KPI artifact read by viz_kpis.py --kpi_json
+# =============================================================
+
+import os, json
+from typing import Dict, Iterable
+
+import numpy as np
+import pandas as pd
+
+# Per-key sums: [n_rows, baseline_rev, policy_rev, baseline_discount, policy_discount]
+SUM_COLS = ["n_rows","baseline_rev","policy_rev","baseline_discount","policy_discount"]
+
+
+EXPIRY_BUCKETS = np.array(["0-1d", "2-3d", "4-5d", "6d+"])
+
+
+def expiry_bucket_code(tte) -> np.ndarray:
+    """Index into EXPIRY_BUCKETS (ml/bqml/policy_kpis.sql buckets)."""
+    return np.searchsorted([1, 3, 5], np.asarray(tte, dtype=np.float64), side="left")
+
+
+def expiry_bucket(tte) -> np.ndarray:
+    return EXPIRY_BUCKETS[expiry_bucket_code(tte)]
+
+
+def _group_sums(codes: np.ndarray, labels, values: np.ndarray) -> Dict[str, np.ndarray]:
+    """Column sums of `values` per code; keys are the labels of the codes present."""
+    size = len(labels)
+    sums = np.column_stack([np.bincount(codes, weights=v, minlength=size) for v in values.T])
+    return {str(labels[i]): sums[i] for i in np.flatnonzero(sums[:, 0])}
+
+
+class KpiAccumulator:
+    """Mergeable online KPIs over sweep result rows."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.groups: Dict[str, Dict[str, np.ndarray]] = {"by_date": {}, "by_expiry": {}, "by_discount": {}}
+        # Co-moments of (policy_discount_pct, time_to_expiry)
+        self.n, self.mean_x, self.mean_y, self.m_xx, self.m_yy, self.m_xy = 0, 0.0, 0.0, 0.0, 0.0, 0.0
+
+    def _add_groups(self, name: str, sums: Dict[str, np.ndarray]):
+        g = self.groups[name]
+        for k, v in sums.items():
+            g[k] = g[k] + v if k in g else np.asarray(v, dtype=np.float64).copy()
+
+    def _add_moments(self, n, mean_x, mean_y, m_xx, m_yy, m_xy):
+        if n == 0:
+            return
+        tot = self.n + n
+        dx, dy = mean_x - self.mean_x, mean_y - self.mean_y
+        w = self.n * n / tot
+        self.m_xx += m_xx + dx * dx * w
+        self.m_yy += m_yy + dy * dy * w
+        self.m_xy += m_xy + dx * dy * w
+        self.mean_x += dx * n / tot
+        self.mean_y += dy * n / tot
+        self.n = tot
+
+    def update(self, result: pd.DataFrame, time_to_expiry: Iterable):
+        """Fold in sweep rows (sweep_engine.OUT_COLS) and the time_to_expiry of the same rows."""
+        if result is None or result.empty:
+            return
+        tte = np.asarray(time_to_expiry, dtype=np.float64)
+        assert len(tte) == len(result), "time_to_expiry must align with the result rows"
+        pol_disc = result["policy_discount_pct"].to_numpy(dtype=np.float64)
+        values = np.column_stack([
+            np.ones(len(result)),
+            result["baseline_revenue"].to_numpy(dtype=np.float64),
+            result["policy_revenue"].to_numpy(dtype=np.float64),
+            result["baseline_discount_pct"].to_numpy(dtype=np.float64),
+            pol_disc,
+        ])
+        # Factorize first: only the distinct keys get formatted
+        codes, uniq = pd.factorize(result["date"])
+        self._add_groups("by_date", _group_sums(codes, pd.to_datetime(uniq).strftime("%Y-%m-%d"), values))
+        self._add_groups("by_expiry", _group_sums(expiry_bucket_code(tte), EXPIRY_BUCKETS, values))
+        # ROUND(policy_discount_pct, 1) bins
+        codes, uniq = pd.factorize(np.round(pol_disc, 1))
+        self._add_groups("by_discount", _group_sums(codes, [f"{b:.1f}" for b in uniq], values))
+
+        # CORR ignores rows where either side is NULL
+        ok = ~(np.isnan(pol_disc) | np.isnan(tte))
+        x, y = pol_disc[ok], tte[ok]
+        if len(x):
+            mx, my = x.mean(), y.mean()
+            self._add_moments(len(x), mx, my, ((x - mx) ** 2).sum(), ((y - my) ** 2).sum(),
+                              ((x - mx) * (y - my)).sum())
+
+    def snapshot(self) -> Dict:
+        """Plain-data state (picklable / JSON-able) for merge()."""
+        return {"groups": {name: {k: v.tolist() for k, v in g.items()} for name, g in self.groups.items()},
+                "moments": [self.n, self.mean_x, self.mean_y, self.m_xx, self.m_yy, self.m_xy]}
+
+    def merge(self, snap: Dict):
+        """Fold in a snapshot() from another process (e.g. a forked sweep worker)."""
+        for name, g in snap["groups"].items():
+            self._add_groups(name, {k: np.asarray(v, dtype=np.float64) for k, v in g.items()})
+        self._add_moments(*snap["moments"])
+
+    @staticmethod
+    def _frame(g: Dict[str, np.ndarray], key: str) -> pd.DataFrame:
+        df = pd.DataFrame([g[k] for k in sorted(g)], columns=SUM_COLS)
+        df.insert(0, key, sorted(g))
+        df["n_rows"] = df["n_rows"].astype(np.int64)
+        df["uplift_pct"] = (df["policy_rev"] - df["baseline_rev"]) / df["baseline_rev"].replace(0, np.nan)
+        df["avg_policy_discount"] = df["policy_discount"] / df["n_rows"]
+        return df.drop(columns=["baseline_discount", "policy_discount"])
+
+    def tables(self) -> Dict[str, pd.DataFrame]:
+        """The policy_kpis.sql tables: kpis (one row), by_date, by_expiry, by_discount."""
+        tot = np.sum(list(self.groups["by_date"].values()), axis=0) if self.groups["by_date"] else np.zeros(5)
+        n, base_rev, pol_rev, base_disc, pol_disc = tot
+        denom = np.sqrt(self.m_xx * self.m_yy)
+        kpis = pd.DataFrame([{
+            "n_rows": int(n),
+            "baseline_rev": base_rev,
+            "policy_rev": pol_rev,
+            "uplift_abs": pol_rev - base_rev,
+            "uplift_pct": (pol_rev - base_rev) / base_rev if base_rev else np.nan,
+            "avg_baseline_discount": base_disc / n if n else np.nan,
+            "avg_policy_discount": pol_disc / n if n else np.nan,
+            "corr_discount_vs_expiry": self.m_xy / denom if self.n > 1 and denom > 0 else np.nan,
+        }])
+        by_date = self._frame(self.groups["by_date"], "date")
+        by_date["date"] = pd.to_datetime(by_date["date"])
+        return {"kpis": kpis, "by_date": by_date,
+                "by_expiry": self._frame(self.groups["by_expiry"], "expiry_bucket"),
+                "by_discount": self._frame(self.groups["by_discount"], "discount_bin")}
+
+    def write_json(self, path: str, **extra):
+        """KPI artifact: the tables as records (+ the mergeable state) and any extra fields."""
+        rep = dict(extra)
+        for name, df in self.tables().items():
+            rep[name] = json.loads(df.to_json(orient="records", date_format="iso"))
+        rep["state"] = self.snapshot()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(rep, f, indent=2, default=str)
+        k = rep["kpis"][0]
+        uplift = "n/a" if k["uplift_pct"] is None else f"{k['uplift_pct']:+.2%}"
+        print(f"[kpi] rows={k['n_rows']:,} baseline={k['baseline_rev']:,.0f} policy={k['policy_rev']:,.0f} "
+              f"uplift={uplift} -> {path}")
+
+
+def load_kpis(path: str) -> Dict[str, pd.DataFrame]:
+    """KPI tables back from a write_json() artifact."""
+    with open(path) as f:
+        rep = json.load(f)
+    acc = KpiAccumulator()
+    acc.merge(rep["state"])
+    return acc.tables()
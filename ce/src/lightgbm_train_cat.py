@@ -6,22 +6,27 @@
 #  - Uses pandas 'category' dtype with fixed vocab + '__UNK__' for unseen values
 #  - Downcasts numerics to float32 / small ints for memory efficiency
 #  - Logs metrics/artifacts to MLflow
+#  - --stream: splits streamed in chunks into lgb.Dataset via lgb.Sequence
+#  - --dataset_cache: binned Datasets reused across runs (dataset_cache.py)
+#  - Per-stage perf spans -> MLflow metrics + <model_out>_perf.json
 # =============================================================
 
 #!/usr/bin/env python3
-import os, argparse, json
-from typing import Dict, List, Tuple
+import os, argparse, json, shutil, tempfile
+from typing import List, Tuple
 
 import numpy as np
 import pandas as pd
-from google.cloud import bigquery
 import lightgbm as lgb
 from sklearn.metrics import mean_absolute_error, mean_squared_error
 import mlflow
 
-TRACKING_SERVER_HOST = args.mlflow_server
-mlflow.set_tracking_uri(f"http://{TRACKING_SERVER_HOST}:5000")
-print(f"tracking URI: '{mlflow.get_tracking_uri()}'")
+from data_source import DataSource, add_source_args, source_from_args
+from train_stream import SpilledSplit, fit_vocab, frame_to_matrix, predict_chunks, save_split, spill_split
+from dataset_cache import add_cache_args, cache_from_args, code_hash
+from encoding import CategoryEncoder
+from arrow_ingest import load_encoded
+from perf import IterationClock, peak_rss_mb, span, tracer
 
 # ---------- Spec (identical to BQML/XGB) ----------
 FEATURES: List[str] = [
@@ -36,7 +41,8 @@ FEATURES: List[str] = [
     "family","class","store_nbr","cluster"
 ]
 LABEL = "unit_sales"
-BQ_TABLE = "{project}.dynamic_pricing_ml.features_split"
+SPLIT_TABLE = "features_split"
+SPLITS = ["train","valid","test"]
 
 CAT_COLS = ["family","class","store_nbr","cluster"]
 FLOAT_COLS = [
@@ -45,6 +51,29 @@ FLOAT_COLS = [
     "rm7_log_sales","rm28_log_sales"
 ]
 INT_COLS = ["time_to_expiry","promo_in_last_7d","dow","month","year"]
+# Target dtypes of the numeric FEATURES (pandas downcast, or Arrow cast at load with --ingest arrow)
+DTYPES = {**{c: np.float32 for c in FLOAT_COLS},
+          "time_to_expiry": np.int16, "promo_in_last_7d": np.int8, "dow": np.int8, "month": np.int8, "year": np.int16}
+
+PARAMS = dict(
+    objective="regression",
+    metric=["rmse","mae"],
+    learning_rate=0.08,
+    num_leaves=255,         
+    max_depth=-1,
+    max_bin=255,            
+    feature_fraction=0.8,
+    bagging_fraction=0.8,
+    bagging_freq=1,
+    min_data_in_leaf=64,
+    verbosity=-1,
+    force_row_wise=True     
+)
+NUM_BOOST_ROUND = 800
+# Params fixed into a binned lgb.Dataset (part of the dataset cache key)
+DATASET_PARAMS = ["max_bin","max_bin_by_feature","min_data_in_bin","bin_construct_sample_cnt","data_random_seed",
+                  "min_data_in_leaf","feature_pre_filter","use_missing","zero_as_missing","enable_bundle",
+                  "linear_tree"]
 
 
 def rmse(y, yhat) -> float:
@@ -52,155 +81,247 @@ def rmse(y, yhat) -> float:
     return float(np.sqrt(mean_squared_error(y, yhat)))
 
 
-def load_split(project: str, split: str, cols: List[str]) -> pd.DataFrame:
-    """Load one split from BigQuery with only needed columns."""
-    client = bigquery.Client(project=project)
-    table = BQ_TABLE.format(project=project)
-    sql = f"""
-    SELECT {', '.join(['date'] + cols + [LABEL, 'split'])}
-    FROM `{table}`
-    WHERE split = @split
-    """
-    job = client.query(
-        sql,
-        job_config=bigquery.QueryJobConfig(
-            query_parameters=[bigquery.ScalarQueryParameter("split","STRING",split)]
-        )
-    )
-    return job.result().to_dataframe(create_bqstorage_client=True)
-
-
-def cast_and_fit_vocab_train(df: pd.DataFrame) -> Tuple[pd.DataFrame, Dict[str, List[str]]]:
-    """Down-cast numerics; fit categorical vocabularies on TRAIN; set dtype=category."""
-    X = df[FEATURES].copy()
+def load_split(source: DataSource, split: str, cols: List[str]) -> pd.DataFrame:
+    """Load one split with only needed columns."""
+    with span("load") as sp:
+        df = source.read(SPLIT_TABLE, columns=["date"] + cols + [LABEL, "split"], split=split)
+        sp.rows = len(df)
+    return df
 
-    # Down-cast numerics
-    for c in FLOAT_COLS:
-        X[c] = X[c].astype(np.float32)
-    X["time_to_expiry"] = X["time_to_expiry"].astype(np.int16)
-    X["promo_in_last_7d"] = X["promo_in_last_7d"].astype(np.int8)
-    X["dow"] = X["dow"].astype(np.int8)
-    X["month"] = X["month"].astype(np.int8)
-    X["year"] = X["year"].astype(np.int16)
-
-    # Fit vocabularies from TRAIN
-    cat_vocab: Dict[str, List[str]] = {}
-    for c in CAT_COLS:
-        s = X[c].astype(str)
-        vocab = pd.Index(s.unique()).astype(str).tolist()
-        vocab_with_unk = vocab + ["__UNK__"]
-        X[c] = pd.Categorical(s, categories=vocab_with_unk)
-        cat_vocab[c] = vocab  # store without UNK
-    return X, cat_vocab
-
-
-def apply_vocab(df: pd.DataFrame, cat_vocab: Dict[str, List[str]]) -> pd.DataFrame:
-    """Apply TRAIN vocabularies to VAL/TEST; unseen -> '__UNK__'."""
+
+def downcast(df: pd.DataFrame) -> pd.DataFrame:
+    """FEATURES with numerics down-cast to float32 / small ints."""
     X = df[FEATURES].copy()
-    for c in FLOAT_COLS:
-        X[c] = X[c].astype(np.float32)
-    X["time_to_expiry"] = X["time_to_expiry"].astype(np.int16)
-    X["promo_in_last_7d"] = X["promo_in_last_7d"].astype(np.int8)
-    X["dow"] = X["dow"].astype(np.int8)
-    X["month"] = X["month"].astype(np.int8)
-    X["year"] = X["year"].astype(np.int16)
-
-    for c in CAT_COLS:
-        s = X[c].astype(str)
-        vocab = cat_vocab[c]
-        mask = ~s.isin(vocab)
-        if mask.any():
-            s.loc[mask] = "__UNK__"
-        X[c] = pd.Categorical(s, categories=(vocab + ["__UNK__"]))
+    for c, t in DTYPES.items():
+        X[c] = X[c].astype(t)
     return X
 
 
+def cast_and_fit_vocab_train(df: pd.DataFrame) -> Tuple[pd.DataFrame, CategoryEncoder]:
+    """Down-cast numerics; fit categorical vocabularies on TRAIN; set dtype=category."""
+    X = downcast(df)
+    encoder = CategoryEncoder.fit(X, CAT_COLS)
+    return encoder.encode(X), encoder
+
+
+def apply_vocab(df: pd.DataFrame, encoder: CategoryEncoder) -> pd.DataFrame:
+    """Apply TRAIN vocabularies to VAL/TEST; unseen -> '__UNK__'."""
+    return encoder.encode(downcast(df))
+
+
+class ChunkSequence(lgb.Sequence):
+    """Random access over one spilled chunk; LightGBM wants float64 batches."""
+    batch_size = 65536
+
+    def __init__(self, path: str):
+        self.X = np.load(path, mmap_mode="r")
+
+    def __getitem__(self, idx):
+        return np.asarray(self.X[idx], dtype=np.float64)
+
+    def __len__(self) -> int:
+        return len(self.X)
+
+
+def spilled_dataset(split: SpilledSplit, reference=None, params=None) -> lgb.Dataset:
+    return lgb.Dataset([ChunkSequence(p) for p in split.chunk_files], label=np.asarray(split.label),
+                       feature_name=split.feature_names, categorical_feature=CAT_COLS, reference=reference,
+                       params=params)
+
+
+def iteration_spans(rows: int) -> list:
+    """Callbacks recording every boosting round (update + eval) as a "train_iter" perf span."""
+    clock = IterationClock("train_iter", rows)
+    def start(env):
+        clock.start()
+    start.before_iteration = True
+    def stop(env):
+        clock.stop()
+    return [start, stop]
+
+
 def main():
     ap = argparse.ArgumentParser()
-    ap.add_argument("--project", required=True)
+    ap.add_argument("--project", default=os.getenv("PROJECT"))
     ap.add_argument("--mlflow_server", required=True)
     ap.add_argument("--model_out", default="models/lgbm_cat.txt")
     ap.add_argument("--cat_vocab_out", default="models/lgbm_cat_vocab.json")
     ap.add_argument("--experiment", default="peri-price-lgbm-cat")
+    ap.add_argument("--stream", action="store_true",
+                    help="Stream splits in chunks into lgb.Dataset instead of loading them into pandas")
+    ap.add_argument("--chunk_rows", type=int, default=1_000_000)
+    ap.add_argument("--spill_dir", default=None, help="Local dir for encoded chunks (default: temp dir, removed)")
+    ap.add_argument("--params_json", default=None,
+                    help="Search results JSON (hparam_search.py); its best_params override PARAMS")
+    ap.add_argument("--eval_only", action="store_true",
+                    help="Evaluate the saved --model_out on valid / test instead of training")
+    ap.add_argument("--ingest", choices=["arrow","pandas"], default="arrow",
+                    help="arrow: record batches cast to DTYPES / encoded at the source; pandas: read() + downcast")
+    add_cache_args(ap)
+    add_source_args(ap)
     args = ap.parse_args()
 
     os.makedirs(os.path.dirname(args.model_out), exist_ok=True)
     os.makedirs(os.path.dirname(args.cat_vocab_out), exist_ok=True)
 
+    TRACKING_SERVER_HOST = args.mlflow_server
+    mlflow.set_tracking_uri(f"http://{TRACKING_SERVER_HOST}:5000")
+    print(f"tracking URI: '{mlflow.get_tracking_uri()}'")
+
+    source = source_from_args(args)
     mlflow.set_experiment(args.experiment)
 
-    with mlflow.start_run(run_name="lgbm_cat_train"):
-        # 1) Load splits
-        df_tr = load_split(args.project, "train", FEATURES)
-        df_va = load_split(args.project, "valid", FEATURES)
-        df_te = load_split(args.project, "test",  FEATURES)
-
-        ytr = df_tr[LABEL].astype(np.float32).values
-        yva = df_va[LABEL].astype(np.float32).values
-        yte = df_te[LABEL].astype(np.float32).values
-
-        # 2) Cast + categories
-        Xtr, cat_vocab = cast_and_fit_vocab_train(df_tr)
-        Xva = apply_vocab(df_va, cat_vocab)
-        Xte = apply_vocab(df_te, cat_vocab)
-
-        # 3) LightGBM datasets 
-        dtrain = lgb.Dataset(Xtr, label=ytr, categorical_feature=CAT_COLS, free_raw_data=False)
-        dvalid = lgb.Dataset(Xva, label=yva, categorical_feature=CAT_COLS, free_raw_data=False)
-
-        # 4) Params (histogram boosting is default). Keep memory safe.
-        params = dict(
-            objective="regression",
-            metric=["rmse","mae"],
-            learning_rate=0.08,
-            num_leaves=255,         
-            max_depth=-1,
-            max_bin=255,            
-            feature_fraction=0.8,
-            bagging_fraction=0.8,
-            bagging_freq=1,
-            min_data_in_leaf=64,
-            verbosity=-1,
-            force_row_wise=True     
-        )
+    # Params (histogram boosting is default). Keep memory safe.
+    # Dataset-level ones (max_bin) must reach the Datasets before they are binned.
+    params = dict(PARAMS)
+    if args.params_json:
+        with open(args.params_json) as f:
+            params.update(json.load(f)["best_params"])
+
+    cache = cache_from_args(args)
+    key = cache.key(model="lgb", table=SPLIT_TABLE, features=FEATURES, label=LABEL,
+                    source={s: source.fingerprint(SPLIT_TABLE, FEATURES + [LABEL], s) for s in SPLITS},
+                    casts=dict(dtypes=DTYPES, category=CAT_COLS,
+                               code=code_hash(downcast, CategoryEncoder, frame_to_matrix)),
+                    binning={k: params[k] for k in DATASET_PARAMS if k in params}) if cache else None
+    entry = cache.get(key) if cache else None
+    build = spilled = None
+    spill_root = args.spill_dir or (tempfile.mkdtemp(prefix="lgbm_spill_") if args.stream and not cache else None)
+
+    with mlflow.start_run(run_name="lgbm_cat_eval" if args.eval_only else "lgbm_cat_train"):
+        if entry:
+            # 1-3) Cache hit: binned train / valid Datasets, valid / test memory-mapped for predictions
+            encoder = CategoryEncoder.load(os.path.join(entry, "vocab.json"))
+            spilled = {s: SpilledSplit(os.path.join(entry, s), FEATURES) for s in ["valid","test"]}
+            dtrain = lgb.Dataset(os.path.join(entry, "train.bin"), params=params)
+            dvalid = lgb.Dataset(os.path.join(entry, "valid.bin"), reference=dtrain, params=params)
+        elif args.stream:
+            # 1-3) Vocab pass on the categorical columns, then one streamed pass per split;
+            # the Dataset is binned from the chunk Sequences (peak RAM ~ one chunk + binned data)
+            build = cache.build(key) if cache else spill_root
+            encoder = CategoryEncoder(fit_vocab(source, SPLIT_TABLE, "train", CAT_COLS, args.chunk_rows))
+            spilled = {s: spill_split(source, SPLIT_TABLE, s, FEATURES, LABEL,
+                                      lambda df: apply_vocab(df, encoder),
+                                      os.path.join(build, s), args.chunk_rows)
+                       for s in SPLITS}
+            dtrain = spilled_dataset(spilled["train"], params=params)
+            dvalid = spilled_dataset(spilled["valid"], reference=dtrain, params=params)
+        else:
+            rss0 = peak_rss_mb()
+            if args.ingest == "arrow":
+                # 1-2) Arrow batches cast to DTYPES at load; vocab + categoricals encoded on the Arrow columns
+                X, y, encoder = load_encoded(source, SPLIT_TABLE, FEATURES, LABEL, DTYPES, CAT_COLS, SPLITS)
+                (Xtr, Xva, Xte), (ytr, yva, yte) = [X[s] for s in SPLITS], [y[s] for s in SPLITS]
+            else:
+                # 1) Load splits
+                df_tr = load_split(source, "train", FEATURES)
+                df_va = load_split(source, "valid", FEATURES)
+                df_te = load_split(source, "test",  FEATURES)
+
+                ytr = df_tr[LABEL].astype(np.float32).values
+                yva = df_va[LABEL].astype(np.float32).values
+                yte = df_te[LABEL].astype(np.float32).values
+
+                # 2) Cast + categories
+                with span("encode", rows=len(df_tr) + len(df_va) + len(df_te)):
+                    Xtr, encoder = cast_and_fit_vocab_train(df_tr)
+                    Xva = apply_vocab(df_va, encoder)
+                    Xte = apply_vocab(df_te, encoder)
+                del df_tr, df_va, df_te
+            print(f"[ingest] {args.ingest}: {len(Xtr) + len(Xva) + len(Xte):,} rows, "
+                  f"peak RSS {rss0:.0f} -> {peak_rss_mb():.0f} MB over load + encode")
+            mlflow.log_metric("ingest_peak_rss_mb", peak_rss_mb())
+
+            # 3) LightGBM datasets
+            dtrain = lgb.Dataset(Xtr, label=ytr, categorical_feature=CAT_COLS, params=params, free_raw_data=False)
+            dvalid = lgb.Dataset(Xva, label=yva, categorical_feature=CAT_COLS, params=params, reference=dtrain,
+                                 free_raw_data=False)
+            if cache:
+                build = cache.build(key)
+                for s, X, y in [("valid", Xva, yva), ("test", Xte, yte)]:
+                    save_split(X, y, FEATURES, os.path.join(build, s), args.chunk_rows)
+
+        if args.eval_only and encoder.vocab != CategoryEncoder.load(args.cat_vocab_out).vocab:
+            raise SystemExit(f"{args.cat_vocab_out} was not fitted on this data; retrain instead of --eval_only")
+
+        # 4) Params
         mlflow.log_params(params)
 
-        booster = lgb.train(
-            params,
-            dtrain,
-            num_boost_round=800,
-            valid_sets=[dtrain, dvalid],
-            valid_names=["train","valid"],
-            callbacks=[
-                lgb.early_stopping(stopping_rounds=100),
-                lgb.log_evaluation(period=100)
-            ]
-        )
+        # Binning happens lazily inside lgb.train; construct here so it gets its own span
+        with span("dataset") as sp:
+            dtrain.construct()
+            sp.rows = n_train = dtrain.num_data()
+
+        if cache and not entry:
+            # Binned train / valid as LightGBM binaries; the train chunks are not needed once binned
+            dvalid.construct()
+            dtrain.save_binary(os.path.join(build, "train.bin"))
+            dvalid.save_binary(os.path.join(build, "valid.bin"))
+            shutil.rmtree(os.path.join(build, "train"), ignore_errors=True)
+            encoder.save(os.path.join(build, "vocab.json"))
+            entry = cache.commit(key, build, model="lgb", rows=n_train + dvalid.num_data())
+            if spilled:
+                spilled = {s: SpilledSplit(os.path.join(entry, s), FEATURES) for s in ["valid","test"]}
+        if spilled:
+            yva, yte = spilled["valid"].label, spilled["test"].label
+
+        if args.eval_only:
+            booster = lgb.Booster(model_file=args.model_out)
+        else:
+            with span("train", rows=n_train):
+                booster = lgb.train(
+                    params,
+                    dtrain,
+                    num_boost_round=NUM_BOOST_ROUND,
+                    valid_sets=[dtrain, dvalid],
+                    valid_names=["train","valid"],
+                    callbacks=[
+                        lgb.early_stopping(stopping_rounds=100),
+                        lgb.log_evaluation(period=100),
+                        *iteration_spans(n_train)
+                    ]
+                )
 
         # 5) Eval
-        val_pred = booster.predict(Xva, num_iteration=booster.best_iteration)
-        test_pred = booster.predict(Xte, num_iteration=booster.best_iteration)
+        with span("predict", rows=len(yva) + len(yte)):
+            if spilled:
+                predict = lambda X: booster.predict(X, num_iteration=booster.best_iteration)
+                val_pred = predict_chunks(predict, spilled["valid"])
+                test_pred = predict_chunks(predict, spilled["test"])
+            else:
+                val_pred = booster.predict(Xva, num_iteration=booster.best_iteration)
+                test_pred = booster.predict(Xte, num_iteration=booster.best_iteration)
 
         metrics = {
             "valid_mae": float(mean_absolute_error(yva, val_pred)),
             "valid_rmse": rmse(yva, val_pred),
             "test_mae":  float(mean_absolute_error(yte, test_pred)),
             "test_rmse": rmse(yte, test_pred),
-            "best_iteration": int(booster.best_iteration or 0)
+            # A booster loaded from file (--eval_only) has best_iteration -1: the saved model is already cut at it
+            "best_iteration": int(booster.best_iteration if booster.best_iteration > 0 else booster.current_iteration())
         }
         for k,v in metrics.items():
             mlflow.log_metric(k, v)
 
         # 6) Save model + vocab
-        booster.save_model(args.model_out)
-        mlflow.log_artifact(args.model_out)
-
-        with open(args.cat_vocab_out, "w") as f:
-            json.dump(cat_vocab, f, indent=2)
-        mlflow.log_artifact(args.cat_vocab_out)
+        if not args.eval_only:
+            with span("write"):
+                booster.save_model(args.model_out)
+                encoder.save(args.cat_vocab_out)
+            mlflow.log_artifact(args.model_out)
+            mlflow.log_artifact(args.cat_vocab_out)
+
+        # 7) Per-stage time / rows/s / peak RSS
+        perf_path = os.path.splitext(args.model_out)[0] + ("_eval_perf.json" if args.eval_only else "_perf.json")
+        tracer.write_json(perf_path, script=os.path.basename(__file__), metrics=metrics)
+        mlflow.log_metrics(tracer.metrics())
+        mlflow.log_artifact(perf_path)
 
         print("Eval:", metrics)
 
+    if spill_root and not args.spill_dir:
+        shutil.rmtree(spill_root, ignore_errors=True)
+
 if __name__ == "__main__":
     main()
 
@@ -0,0 +1,135 @@
+# =============================================================
+# file: ce/src/markdown_dp.py
+# Purpose: Multi-day markdown policy over the remaining shelf life
+#  - Each (store, item) row plans discounts for its next
+#    min(time_to_expiry + 1, horizon) selling days instead of the one-day
+#    argmax; the day's policy is the first step of the best plan
+#  - Forward DP batched over rows: state = discount chosen the previous day,
+#    carrying the lag / rolling features its path implies (lag1 = that day's
+#    predicted log sales, rm7 / rm28 rolled forward); by default every
+#    previous-discount state is kept, `beam` < G keeps only the best ones
+#    (cheaper, but pruning on value-so-far drops plans that discount early)
+#  - One GridPredictor call per day ahead on (active rows x beam) feature rows
+#    with the G prices as candidates; rows drop out as their horizon ends
+#  - lag7/14/28 and promo_in_last_7d stay at their day-0 values; calendar
+#    columns and time_to_expiry advance with the day
+#  - horizon = 1 reproduces sweep_engine.sweep_day
+# =============================================================
+
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+from perf import span
+from sweep_engine import GridPredictor, OUT_COLS, candidate_prices
+
+LOG_SALES_CAP = 200  # int_sales.sql: LOG(LEAST(GREATEST(unit_sales, 0), 200) + 1)
+
+
+def log_sales(units: np.ndarray) -> np.ndarray:
+    return np.log(np.clip(units, 0, LOG_SALES_CAP) + 1).astype(np.float32)
+
+
+def roll_mean(mean: np.ndarray, x: np.ndarray, window: int) -> np.ndarray:
+    """Next day's rolling mean: x enters, an average day leaves (the day dropping out is unknown)."""
+    return np.where(np.isnan(mean), x, mean + (x - mean) / window).astype(np.float32)
+
+
+def plan_days(time_to_expiry: np.ndarray, horizon: int) -> np.ndarray:
+    """Selling days left including today (time_to_expiry = 0 is the last day), capped at horizon."""
+    tte = np.nan_to_num(np.asarray(time_to_expiry, dtype=np.float64), nan=0.0).astype(np.int64)
+    return np.minimum(np.maximum(tte, 0) + 1, max(1, int(horizon)))
+
+
+def calendar(days: np.ndarray) -> dict:
+    """dow (EXTRACT(DAYOFWEEK): 1 = Sunday) / month / year of datetime64[D] days."""
+    idx = pd.DatetimeIndex(days)
+    return {"dow": (days.astype(np.int64) + 4) % 7 + 1, "month": idx.month.to_numpy(), "year": idx.year.to_numpy()}
+
+
+def markdown_dp(X: pd.DataFrame,
+                base: pd.DataFrame,
+                discount_grid: List[float],
+                predict_grid: GridPredictor,
+                horizon: int = 7,
+                beam: int = 0) -> pd.DataFrame:
+    """Like sweep_engine.sweep_day, but the policy discount maximizes revenue over the plan horizon."""
+    n, G = len(base), len(discount_grid)
+    B = min(int(beam), G) if beam and beam > 0 else G
+    cand_price, cand_disc = candidate_prices(base["base_price"].to_numpy(), discount_grid)
+    bl_price = base["baseline_effective_price"].to_numpy(dtype=np.float32)
+    bl_disc = base["baseline_discount_pct"].to_numpy(dtype=np.float32)
+    H = plan_days(base["time_to_expiry"].to_numpy(), horizon)
+    tte0 = base["time_to_expiry"].to_numpy()
+    day0 = pd.to_datetime(base["date"]).to_numpy().astype("datetime64[D]")
+
+    # Day 0 is the one-day sweep's block (candidates + baseline)
+    with span("predict", rows=n * (G + 1)):
+        units = predict_grid(X, {
+            "effective_price": np.column_stack([cand_price, bl_price]),
+            "discount_pct": np.column_stack([cand_disc, bl_disc]),
+        })
+    cand_units, bl_units = units[:, :G], units[:, G]
+    rev0 = cand_price * cand_units
+
+    with span("dp", rows=n):
+        # Beam = best B discounts per row, best first (stable: ties keep the lower grid index, like argmax)
+        state0 = np.argsort(-rev0, axis=1, kind="stable")[:, :B]
+        value = np.take_along_axis(rev0, state0, axis=1)
+        lag1 = log_sales(np.take_along_axis(cand_units, state0, axis=1))
+        rm7 = roll_mean(base["rm7_log_sales"].to_numpy(dtype=np.float32)[:, None], lag1, 7)
+        rm28 = roll_mean(base["rm28_log_sales"].to_numpy(dtype=np.float32)[:, None], lag1, 28)
+    rows = np.arange(n)
+    steps = []  # per day ahead: (active rows, parent beam position of each kept state)
+
+    for t in range(1, int(H.max()) if n else 0):
+        with span("dp", rows=len(rows)):
+            keep = H[rows] > t
+            rows, value, lag1, rm7, rm28 = rows[keep], value[keep], lag1[keep], rm7[keep], rm28[keep]
+            m = len(rows)
+            # One feature row per (row, state): the path's lags, day t's calendar / expiry
+            rep = np.repeat(rows, B)
+            Xs = X.take(rep)
+            Xs.index = pd.RangeIndex(m * B)
+            cols = {"lag1_log_sales": lag1, "rm7_log_sales": rm7, "rm28_log_sales": rm28,
+                    "time_to_expiry": tte0[rep] - t, **calendar(day0[rep] + t)}
+            for c, v in cols.items():
+                if c in Xs:
+                    Xs[c] = np.asarray(v).reshape(-1).astype(Xs[c].dtype)
+        with span("predict", rows=m * B * G):
+            u = np.asarray(predict_grid(Xs, {
+                "effective_price": np.repeat(cand_price[rows], B, axis=0),
+                "discount_pct": np.repeat(cand_disc[rows], B, axis=0),
+            }), dtype=np.float32).reshape(m, B, G)
+        with span("dp", rows=m):
+            total = value[:, :, None] + cand_price[rows][:, None, :] * u       # (m, B prev, G today)
+            best_prev = total.argmax(axis=1)                                   # (m, G)
+            by_disc = np.take_along_axis(total, best_prev[:, None, :], axis=1)[:, 0, :]
+            state = np.argsort(-by_disc, axis=1, kind="stable")[:, :B]
+            parent = np.take_along_axis(best_prev, state, axis=1)
+            value = np.take_along_axis(by_disc, state, axis=1)
+            r = np.arange(m)[:, None]
+            lag1 = log_sales(u[r, parent, state])
+            rm7 = roll_mean(rm7[r, parent], lag1, 7)
+            rm28 = roll_mean(rm28[r, parent], lag1, 28)
+            steps.append((rows, parent))
+
+    with span("argmax", rows=n):
+        # Backtrack to each row's day-0 state; beams are sorted, so a plan ending at day t starts at position 0
+        pos = np.zeros(n, dtype=np.int64)
+        for t in range(len(steps), 0, -1):
+            srows, parent = steps[t - 1]
+            pos[srows[H[srows] - 1 == t]] = 0
+            pos[srows] = parent[np.arange(len(srows)), pos[srows]]
+        best = state0[np.arange(n), pos]
+        rows = np.arange(n)
+
+        out = base[["date","store_nbr","item_nbr","baseline_discount_pct","baseline_effective_price"]].reset_index(drop=True)
+        out["pred_units_baseline"] = bl_units
+        out["baseline_revenue"] = bl_price * bl_units
+        out["policy_discount_pct"] = cand_disc[rows, best]
+        out["policy_effective_price"] = cand_price[rows, best]
+        out["pred_units_policy"] = cand_units[rows, best]
+        out["policy_revenue"] = rev0[rows, best]
+        return out[OUT_COLS]
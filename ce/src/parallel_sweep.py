@@ -0,0 +1,203 @@
+# =============================================================
+# file: ce/src/parallel_sweep.py
+# Purpose: Run the daily policy sweep as (day, shard) tasks on a process pool
+#  - Model, vocab and predictor are built once in the parent and inherited
+#    copy-on-write by forked workers (nothing model-sized is pickled)
+#  - Each task reads only its shard and writes one Parquet part:
+#    parts_dir/date=YYYY-MM-DD/shard-003-of-008.parquet (tmp + rename)
+#  - Days are merged in (date, shard) order as soon as all their shards are
+#    done -> output identical to a serial run with the same --num_shards,
+#    and result store / BQ writes overlap with the remaining compute
+#  - Workers return their perf spans (and KPI accumulator / prediction cache
+#    entries, if given) with each task; the parent merges them
+#  - A worker that raises or dies (OOM kill) fails the run naming its
+#    (day, shard); the other workers are stopped and a rerun replaces the parts
+# =============================================================
+
+import os, glob, shutil, time, traceback
+import multiprocessing as mp
+from multiprocessing.connection import wait
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import pandas as pd
+
+from perf import span, tracer
+from kpi import KpiAccumulator
+from pred_cache import PredictionCache
+
+
+class SweepTask(NamedTuple):
+    date: str
+    shard_id: int
+    num_shards: int
+
+
+# (task) -> sweep rows of that (day, shard); set before the pool forks
+TaskFn = Callable[[SweepTask], pd.DataFrame]
+_JOB: Dict[str, object] = {}
+
+
+def plan_tasks(dates: List[str], num_shards: int) -> List[SweepTask]:
+    """All (day, shard) tasks in merge order."""
+    return [SweepTask(d, k, num_shards) for d in dates for k in range(num_shards)]
+
+
+def part_path(parts_dir: str, task: SweepTask) -> str:
+    width = len(str(task.num_shards))
+    name = f"shard-{task.shard_id:0{width}d}-of-{task.num_shards:0{width}d}.parquet"
+    return os.path.join(parts_dir, f"date={task.date}", name)
+
+
+def _run_task(task: SweepTask) -> Tuple[SweepTask, int, float, Dict, Optional[Dict], Optional[Dict]]:
+    t0 = time.time()
+    tracer.reset()  # drop stats inherited from the parent / earlier tasks of this worker
+    kpis, cache = _JOB.get("kpis"), _JOB.get("pred_cache")
+    for acc in (kpis, cache):
+        if acc is not None:
+            acc.reset()
+    df = _JOB["fn"](task)
+    path = part_path(_JOB["parts_dir"], task)
+    if df is not None and not df.empty:
+        with span("write_part", rows=len(df)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            df.to_parquet(tmp, index=False)
+            os.replace(tmp, path)
+    return (task, (0 if df is None else len(df)), time.time() - t0, tracer.snapshot(),
+            None if kpis is None else kpis.snapshot(), None if cache is None else cache.snapshot())
+
+
+def _worker(conn) -> None:
+    """Pool worker: run each task the parent sends, reply with its result (or traceback); None = stop."""
+    while True:
+        task = conn.recv()
+        if task is None:
+            return
+        try:
+            conn.send(("done", _run_task(task)))
+        except BaseException:
+            conn.send(("error", traceback.format_exc()))
+            return
+
+
+def _task_name(task: SweepTask) -> str:
+    return f"{task.date} shard {task.shard_id}/{task.num_shards}"
+
+
+def merge_day(parts_dir: str, tasks: List[SweepTask]) -> pd.DataFrame:
+    """Concatenate the part files of one day's tasks in shard order (missing = empty shard)."""
+    frames = [pd.read_parquet(p) for p in (part_path(parts_dir, t) for t in sorted(tasks))
+              if os.path.exists(p)]
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+
+def run_parallel(tasks: List[SweepTask],
+                 fn: TaskFn,
+                 parts_dir: str,
+                 workers: int,
+                 on_day: Callable[[str, pd.DataFrame], None],
+                 keep_parts: bool = False,
+                 kpis: Optional[KpiAccumulator] = None,
+                 pred_cache: Optional[PredictionCache] = None) -> int:
+    """Run `fn` over `tasks` on `workers` forked processes; call `on_day` per day in date order.
+    A task that raises, or a worker killed mid-task, fails the run and stops the other workers.
+
+    `kpis`: accumulator that `fn` updates; each worker's copy is reset per task and merged back here.
+    `pred_cache`: cache behind `fn`'s predictor; new entries and hit counters are merged back the same way.
+    """
+    by_day: Dict[str, List[SweepTask]] = {}
+    for t in tasks:
+        by_day.setdefault(t.date, []).append(t)
+    days = sorted(by_day)
+
+    # Stale parts (and tmp files of killed workers) from an earlier run would otherwise be merged as results
+    for d in days:
+        for p in glob.glob(os.path.join(parts_dir, f"date={d}", "shard-*.parquet*")):
+            os.remove(p)
+
+    _JOB.update(fn=fn, parts_dir=parts_dir, kpis=kpis, pred_cache=pred_cache)
+    pending = {d: len(ts) for d, ts in by_day.items()}
+    next_day, total = 0, 0
+    ctx = mp.get_context("fork")
+    procs, running = {}, {}  # parent pipe end -> worker process / task it is running
+    for _ in range(max(1, min(workers, len(tasks)))):
+        conn, child = ctx.Pipe()
+        procs[conn] = ctx.Process(target=_worker, args=(child,), daemon=True)
+        procs[conn].start()
+        child.close()
+    todo = iter(tasks)
+
+    def dispatch(conn) -> None:
+        task = next(todo, None)
+        if task is not None:
+            running[conn] = task
+        try:
+            conn.send(task)
+        except OSError:
+            pass  # worker already gone: its sentinel reports the task below
+
+    ok = False
+    try:
+        for conn in procs:
+            dispatch(conn)
+        while running:
+            # A worker killed mid-task (OOM -> -9) closes its pipe without a result
+            ready = wait(list(running) + [procs[c].sentinel for c in running])
+            for conn in [c for c in list(running) if c in ready or procs[c].sentinel in ready]:
+                task = running[conn]
+                try:
+                    kind, msg = conn.recv()
+                except EOFError:
+                    procs[conn].join()
+                    raise RuntimeError(f"sweep worker exited with code {procs[conn].exitcode} "
+                                       f"on {_task_name(task)}") from None
+                if kind == "error":
+                    raise RuntimeError(f"sweep task {_task_name(task)} failed:\n{msg}")
+                del running[conn]
+                dispatch(conn)
+                task, n, secs, stats, kpi_stats, cache_stats = msg
+                print(f"[{task.date} shard {task.shard_id}/{task.num_shards}] rows={n:,} ({secs:.1f}s)")
+                tracer.merge(stats)
+                if kpi_stats is not None:
+                    kpis.merge(kpi_stats)
+                if cache_stats is not None:
+                    pred_cache.merge(cache_stats)
+                total += n
+                pending[task.date] -= 1
+                # Emit every day whose shards are all done, strictly in date order
+                while next_day < len(days) and pending[days[next_day]] == 0:
+                    d = days[next_day]
+                    with span("merge_day") as sp:
+                        df = merge_day(parts_dir, by_day[d])
+                        sp.rows = len(df)
+                    if df.empty:
+                        print(f"[{d}] no rows")
+                    else:
+                        on_day(d, df)
+                    if not keep_parts:
+                        shutil.rmtree(os.path.join(parts_dir, f"date={d}"), ignore_errors=True)
+                    next_day += 1
+        ok = True
+    finally:
+        _JOB.clear()
+        for conn, p in procs.items():
+            if not ok and p.is_alive():
+                p.terminate()
+            p.join()
+            conn.close()
+        if not ok:
+            # Parts of unfinished days stay for inspection; the rerun deletes them (and these tmp files) first
+            for p in glob.glob(os.path.join(parts_dir, "date=*", "shard-*.parquet.*.tmp")):
+                os.remove(p)
+    if not keep_parts and os.path.isdir(parts_dir) and not os.listdir(parts_dir):
+        os.rmdir(parts_dir)
+    return total
+
+
+def default_parts_dir(out_path: str) -> str:
+    return os.path.splitext(out_path)[0] + "_parts"
+
+
+def resolve_workers(workers: Optional[int]) -> int:
+    """--workers 0 means one worker per CPU."""
+    return max(1, os.cpu_count() or 1) if not workers else workers
@@ -0,0 +1,205 @@
+# =============================================================
+# file: ce/src/perf.py
+# Purpose: Stage-level timing / memory spans for training runs and sweeps
+#  - span("load", rows=n): wall time, rows/s and peak-RSS growth of a stage,
+#    aggregated by name (count / total / max); thread-safe, so spans from the
+#    prefetch and writer threads land in the same tracer
+#  - Peak RSS comes from getrusage (process high-water mark): the delta says
+#    how far a stage pushed the peak, which is what sizes the VM
+#  - Reports: JSON run report (sweeps), MLflow metrics (training);
+#    forked sweep workers ship their stats back with each task result
+#  - SamplingProfiler: opt-in pure-Python stack sampler; writes folded stacks
+#    ("a;b;c 42" lines) for flamegraph.pl / speedscope / inferno
+# =============================================================
+
+import os, sys, json, time, threading, resource
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, Optional
+
+# ru_maxrss is KiB on Linux, bytes on macOS
+_RSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * _RSS_UNIT / 2**20
+
+
+class Span:
+    """Handle yielded by Tracer.span; set `.rows` when the row count is only known inside."""
+
+    def __init__(self, name: str, rows: Optional[int] = None):
+        self.name = name
+        self.rows = rows
+
+
+class Tracer:
+    """Aggregates spans by name: count, seconds (total / max), rows, peak-RSS delta (max)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, float]] = {}
+        self._t0 = time.time()
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+            self._t0 = time.time()
+
+    def add(self, name: str, seconds: float, rows: Optional[int] = None, rss_delta_mb: float = 0.0):
+        with self._lock:
+            st = self._stats.setdefault(name, dict(count=0, seconds=0.0, max_seconds=0.0, rows=0,
+                                                   peak_rss_delta_mb=0.0))
+            st["count"] += 1
+            st["seconds"] += seconds
+            st["max_seconds"] = max(st["max_seconds"], seconds)
+            st["rows"] += int(rows or 0)
+            st["peak_rss_delta_mb"] = max(st["peak_rss_delta_mb"], rss_delta_mb)
+
+    @contextmanager
+    def span(self, name: str, rows: Optional[int] = None) -> Iterator[Span]:
+        sp = Span(name, rows)
+        rss0, t0 = peak_rss_mb(), time.perf_counter()
+        try:
+            yield sp
+        finally:
+            self.add(name, time.perf_counter() - t0, sp.rows, peak_rss_mb() - rss0)
+
+    def merge(self, stats: Dict[str, Dict[str, float]]):
+        """Fold in a snapshot() from another process (e.g. a forked sweep worker)."""
+        with self._lock:
+            for name, other in stats.items():
+                st = self._stats.setdefault(name, dict(other, count=0, seconds=0.0, max_seconds=0.0,
+                                                       rows=0, peak_rss_delta_mb=0.0))
+                for k in ("count", "seconds", "rows"):
+                    st[k] += other[k]
+                for k in ("max_seconds", "peak_rss_delta_mb"):
+                    st[k] = max(st[k], other[k])
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            return {name: dict(st) for name, st in self._stats.items()}
+
+    def report(self) -> Dict[str, object]:
+        spans = self.snapshot()
+        for st in spans.values():
+            st["rows_per_s"] = st["rows"] / st["seconds"] if st["rows"] and st["seconds"] > 0 else None
+        return {"wall_s": time.time() - self._t0, "peak_rss_mb": peak_rss_mb(), "spans": spans}
+
+    def metrics(self, prefix: str = "perf") -> Dict[str, float]:
+        """Flat {prefix.stage.stat: value} for mlflow.log_metrics."""
+        rep = self.report()
+        out = {f"{prefix}.wall_s": rep["wall_s"], f"{prefix}.peak_rss_mb": rep["peak_rss_mb"]}
+        for name, st in rep["spans"].items():
+            for k in ("count", "seconds", "max_seconds", "rows_per_s", "peak_rss_delta_mb"):
+                if st[k] is not None:
+                    out[f"{prefix}.{name}.{k}"] = float(st[k])
+        return out
+
+    def write_json(self, path: str, **extra):
+        """Run report (spans + any extra fields such as args) as JSON; prints a one-line summary per stage."""
+        rep = dict(extra, **self.report())
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(rep, f, indent=2, default=str)
+        for name, st in rep["spans"].items():
+            rate = f" {st['rows_per_s']:,.0f} rows/s" if st["rows_per_s"] else ""
+            print(f"[perf] {name:<12} n={st['count']:<5} {st['seconds']:8.2f}s{rate} "
+                  f"peak+{st['peak_rss_delta_mb']:.0f}MB")
+        print(f"[perf] report -> {path}")
+
+
+# Process-wide tracer used by the scripts and the sweep engine
+tracer = Tracer()
+
+
+def span(name: str, rows: Optional[int] = None):
+    return tracer.span(name, rows)
+
+
+_END = object()
+
+
+def traced_iter(items: Iterable, name: str = "load") -> Iterator:
+    """Yield from `items`, recording one `name` span (rows = len(item)) per fetch (streamed chunks)."""
+    it = iter(items)
+    while True:
+        rss0, t0 = peak_rss_mb(), time.perf_counter()
+        item = next(it, _END)
+        if item is _END:
+            return
+        tracer.add(name, time.perf_counter() - t0, len(item), peak_rss_mb() - rss0)
+        yield item
+
+
+class IterationClock:
+    """One `name` span per start() / stop() pair; driven by the boosting-round callbacks."""
+
+    def __init__(self, name: str = "train_iter", rows: Optional[int] = None, trace: Tracer = tracer):
+        self.name, self.rows, self.trace = name, rows, trace
+        self._t0, self._rss0 = time.perf_counter(), peak_rss_mb()
+
+    def start(self):
+        self._t0, self._rss0 = time.perf_counter(), peak_rss_mb()
+
+    def stop(self):
+        self.trace.add(self.name, time.perf_counter() - self._t0, self.rows, peak_rss_mb() - self._rss0)
+
+
+class SamplingProfiler:
+    """Samples the Python stacks of all other threads every `interval_s` into folded-stack counts.
+
+    Time spent inside C extensions (xgboost / numpy) is attributed to the Python frame that called them.
+    """
+
+    def __init__(self, interval_s: float = 0.005):
+        self.interval_s = interval_s
+        self.counts: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _loop(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval_s):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self.counts[";".join([names.get(ident, str(ident))] + stack[::-1])] += 1
+
+    def start(self) -> "SamplingProfiler":
+        self._thread = threading.Thread(target=self._loop, name="perf-sampler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def write_folded(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            for stack, n in sorted(self.counts.items()):
+                f.write(f"{stack} {n}\n")
+
+
+@contextmanager
+def profiled(path: Optional[str], interval_s: float = 0.005):
+    """Sample stacks for the body and write folded stacks to `path`; no-op when path is None."""
+    if path is None:
+        yield None
+        return
+    prof = SamplingProfiler(interval_s).start()
+    try:
+        yield prof
+    finally:
+        prof.stop()
+        prof.write_folded(path)
+        print(f"[perf] {sum(prof.counts.values()):,} samples -> {path} "
+              f"(flamegraph.pl {path} > flame.svg, or open in speedscope)")
@@ -0,0 +1,160 @@
+# =============================================================
+# file: ce/src/pipeline.py
+# Purpose: Overlap day I/O with scoring in the sweeps
+#  - Prefetcher: loads days d+1..d+depth on a background thread, in order
+#  - BackgroundWriter: one thread appends CSV / loads BQ in submit order
+#  - run_pipeline: load -> score (caller's thread) -> write, with at most
+#    `max_inflight` days held in memory across all three stages
+#  - Any stage error stops the other stages and is re-raised in the caller
+# =============================================================
+
+import queue, threading
+from typing import Any, Callable, Iterable, Iterator, Optional, Tuple
+
+_DONE = object()
+_POLL_S = 0.2
+
+
+class _Failed:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+class Prefetcher:
+    """Iterate (key, load(key)) in key order while a thread loads up to `depth` keys ahead."""
+
+    def __init__(self,
+                 keys: Iterable[Any],
+                 load: Callable[[Any], Any],
+                 depth: int = 2,
+                 slots: Optional[threading.Semaphore] = None):
+        self._keys = list(keys)
+        self._load = load
+        self._slots = slots
+        self._q: "queue.Queue" = queue.Queue(maxsize=max(1, depth))
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name="sweep-prefetch", daemon=True)
+        self._thread.start()
+
+    def _put(self, item) -> bool:
+        while not self._stop.is_set():
+            try:
+                self._q.put(item, timeout=_POLL_S)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _loop(self):
+        for key in self._keys:
+            # A slot is held from load until the day is written (or dropped)
+            while self._slots is not None and not self._slots.acquire(timeout=_POLL_S):
+                if self._stop.is_set():
+                    return
+            if self._stop.is_set():
+                return
+            try:
+                item = (key, self._load(key))
+            except BaseException as e:
+                self._put(_Failed(e))
+                return
+            if not self._put(item):
+                return
+        self._put(_DONE)
+
+    def __iter__(self) -> Iterator[Tuple[Any, Any]]:
+        while True:
+            item = self._q.get()
+            if item is _DONE:
+                return
+            if isinstance(item, _Failed):
+                raise item.error
+            yield item
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class BackgroundWriter:
+    """Runs write(key, value) on one thread in submit order; a failure resurfaces on submit()/close()."""
+
+    def __init__(self,
+                 write: Callable[[Any, Any], None],
+                 max_pending: int = 2,
+                 on_done: Optional[Callable[[Any], None]] = None):
+        self._write = write
+        self._on_done = on_done
+        self._q: "queue.Queue" = queue.Queue(maxsize=max(1, max_pending))
+        self._error: Optional[BaseException] = None
+        # Started on first submit, so a process pool created meanwhile forks a single-threaded parent
+        self._thread: Optional[threading.Thread] = None
+
+    def _loop(self):
+        while True:
+            item = self._q.get()
+            if item is _DONE:
+                return
+            key, value = item
+            # After a failure keep draining (so producers never block) but write nothing
+            if self._error is None:
+                try:
+                    self._write(key, value)
+                except BaseException as e:
+                    self._error = e
+            if self._on_done is not None:
+                self._on_done(key)
+
+    def _raise(self):
+        if self._error is not None:
+            raise self._error
+
+    def submit(self, key, value):
+        self._raise()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="sweep-writer", daemon=True)
+            self._thread.start()
+        self._q.put((key, value))
+
+    def close(self, abort: bool = False):
+        """Wait for queued writes; re-raise a write error unless already unwinding from one."""
+        if self._thread is not None:
+            self._q.put(_DONE)
+            self._thread.join()
+        if not abort:
+            self._raise()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(abort=exc_type is not None)
+
+
+def run_pipeline(keys: Iterable[Any],
+                 load: Callable[[Any], Any],
+                 score: Callable[[Any, Any], Any],
+                 write: Callable[[Any, Any], None],
+                 prefetch: int = 2,
+                 max_inflight: int = 4) -> None:
+    """load(key) on a prefetch thread -> score(key, data) here -> write(key, out) on a writer thread.
+
+    score returning None skips the write. At most `max_inflight` keys are between
+    load start and write end at any time, which bounds memory to that many days.
+    """
+    slots = threading.Semaphore(max(1, max_inflight))
+    with BackgroundWriter(write, max_pending=max_inflight, on_done=lambda _: slots.release()) as writer:
+        with Prefetcher(keys, load, depth=prefetch, slots=slots) as days:
+            for key, data in days:
+                out = score(key, data)
+                del data
+                if out is None:
+                    slots.release()
+                else:
+                    writer.submit(key, out)
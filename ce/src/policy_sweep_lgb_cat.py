@@ -1,20 +1,38 @@
 
 # =============================================================
-# file: ce/src/policy_sweep_lgbm_cat.py
+# file: ce/src/policy_sweep_lgb_cat.py
 # Purpose: Mirror the BQML/XGB policy sweep using LightGBM model
 #  - Processes by day (and optional shards) for memory safety
-#  - Writes CSV and (optionally) BigQuery table: dynamic_pricing_ml.lgb_policy_eval_test
+#  - Writes the date-partitioned Parquet store (result_store.py):
+#    <out_dir>/lgb_policy_eval_test/date=YYYY-MM-DD/part-0.parquet, a rerun
+#    replaces the day; optional legacy CSV copy with --out_csv
+#  - --write_bq: partition-overwrite loads of the store files (bq_writer.py)
+#    into dynamic_pricing_ml.lgb_policy_eval_test
 # =============================================================
 
 #!/usr/bin/env python3
-import os, argparse, json
-from typing import Dict, List
+import os, argparse
+from typing import List, Optional
 import numpy as np
 import pandas as pd
 
-from google.cloud import bigquery
 import lightgbm as lgb
 
+from data_source import DataSource, add_source_args, source_from_args
+from arrow_ingest import read_arrow, to_frame
+from sweep_engine import GridPredictor, sweep_day, tiled_predictor
+from markdown_dp import markdown_dp
+from sharding import CANDIDATE_ROW_BYTES, auto_num_shards, shard_indices
+from parallel_sweep import SweepTask, default_parts_dir, plan_tasks, resolve_workers, run_parallel
+from pipeline import BackgroundWriter, run_pipeline
+from perf import profiled, span, tracer
+from result_store import ResultStore
+from bq_writer import BQPartitionWriter
+from kpi import KpiAccumulator
+from pred_cache import CachedPredictor, PredictionCache, model_fingerprint
+from encoding import CategoryEncoder
+from forest import PriceIncrementalPredictor, from_lightgbm, load_forest
+
 FEATURES: List[str] = [
     "effective_price","discount_pct","time_to_expiry","base_price",
     "lag1_log_sales","lag7_log_sales","lag14_log_sales","lag28_log_sales",
@@ -28,6 +46,19 @@ FLOAT_COLS = [
     "lag1_log_sales","lag7_log_sales","lag14_log_sales","lag28_log_sales",
     "rm7_log_sales","rm28_log_sales"
 ]
+SCORING_TABLE = "scoring_frame_test"
+SCORING_COLS = [
+    "date","store_nbr","item_nbr",
+    "base_price","time_to_expiry",
+    "lag1_log_sales","lag7_log_sales","lag14_log_sales","lag28_log_sales",
+    "rm7_log_sales","rm28_log_sales","promo_in_last_7d",
+    "dow","month","year",
+    "family","class","cluster",
+    "baseline_discount_pct","baseline_effective_price"
+]
+# Cast at load (--ingest arrow): model-only columns; prices / baselines / time_to_expiry keep their source dtypes
+SCORING_DTYPES = {**{c: np.float32 for c in FLOAT_COLS if c.startswith(("lag","rm"))},
+                  "promo_in_last_7d": np.int8, "dow": np.int8, "month": np.int8, "year": np.int16}
 
 
 def _cast_numeric(df: pd.DataFrame) -> pd.DataFrame:
@@ -44,178 +75,226 @@ def _cast_numeric(df: pd.DataFrame) -> pd.DataFrame:
     return X
 
 
-def _apply_categories(df: pd.DataFrame, cat_vocab: Dict[str, List[str]]) -> pd.DataFrame:
-    X = df.copy()
-    for c in CAT_COLS:
-        s = X[c].astype(str)
-        vocab = cat_vocab[c]
-        mask = ~s.isin(vocab)
-        if mask.any():
-            s.loc[mask] = "__UNK__"
-        X[c] = pd.Categorical(s, categories=(vocab + ["__UNK__"]))
-    return X
+def load_scoring_frame(source: DataSource, the_date: str, shard=None, ingest: str = "arrow") -> pd.DataFrame:
+    if ingest == "arrow":
+        # Feature dtypes fixed batch by batch at the source, strings as categoricals (no object columns)
+        return to_frame(read_arrow(source, SCORING_TABLE, SCORING_COLS, SCORING_DTYPES, date=the_date, shard=shard))
+    with span("load") as sp:
+        df = source.read(SCORING_TABLE, columns=SCORING_COLS, date=the_date, shard=shard)
+        sp.rows = len(df)
+    return df
 
 
-def load_scoring_frame(project: str, the_date: str) -> pd.DataFrame:
-    client = bigquery.Client(project=project)
-    table = f"{project}.dynamic_pricing_ml.scoring_frame_test"
-    sql = f"""
-    SELECT
-      date, store_nbr, item_nbr,
-      base_price, time_to_expiry,
-      lag1_log_sales, lag7_log_sales, lag14_log_sales, lag28_log_sales,
-      rm7_log_sales, rm28_log_sales, promo_in_last_7d,
-      dow, month, year,
-      family, class, cluster,
-      baseline_discount_pct, baseline_effective_price
-    FROM `{table}`
-    WHERE date = @d
-    """
-    job = client.query(
-        sql,
-        job_config=bigquery.QueryJobConfig(
-            query_parameters=[bigquery.ScalarQueryParameter("d","DATE", the_date)]
-        )
-    )
-    return job.result().to_dataframe(create_bqstorage_client=True)
-
-
-def predict_units(booster: lgb.Booster, X: pd.DataFrame) -> np.ndarray:
-    return booster.predict(X, num_iteration=booster.best_iteration)
+def predict_units(booster: lgb.Booster, X: pd.DataFrame, num_threads: int = 0) -> np.ndarray:
+    return booster.predict(X, num_iteration=booster.best_iteration, num_threads=num_threads)
 
 
 def day_sweep(booster: lgb.Booster,
-              cat_vocab: Dict[str, List[str]],
+              encoder: CategoryEncoder,
               base: pd.DataFrame,
               discount_grid: List[float],
-              num_shards: int = 1,
-              shard_id: int = 0) -> pd.DataFrame:
-    if num_shards > 1:
-        key_hash = (base["store_nbr"].astype(str) + "|" + base["item_nbr"].astype(str)).apply(hash).astype(np.int64)
-        base = base[(np.abs(key_hash) % num_shards) == shard_id]
-        if base.empty:
-            return pd.DataFrame()
-
-    # Baseline
-    base_infer = base.copy()
-    base_infer["effective_price"] = base_infer["baseline_effective_price"]
-    base_infer["discount_pct"]    = base_infer["baseline_discount_pct"]
-
-    base_feats = base_infer[FEATURES].copy()
-    base_feats = _cast_numeric(base_feats)
-    base_feats = _apply_categories(base_feats, cat_vocab)
-    base_pred = predict_units(booster, base_feats).astype(np.float32)
-
-    baseline = base[["date","store_nbr","item_nbr","baseline_discount_pct","baseline_effective_price"]].copy()
-    baseline["pred_units_baseline"] = base_pred
-    baseline["baseline_revenue"] = baseline["baseline_effective_price"].astype(np.float32) * baseline["pred_units_baseline"]
-
-    # Candidates
-    blocks = []
-    for g in discount_grid:
-        blk = base.copy()
-        blk["cand_discount_pct"] = np.float32(g)
-        blk["cand_effective_price"] = np.round(blk["base_price"].astype(np.float32) * (1.0 - g), 2)
-        blk["effective_price"] = blk["cand_effective_price"]
-        blk["discount_pct"]    = blk["cand_discount_pct"]
-        blocks.append(blk)
-    cand = pd.concat(blocks, ignore_index=True)
-
-    cand_feats = cand[FEATURES].copy()
-    cand_feats = _cast_numeric(cand_feats)
-    cand_feats = _apply_categories(cand_feats, cat_vocab)
-
-    cand["pred_units"] = predict_units(booster, cand_feats).astype(np.float32)
-    cand["exp_revenue"] = cand["cand_effective_price"].astype(np.float32) * cand["pred_units"]
-
-    idx = cand.groupby(["date","store_nbr","item_nbr"])['exp_revenue'].idxmax()
-    best = cand.loc[idx, [
-        "date","store_nbr","item_nbr",
-        "cand_discount_pct","cand_effective_price","pred_units","exp_revenue"
-    ]].rename(columns={
-        "cand_discount_pct": "policy_discount_pct",
-        "cand_effective_price": "policy_effective_price",
-        "pred_units": "pred_units_policy",
-        "exp_revenue": "policy_revenue"
-    })
-
-    out = baseline.merge(best, on=["date","store_nbr","item_nbr"], how="inner")
-    return out
-
-
-def delete_bq_partition(project: str, table_fq: str, the_date: str):
-    client = bigquery.Client(project=project)
-    sql = f"DELETE FROM `{table_fq}` WHERE date = @d"
-    client.query(
-        sql,
-        job_config=bigquery.QueryJobConfig(
-            query_parameters=[bigquery.ScalarQueryParameter("d","DATE", the_date)]
-        )
-    ).result()
-
-
-def write_bq(project: str, dataset: str, table: str, df: pd.DataFrame, mode="append"):
-    from pandas_gbq import to_gbq
-    fq = f"{project}.{dataset}.{table}"
-    to_gbq(df, fq, project_id=project, if_exists=("append" if mode=="append" else "replace"))
+              predict_grid: Optional[GridPredictor] = None,
+              horizon: int = 1,
+              beam: int = 0) -> pd.DataFrame:
+    if base.empty:
+        return pd.DataFrame()
+
+    # Encode the day once; the engine only varies effective_price / discount_pct
+    with span("encode", rows=len(base)):
+        feats = base.assign(effective_price=base["baseline_effective_price"],
+                            discount_pct=base["baseline_discount_pct"])[FEATURES]
+        feats = encoder.encode(_cast_numeric(feats))
+
+    if predict_grid is None:
+        predict_grid = tiled_predictor(lambda X: predict_units(booster, X))
+    if horizon > 1:
+        return markdown_dp(feats, base, discount_grid, predict_grid, horizon=horizon, beam=beam)
+    return sweep_day(feats, base, discount_grid, predict_grid)
 
 
 def main():
     ap = argparse.ArgumentParser()
-    ap.add_argument("--project", required=True)
+    ap.add_argument("--project", default=os.getenv("PROJECT"))
     ap.add_argument("--model_path", default="models/lgbm_cat.txt")
     ap.add_argument("--cat_vocab_path", default="models/lgbm_cat_vocab.json")
     ap.add_argument("--start_date", default="2017-08-01")
     ap.add_argument("--end_date",   default="2017-08-15")
     ap.add_argument("--discount_grid", default="0.0,0.1,0.2,0.3,0.4,0.5")
-    ap.add_argument("--num_shards", type=int, default=1)
-    ap.add_argument("--out_csv", default="outputs/lgbm_cat_policy_eval_test.csv")
+    ap.add_argument("--horizon", type=int, default=1,
+                    help="Days planned ahead within time_to_expiry (markdown_dp.py); 1 = one-day argmax")
+    ap.add_argument("--dp_beam", type=int, default=0,
+                    help="Previous-discount states kept per row by the DP (0 = all grid points)")
+    ap.add_argument("--num_shards", default="1", help="N shards (BQML FARM_FINGERPRINT slices) or 'auto'")
+    ap.add_argument("--mem_budget_mb", type=float, default=2048)
+    ap.add_argument("--out_dir", default="outputs",
+                    help="Parquet result store root: <out_dir>/<bq table name>/date=YYYY-MM-DD/part-0.parquet")
+    ap.add_argument("--out_csv", default=None, help="Also append the rows to this CSV (legacy output)")
+    ap.add_argument("--predictor", choices=["native", "compiled", "incremental"], default="native",
+                    help="native: one booster call on the tiled grid; compiled: NumPy array forest on the "
+                         "tiled grid (no DMatrix); incremental: price-only tree re-evaluation")
+    ap.add_argument("--forest_path", default=None,
+                    help="Compiled model dir from forest.py (mmapped; replaces --model_path / --cat_vocab_path)")
+    ap.add_argument("--pred_cache_entries", type=int, default=None,
+                    help="LRU prediction cache size in cells (default: 2,000,000 with --pred_cache_dir, else 0 = "
+                         "only the cells repeated within a row are skipped)")
+    ap.add_argument("--pred_cache_dir", default=None,
+                    help="Persist the cache per model here, so reruns / overlapping grids reuse predictions")
+    ap.add_argument("--workers", type=int, default=1,
+                    help="Run (day, shard) tasks on N forked processes (0 = one per CPU); 1 = serial")
+    ap.add_argument("--parts_dir", default=None,
+                    help="Per-task Parquet parts for --workers > 1 (default: <out_dir>/<table>_parts)")
+    ap.add_argument("--ingest", choices=["arrow","pandas"], default="arrow",
+                    help="arrow: record batches cast to SCORING_DTYPES at the source; pandas: read() as is")
+    ap.add_argument("--prefetch_days", type=int, default=2,
+                    help="Days loaded ahead of the scorer on a background thread")
+    ap.add_argument("--max_inflight_days", type=int, default=4,
+                    help="Max days held in memory across load / score / write")
+    ap.add_argument("--kpi_report", default=None,
+                    help="KPI artifact path (default: <out_dir>/<table>_kpis.json)")
+    ap.add_argument("--perf_report", default=None,
+                    help="JSON run report with per-stage time / rows/s / peak RSS "
+                         "(default: <out_dir>/<table>_perf.json)")
+    ap.add_argument("--profile_day", default=None,
+                    help="YYYY-MM-DD: sample stacks while scoring this day and write folded stacks (flamegraph)")
+    ap.add_argument("--profile_out", default=None, help="Folded-stacks path (default: <out_dir>/<table>_<day>.folded)")
     ap.add_argument("--write_bq", action="store_true")
+    ap.add_argument("--bq_batch_days", type=int, default=7,
+                    help="Days buffered per BigQuery flush (one partition-overwrite load job per day)")
     ap.add_argument("--bq_table", default="dynamic_pricing_ml.lgb_policy_eval_test")
+    add_source_args(ap)
     args = ap.parse_args()
+    assert args.project or not args.write_bq, "Missing --project (required for --write_bq)"
+
+    source = source_from_args(args)
 
     # Load model + vocab
-    booster = lgb.Booster(model_file=args.model_path)
-    with open(args.cat_vocab_path) as f:
-        cat_vocab = json.load(f)
+    if args.forest_path:
+        # Compiled model: mmapped node arrays, bundled vocab, no booster to deserialize
+        assert args.predictor != "native", "--forest_path needs --predictor compiled or incremental"
+        forest = load_forest(args.forest_path)
+        booster, encoder = None, forest.encoder
+    else:
+        booster = lgb.Booster(model_file=args.model_path)
+        encoder = CategoryEncoder.load(args.cat_vocab_path)
+        forest = from_lightgbm(booster, encoder.vocab) if args.predictor != "native" else None
+
+    workers = resolve_workers(args.workers)
+    if args.predictor == "incremental":
+        predict_grid = PriceIncrementalPredictor(forest)
+    elif args.predictor == "compiled":
+        predict_grid = tiled_predictor(forest.predict_frame)
+    elif workers > 1:
+        # Forked workers share this booster; one thread each keeps the box from oversubscribing
+        predict_grid = tiled_predictor(lambda X: predict_units(booster, X, num_threads=1))
+    else:
+        predict_grid = None
+
+    # Prediction cache (sweep_engine cells keyed by encoded features + price bits, per model file). Keys include
+    # the daily lag / calendar features, so the LRU only pays off on reruns: off unless persisted
+    entries = args.pred_cache_entries
+    if entries is None:
+        entries = 2_000_000 if args.pred_cache_dir else 0
+    pred_cache = PredictionCache(model_fingerprint(args.forest_path or args.model_path), entries, args.pred_cache_dir)
+    predict_grid = CachedPredictor(predict_grid or tiled_predictor(lambda X: predict_units(booster, X)), pred_cache)
 
     grid = [float(x) for x in args.discount_grid.split(",") if x.strip() != ""]
-    dates = pd.date_range(args.start_date, args.end_date, freq="D")
-
-    os.makedirs(os.path.dirname(args.out_csv), exist_ok=True)
-    wrote_header = not os.path.exists(args.out_csv)
-
-    for d in dates:
-        dstr = d.date().isoformat()
-        base = load_scoring_frame(args.project, dstr)
+    # The DP scores beam x G candidates per row and day ahead
+    beam = min(args.dp_beam, len(grid)) if args.dp_beam > 0 else len(grid)
+    cands_per_row = len(grid) * (beam if args.horizon > 1 else 1)
+    dates = [d.date().isoformat() for d in pd.date_range(args.start_date, args.end_date, freq="D")]
+
+    # Result store (rerunning a day replaces its partition) + optional legacy CSV
+    store = ResultStore(args.out_dir, args.bq_table.split(".", 1)[-1])
+    if args.out_csv:
+        os.makedirs(os.path.dirname(args.out_csv) or ".", exist_ok=True)
+    wrote_header = not (args.out_csv and os.path.exists(args.out_csv))
+    # Optional BigQuery copy: one client, partition-overwrite loads of the store files
+    bq = BQPartitionWriter(args.project, args.bq_table, args.bq_batch_days) if args.write_bq else None
+    # policy_kpis.sql numbers, accumulated per day / shard next to time_to_expiry
+    kpis = KpiAccumulator()
+
+    def emit_day(dstr: str, day_result: pd.DataFrame):
+        nonlocal wrote_header
+        with span("write", rows=len(day_result)):
+            part = store.write_day(dstr, day_result)
+            if args.out_csv:
+                day_result.to_csv(args.out_csv, mode=("w" if wrote_header else "a"),
+                                  header=wrote_header, index=False)
+                wrote_header = False
+
+            # Optional BigQuery write (idempotent per day, flushed in batches)
+            if bq is not None:
+                bq.write_day(dstr, part, rows=len(day_result))
+
+    stem = store.path
+    profile_out = args.profile_out or f"{stem}_{args.profile_day}.folded"
+
+    def sweep_task(task: SweepTask) -> pd.DataFrame:
+        profile = (None if task.date != args.profile_day else
+                   f"{os.path.splitext(profile_out)[0]}_shard{task.shard_id}.folded")
+        with profiled(profile):
+            base = load_scoring_frame(source, task.date, shard=(task.shard_id, task.num_shards),
+                                      ingest=args.ingest)
+            chunks = auto_num_shards(len(base), cands_per_row, CANDIDATE_ROW_BYTES, args.mem_budget_mb)
+            frames = [day_sweep(booster, encoder, base.iloc[idx], grid, predict_grid=predict_grid,
+                                horizon=args.horizon, beam=args.dp_beam)
+                      for idx in np.array_split(np.arange(len(base)), chunks)]
+        frames = [f for f in frames if not f.empty]
+        out = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+        with span("kpi", rows=len(out)):
+            kpis.update(out, base["time_to_expiry"])
+        return out
+
+    if workers > 1:
+        num_shards = workers if args.num_shards == "auto" else int(args.num_shards)
+        tasks = plan_tasks(dates, num_shards)
+        print(f"{len(tasks)} tasks ({len(dates)} days x {num_shards} shards) on {workers} workers")
+        with BackgroundWriter(emit_day, max_pending=args.max_inflight_days) as writer:
+            run_parallel(tasks, sweep_task, args.parts_dir or default_parts_dir(stem), workers,
+                         writer.submit, kpis=kpis, pred_cache=pred_cache)
+        if bq is not None:
+            with span("bq_flush"):
+                bq.close()
+        kpis.write_json(args.kpi_report or f"{stem}_kpis.json", script=os.path.basename(__file__),
+                        start_date=args.start_date, end_date=args.end_date, horizon=args.horizon)
+        pred_cache.save()
+        tracer.write_json(args.perf_report or f"{stem}_perf.json", script=os.path.basename(__file__),
+                          args=vars(args), workers=workers, num_shards=num_shards,
+                          pred_cache=pred_cache.report())
+        print(f"Done. Results at {store.path}")
+        return
+
+    def score_day(dstr: str, base: pd.DataFrame) -> Optional[pd.DataFrame]:
         if base.empty:
             print(f"[{dstr}] no rows")
-            continue
-
-        day_frames = []
-        for shard_id in range(args.num_shards):
-            df_out = day_sweep(booster, cat_vocab, base, grid, num_shards=args.num_shards, shard_id=shard_id)
-            if not df_out.empty:
-                day_frames.append(df_out)
-                print(f"[{dstr} shard {shard_id}/{args.num_shards}] rows={len(df_out):,}")
-
-        if not day_frames:
-            continue
-
-        day_result = pd.concat(day_frames, ignore_index=True)
-
-        # CSV append
-        day_result.to_csv(args.out_csv, mode=("w" if wrote_header else "a"), header=wrote_header, index=False)
-        wrote_header = False
-
-        # Optional BigQuery write (idempotent per day)
-        if args.write_bq:
-            ds, tbl = args.bq_table.split(".", 1)
-            delete_bq_partition(args.project, f"{args.project}.{ds}.{tbl}", dstr)
-            write_bq(args.project, ds, tbl, day_result, mode="append")
-            print(f"[{dstr}] wrote {len(day_result):,} rows to {args.project}.{args.bq_table}")
-
-    print(f"Done. CSV at {args.out_csv}")
+            return None
+
+        with profiled(profile_out if dstr == args.profile_day else None):
+            num_shards = (auto_num_shards(len(base), cands_per_row, CANDIDATE_ROW_BYTES, args.mem_budget_mb)
+                          if args.num_shards == "auto" else int(args.num_shards))
+            day_frames = []
+            for shard_id, idx in enumerate(shard_indices(base, num_shards)):
+                df_out = day_sweep(booster, encoder, base.iloc[idx], grid, predict_grid=predict_grid,
+                                   horizon=args.horizon, beam=args.dp_beam)
+                if not df_out.empty:
+                    with span("kpi", rows=len(df_out)):
+                        kpis.update(df_out, base["time_to_expiry"].iloc[idx])
+                    day_frames.append(df_out)
+                    print(f"[{dstr} shard {shard_id}/{num_shards}] rows={len(df_out):,}")
+            return pd.concat(day_frames, ignore_index=True) if day_frames else None
+
+    run_pipeline(dates, lambda dstr: load_scoring_frame(source, dstr, ingest=args.ingest), score_day, emit_day,
+                 prefetch=args.prefetch_days, max_inflight=args.max_inflight_days)
+    if bq is not None:
+        with span("bq_flush"):
+            bq.close()
+    kpis.write_json(args.kpi_report or f"{stem}_kpis.json", script=os.path.basename(__file__),
+                    start_date=args.start_date, end_date=args.end_date, horizon=args.horizon)
+    pred_cache.save()
+    tracer.write_json(args.perf_report or f"{stem}_perf.json", script=os.path.basename(__file__),
+                      args=vars(args), workers=workers, num_shards=args.num_shards,
+                      pred_cache=pred_cache.report())
+    print(f"Done. Results at {store.path}")
 
 if __name__ == "__main__":
     main()
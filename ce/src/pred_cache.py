@@ -0,0 +1,252 @@
+# =============================================================
+# file: ce/src/pred_cache.py
+# Purpose: Deduplicated, memoized grid predictions for the sweeps
+#  - Cell key = hash(encoded non-price features of the row) mixed with the
+#    float32 bits of the (already cent-rounded) price features: equal keys
+#    are byte-identical model inputs, so a reused prediction is exact
+#  - CachedPredictor wraps any GridPredictor (sweep_engine.py): cells of one
+#    block that repeat (the baseline column is almost always one of the grid
+#    discounts) are scored once, cached cells are not scored at all, and the
+#    rest go to the inner predictor grouped by misses per row (one call per
+#    distinct count, no padding)
+#  - With max_entries = 0 (the sweeps' default without --pred_cache_dir) only
+#    the in-row repeats are skipped, found by comparing prices (no hashing)
+#  - PredictionCache: one per model (model_fingerprint = hash of the model
+#    file / compiled dir); dict index over flat key / value / last-use arrays,
+#    LRU eviction in bulk past max_entries; optional <cache_dir>/<model>.npz
+#    so reruns and overlapping grids reuse earlier sweeps
+#  - Forked workers ship their new entries + counters with each task and the
+#    parent merge()s them (same pattern as kpi.py / perf.tracer)
+# =============================================================
+
+import os, hashlib
+from itertools import repeat
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from sweep_engine import GridPredictor
+
+STAT_KEYS = ["cells","dedup","hits","scored","evicted"]
+_M1, _M2 = np.uint64(0xBF58476D1CE4E5B9), np.uint64(0x94D049BB133111EB)
+
+
+def _mix(h: np.ndarray) -> np.ndarray:
+    """splitmix64 finalizer (uint64 in, uint64 out)."""
+    with np.errstate(over="ignore"):
+        h = (h ^ (h >> np.uint64(30))) * _M1
+        h = (h ^ (h >> np.uint64(27))) * _M2
+        return h ^ (h >> np.uint64(31))
+
+
+def cell_keys(X: pd.DataFrame, prices: Dict[str, np.ndarray]) -> np.ndarray:
+    """(n x k) uint64 keys: row hash of the non-price columns x float32 bits of each price column."""
+    rest = X.drop(columns=[c for c in prices if c in X])
+    key = pd.util.hash_pandas_object(rest, index=False).to_numpy(dtype=np.uint64)[:, None]
+    with np.errstate(over="ignore"):
+        for c in sorted(prices):
+            bits = np.ascontiguousarray(prices[c], dtype=np.float32).view(np.uint32).astype(np.uint64)
+            key = _mix(key ^ _mix(bits + np.uint64(0x9E3779B97F4A7C15)))
+    return key
+
+
+def model_fingerprint(path: str) -> str:
+    """Content hash of a model file, or of every file in a compiled model dir."""
+    h = hashlib.sha1()
+    paths = [path] if os.path.isfile(path) else sorted(
+        os.path.join(d, f) for d, _, fs in os.walk(path) for f in fs)
+    for p in paths:
+        h.update(os.path.relpath(p, path).encode())
+        with open(p, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+    return h.hexdigest()[:16]
+
+
+class PredictionCache:
+    """Bounded LRU map uint64 cell key -> predicted units, for one model."""
+
+    def __init__(self, model_id: str, max_entries: int = 2_000_000, cache_dir: Optional[str] = None):
+        self.model_id = model_id
+        self.max_entries = int(max_entries)
+        self.path = os.path.join(cache_dir, f"{model_id}.npz") if cache_dir else None
+        self.keys = np.zeros(0, dtype=np.uint64)
+        self.values = np.zeros(0, dtype=np.float32)
+        self.used = np.zeros(0, dtype=np.int64)  # last-use tick per slot, -1 = free
+        self.index: Dict[int, int] = {}
+        self.free: List[int] = []
+        self.tick = 0
+        self.stats = dict.fromkeys(STAT_KEYS, 0)
+        self._new: List[np.ndarray] = []  # slots written since reset(), shipped by snapshot()
+        if self.path and os.path.exists(self.path):
+            with np.load(self.path) as z:
+                self.insert(z["keys"], z["values"], track=False)
+            print(f"[pred_cache] loaded {len(self):,} entries for model {model_id} <- {self.path}")
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def lookup(self, keys: np.ndarray) -> np.ndarray:
+        """Slot per key (-1 = miss); hits count as a use."""
+        self.tick += 1
+        slots = np.fromiter(map(self.index.get, keys.tolist(), repeat(-1)), dtype=np.int64, count=len(keys))
+        self.used[slots[slots >= 0]] = self.tick
+        return slots
+
+    def insert(self, keys: np.ndarray, values: np.ndarray, track: bool = True):
+        """Upsert any keys (duplicates: first value wins)."""
+        keys, first = np.unique(np.asarray(keys, dtype=np.uint64), return_index=True)
+        values = np.asarray(values, dtype=np.float32)[first]
+        known = self.lookup(keys)
+        self.values[known[known >= 0]] = values[known >= 0]
+        self.add(keys[known < 0], values[known < 0], track)
+
+    def add(self, keys: np.ndarray, values: np.ndarray, track: bool = True):
+        """Store distinct keys known to be absent (the misses of a lookup())."""
+        if not len(keys) or self.max_entries <= 0:
+            return
+        if len(keys) > self.max_entries:
+            keys, values = keys[:self.max_entries], values[:self.max_entries]
+        self.tick += 1
+        self._evict(len(self) + len(keys) - self.max_entries)
+        slots = self._alloc(len(keys))
+        self.keys[slots], self.values[slots], self.used[slots] = keys, values, self.tick
+        self.index.update(zip(keys.tolist(), slots.tolist()))
+        if track:
+            self._new.append(slots)
+
+    def _alloc(self, n: int) -> np.ndarray:
+        take = min(n, len(self.free))
+        slots = [self.free.pop() for _ in range(take)]
+        grow = n - take
+        if grow:
+            start = len(self.keys)
+            self.keys = np.concatenate([self.keys, np.zeros(grow, dtype=np.uint64)])
+            self.values = np.concatenate([self.values, np.zeros(grow, dtype=np.float32)])
+            self.used = np.concatenate([self.used, np.full(grow, -1, dtype=np.int64)])
+            slots += range(start, start + grow)
+        return np.asarray(slots, dtype=np.int64)
+
+    def _evict(self, n: int):
+        """Drop the n least recently used entries."""
+        if n <= 0:
+            return
+        live = np.flatnonzero(self.used >= 0)
+        victims = live[np.argpartition(self.used[live], n - 1)[:n]] if n < len(live) else live
+        for k in self.keys[victims].tolist():
+            del self.index[k]
+        self.used[victims] = -1
+        self.free.extend(victims.tolist())
+        self.stats["evicted"] += len(victims)
+
+    def reset(self):
+        """Zero the counters and the new-entry log (entries stay)."""
+        self.stats = dict.fromkeys(STAT_KEYS, 0)
+        self._new = []
+
+    def snapshot(self) -> Dict:
+        """Counters + entries written since reset(), for merge() in another process."""
+        slots = np.unique(np.concatenate(self._new)) if self._new else np.zeros(0, dtype=np.int64)
+        slots = slots[self.used[slots] >= 0]
+        return {"stats": dict(self.stats), "keys": self.keys[slots], "values": self.values[slots]}
+
+    def merge(self, snap: Dict):
+        for k in STAT_KEYS:
+            self.stats[k] += snap["stats"][k]
+        self.insert(snap["keys"], snap["values"], track=False)
+
+    def save(self):
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        live = np.flatnonzero(self.used >= 0)
+        tmp = f"{self.path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp, keys=self.keys[live], values=self.values[live])
+        os.replace(tmp, self.path)
+
+    def summary(self) -> Dict[str, float]:
+        s = dict(self.stats, entries=len(self), model_id=self.model_id)
+        cells = s["cells"]
+        s["hit_rate"] = s["hits"] / cells if cells else 0.0
+        s["saved_rate"] = (s["hits"] + s["dedup"]) / cells if cells else 0.0
+        return s
+
+    def report(self) -> Dict[str, float]:
+        """summary(), printed as one line (cells scored vs served from the block / the cache)."""
+        s = self.summary()
+        print(f"[pred_cache] cells={s['cells']:,} scored={s['scored']:,} dedup={s['dedup']:,} "
+              f"hits={s['hits']:,} hit_rate={s['hit_rate']:.1%} saved={s['saved_rate']:.1%} "
+              f"entries={s['entries']:,} evicted={s['evicted']:,}")
+        return s
+
+
+def first_equal_column(prices: Dict[str, np.ndarray]) -> np.ndarray:
+    """(n x k) index of the first column of the same row with identical prices (the column itself if none)."""
+    cols = [np.asarray(p) for p in prices.values()]
+    n, k = cols[0].shape
+    src = np.tile(np.arange(k), (n, 1))
+    for j in range(1, k):
+        for i in range(j):
+            eq = src[:, j] == j
+            for c in cols:
+                eq &= c[:, i] == c[:, j]
+            src[eq, j] = i
+    return src
+
+
+class CachedPredictor:
+    """GridPredictor that scores each distinct, uncached cell of a block once.
+    With a 0-entry cache only the cells repeated within a row are skipped (no keys, no index)."""
+
+    def __init__(self, inner: GridPredictor, cache: PredictionCache):
+        self.inner = inner
+        self.cache = cache
+
+    def _score(self, X: pd.DataFrame, prices: Dict[str, np.ndarray], rows: np.ndarray,
+               cols: np.ndarray) -> np.ndarray:
+        """Inner predictions of the cells (rows, cols), given row-major; rows grouped by their number of cells."""
+        vals = np.empty(len(rows), dtype=np.float32)
+        _, per_row = np.unique(rows, return_counts=True)
+        for m in np.unique(per_row):
+            # Cells of rows with exactly m cells, row-major -> an (r x m) block for the inner predictor
+            sel = np.repeat(per_row == m, per_row)
+            r = rows[sel][::m]
+            c = cols[sel].reshape(-1, m)
+            sub = X.take(r)
+            sub.index = pd.RangeIndex(len(r))
+            u = self.inner(sub, {name: np.take_along_axis(np.asarray(p)[r], c, axis=1) for name, p in prices.items()})
+            vals[sel] = np.asarray(u, dtype=np.float32).ravel()
+        return vals
+
+    def __call__(self, X: pd.DataFrame, prices: Dict[str, np.ndarray]) -> np.ndarray:
+        n, k = next(iter(prices.values())).shape
+        st = self.cache.stats
+        st["cells"] += n * k
+        if self.cache.max_entries <= 0:
+            src = first_equal_column(prices)
+            rows, cols = np.nonzero(src == np.arange(k))
+            vals = np.empty((n, k), dtype=np.float32)
+            vals[rows, cols] = self._score(X, prices, rows, cols)
+            st["dedup"] += n * k - len(rows)
+            st["scored"] += len(rows)
+            return np.take_along_axis(vals, src, axis=1)
+
+        keys = cell_keys(X, prices).ravel()
+        uniq, first, inv = np.unique(keys, return_index=True, return_inverse=True)
+        slots = self.cache.lookup(uniq)
+        vals = np.empty(len(uniq), dtype=np.float32)
+        hit = slots >= 0
+        vals[hit] = self.cache.values[slots[hit]]
+
+        # Misses, by the cell that first carries each key
+        miss = np.flatnonzero(~hit)
+        cells = first[miss]
+        order = np.argsort(cells, kind="stable")
+        miss, cells = miss[order], cells[order]
+        vals[miss] = self._score(X, prices, cells // k, cells % k)
+        self.cache.add(uniq[miss], vals[miss])
+        st["dedup"] += n * k - len(uniq)
+        st["hits"] += int(hit.sum())
+        st["scored"] += len(miss)
+        return vals[inv].reshape(n, k)
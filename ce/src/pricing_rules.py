@@ -0,0 +1,34 @@
+# =============================================================
+# file: ce/src/pricing_rules.py
+# Purpose: The fct_sales_features.sql business rules, in one place for the
+#          daily scoring state, the pricing service and the synthetic data
+#  - SHELF_LIFE_DAYS: shelf life per perishable family (DEFAULT_SHELF_LIFE_DAYS = the SQL's ELSE 14)
+#  - time_to_expiry: shelf_life - MOD(ABS(FARM_FINGERPRINT(store-item-date)), shelf_life + 1)
+#  - discount_ladder / effective_price: markdown by days left, price rounded to cents
+# =============================================================
+
+import numpy as np
+
+from sharding import fingerprint64
+
+SHELF_LIFE_DAYS = {
+    "BREAD_BAKERY": 3, "DAIRY": 10, "DELI": 5, "EGGS": 21, "MEATS": 7,
+    "POULTRY": 5, "PREPARED_FOODS": 3, "PRODUCE": 5, "SEAFOOD": 5,
+}
+DEFAULT_SHELF_LIFE_DAYS = 14  # any other family
+
+
+def time_to_expiry(store_nbr, item_nbr, date: str, shelf_life: np.ndarray) -> np.ndarray:
+    """Days left per row; store_nbr / item_nbr are str arrays or Series, date is YYYY-MM-DD."""
+    keys = (store_nbr + "-" + item_nbr + "-" + date).tolist()
+    fp = np.abs(fingerprint64(keys).view(np.int64))
+    shelf_life = np.asarray(shelf_life, dtype=np.int64)
+    return np.maximum(shelf_life - fp % (shelf_life + 1), 0)
+
+
+def discount_ladder(tte: np.ndarray) -> np.ndarray:
+    return np.select([tte >= 6, tte >= 4, tte == 3, tte == 2, tte == 1], [0.0, 0.10, 0.20, 0.30, 0.40], 0.50)
+
+
+def effective_price(base_price, discount_pct) -> np.ndarray:
+    return np.round(np.asarray(base_price) * (1 - np.asarray(discount_pct)), 2)
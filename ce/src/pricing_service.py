@@ -0,0 +1,357 @@
+# =============================================================
+# file: ce/src/pricing_service.py
+# Purpose: Online pricing: one (date, store, item, expiry, base price) request
+#          -> revenue-maximizing discount, in-process or over HTTP
+#  - Features come from the rolling state (feature_state.py), loaded once per
+#    serving day into a keyed frame; calendar / expiry / base price come with
+#    the request
+#  - MicroBatcher: concurrent requests queue up and one thread scores them
+#    together (up to max_batch, waiting at most max_wait_ms after the first),
+#    so a burst costs one encode + one booster call instead of one per request
+#  - Scoring is the sweep's own day_sweep (same encoder, grid and baseline
+#    column), so online prices equal the offline policy_sweep_*_cat.py rows
+#  - Requests are validated / coerced before they are queued: a malformed
+#    one gets its own {"error": ...}; a batch that still fails is re-scored
+#    item by item, so only the bad item fails
+#  - HTTP: POST /price (one JSON object or a list), GET /healthz; stdlib
+#    ThreadingHTTPServer, one thread per connection
+#  - --load_test N: N requests from C concurrent clients (in-process or
+#    against --url), reports p50 / p99 latency, requests/s and batch sizes
+# =============================================================
+
+#!/usr/bin/env python3
+import os, argparse, importlib, json, queue, threading, time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from encoding import CategoryEncoder
+from feature_state import FeatureState, pair_keys
+from forest import PriceIncrementalPredictor, from_booster, load_booster, load_forest
+from sweep_engine import tiled_predictor
+from pricing_rules import discount_ladder, effective_price
+
+SWEEPS = {"xgboost": "policy_sweep_xgb_cat", "lightgbm": "policy_sweep_lgb_cat"}
+REQUEST_FIELDS = ["date","store_nbr","item_nbr","time_to_expiry","base_price"]
+
+
+def validate_request(request) -> Dict:
+    """Request with its fields coerced (date -> YYYY-MM-DD, keys -> str, expiry -> int, price -> float);
+    ValueError naming the bad field otherwise."""
+    if not isinstance(request, dict):
+        raise ValueError(f"request must be a JSON object, got {type(request).__name__}")
+    missing = [f for f in REQUEST_FIELDS if f not in request]
+    if missing:
+        raise ValueError(f"missing fields {missing}")
+    out = {}
+    for f, conv in [("date", lambda v: pd.Timestamp(v).strftime("%Y-%m-%d")), ("store_nbr", str),
+                    ("item_nbr", str), ("time_to_expiry", int), ("base_price", float)]:
+        v = request[f]
+        try:
+            if v is None or isinstance(v, (bool, list, dict)):
+                raise ValueError
+            out[f] = conv(v)
+        except (ValueError, TypeError, OverflowError):
+            raise ValueError(f"invalid {f}: {v!r}") from None
+    if not np.isfinite(out["base_price"]) or out["base_price"] < 0:
+        raise ValueError(f"invalid base_price: {request['base_price']!r}")
+    return out
+
+
+def request_error(request, error: str) -> Dict:
+    """Per-item error result (same shape as the unknown-key one)."""
+    keys = request if isinstance(request, dict) else {}
+    return {"store_nbr": keys.get("store_nbr"), "item_nbr": keys.get("item_nbr"), "date": keys.get("date"),
+            "error": error}
+
+
+class MicroBatcher:
+    """submit(item) -> Future; one thread runs score(items) -> results on batches of queued items."""
+
+    def __init__(self, score: Callable[[List], List], max_batch: int = 256, max_wait_ms: float = 2.0):
+        self._score = score
+        self.max_batch = max(1, int(max_batch))
+        self.max_wait_s = max(0.0, max_wait_ms) / 1000.0
+        self._q: "queue.Queue" = queue.Queue()
+        self.batch_sizes: List[int] = []
+        self._thread = threading.Thread(target=self._loop, name="price-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, item) -> Future:
+        fut: Future = Future()
+        self._q.put((item, fut))
+        return fut
+
+    def _loop(self):
+        while True:
+            batch = [self._q.get()]
+            deadline = time.perf_counter() + self.max_wait_s
+            while len(batch) < self.max_batch:
+                try:
+                    # Whatever is already queued joins without waiting; then wait out the deadline
+                    batch.append(self._q.get(timeout=max(0.0, deadline - time.perf_counter())))
+                except queue.Empty:
+                    break
+            items, futs = zip(*batch)
+            self.batch_sizes.append(len(batch))
+            try:
+                results = self._score(list(items))
+            except Exception as e:
+                if len(batch) == 1:
+                    futs[0].set_exception(e)
+                    continue
+                # One bad item must not fail the others: re-score the batch one item at a time
+                for item, f in batch:
+                    try:
+                        f.set_result(self._score([item])[0])
+                    except Exception as e1:
+                        f.set_exception(e1)
+                continue
+            for f, r in zip(futs, results):
+                f.set_result(r)
+
+
+class PricingService:
+    """Latest features + model + discount grid -> policy price per request (thread-safe via the batcher)."""
+
+    def __init__(self,
+                 state: FeatureState,
+                 booster,
+                 encoder: CategoryEncoder,
+                 discount_grid: List[float],
+                 predict_grid=None,
+                 max_batch: int = 256,
+                 max_wait_ms: float = 2.0,
+                 active_days: int = 28):
+        self.state = state
+        self.booster = booster
+        self.encoder = encoder
+        self.grid = list(discount_grid)
+        self.predict_grid = predict_grid
+        self.active_days = active_days
+        lib = type(booster).__module__.split(".")[0] if booster is not None else "xgboost"
+        self.sweep = importlib.import_module(SWEEPS[lib])
+        self._features: Dict[str, pd.DataFrame] = {}
+        self._lock = threading.Lock()
+        self.batcher = MicroBatcher(self.price_batch, max_batch, max_wait_ms)
+
+    def features(self, date: str) -> pd.DataFrame:
+        """State features as of `date`, keyed by 'store|item' (built once per date)."""
+        with self._lock:
+            if date not in self._features:
+                df = self.state.features(date, self.active_days)
+                df.index = pair_keys(df["store_nbr"], df["item_nbr"])
+                self._features = {date: df}  # only the current serving day is kept
+            return self._features[date]
+
+    def price_batch(self, requests: List[Dict]) -> List[Dict]:
+        """Score a batch of requests in one day_sweep call per distinct date."""
+        req = pd.DataFrame(requests, columns=REQUEST_FIELDS)
+        req["date"] = pd.to_datetime(req["date"]).dt.strftime("%Y-%m-%d")
+        req[["store_nbr","item_nbr"]] = req[["store_nbr","item_nbr"]].astype(str)
+        out: List[Optional[Dict]] = [None] * len(req)
+        for date, grp in req.groupby("date", sort=False):
+            feats = self.features(date)
+            pos = feats.index.get_indexer(pair_keys(grp["store_nbr"], grp["item_nbr"]))
+            known = pos >= 0
+            for i in grp.index[~known]:
+                out[i] = {"store_nbr": req.at[i, "store_nbr"], "item_nbr": req.at[i, "item_nbr"], "date": date,
+                          "error": "no features (unknown key or < 28 days of history)"}
+            if not known.any():
+                continue
+            g = grp[known]
+            base = feats.iloc[pos[known]].drop(columns=["base_price"]).reset_index(drop=True)
+            ts = pd.Timestamp(date)
+            tte = g["time_to_expiry"].to_numpy(dtype=np.int64)
+            bp = g["base_price"].to_numpy(dtype=np.float64)
+            disc = discount_ladder(tte)
+            base = base.assign(date=ts, base_price=bp, time_to_expiry=tte,
+                               dow=(ts.dayofweek + 1) % 7 + 1, month=ts.month, year=ts.year,
+                               baseline_discount_pct=disc, baseline_effective_price=effective_price(bp, disc))
+            res = self.sweep.day_sweep(self.booster, self.encoder, base, self.grid, predict_grid=self.predict_grid)
+            res["date"] = date
+            for i, rec in zip(g.index, res.to_dict(orient="records")):
+                # float32 scores -> plain floats without the float32 tail (0.2, not 0.20000000298)
+                out[i] = {k: (round(float(v), 6) if isinstance(v, (np.floating, float)) else v) for k, v in rec.items()}
+        return out
+
+    def submit(self, request: Dict) -> Future:
+        """Queue a validated request; a malformed one resolves at once to its error result."""
+        try:
+            return self.batcher.submit(validate_request(request))
+        except ValueError as e:
+            fut: Future = Future()
+            fut.set_result(request_error(request, str(e)))
+            return fut
+
+    def price(self, request: Dict, timeout: Optional[float] = 30.0) -> Dict:
+        return self.submit(request).result(timeout)
+
+    def price_many(self, requests: List[Dict], timeout: Optional[float] = 30.0) -> List[Dict]:
+        futs = [self.submit(r) for r in requests]
+        return [f.result(timeout) for f in futs]
+
+
+def make_handler(service: PricingService):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive: clients reuse one connection per thread
+
+        def _send(self, code: int, body):
+            data = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/healthz":
+                self._send(200, {"ok": True, "state_date": service.state.last_date, "keys": len(service.state)})
+            else:
+                self._send(404, {"error": "not found"})
+
+        def do_POST(self):
+            if self.path != "/price":
+                return self._send(404, {"error": "not found"})
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                items = body if isinstance(body, list) else [body]
+                if not items or not all(isinstance(r, dict) for r in items):
+                    return self._send(400, {"error": "body must be a JSON object or a non-empty list of objects"})
+                missing = {f for r in items for f in REQUEST_FIELDS if f not in r}
+                if missing:
+                    return self._send(400, {"error": f"missing fields {sorted(missing)}"})
+                self._send(200, service.price_many(body) if isinstance(body, list) else service.price(body))
+            except (ValueError, KeyError) as e:
+                self._send(400, {"error": str(e)})
+            except FutureTimeout:
+                self._send(504, {"error": "pricing timed out"})
+            except Exception as e:
+                self._send(500, {"error": f"{type(e).__name__}: {e}"})
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def http_client(url: str) -> Callable[[Dict], Dict]:
+    """POST one request to a running service (keep-alive connection per thread)."""
+    import http.client
+    from urllib.parse import urlparse
+    u = urlparse(url)
+    local = threading.local()
+
+    def call(request: Dict) -> Dict:
+        if not hasattr(local, "conn"):
+            local.conn = http.client.HTTPConnection(u.hostname, u.port or 80, timeout=30)
+        local.conn.request("POST", "/price", json.dumps(request), {"Content-Type": "application/json"})
+        resp = local.conn.getresponse()
+        return json.loads(resp.read())
+
+    return call
+
+
+def sample_requests(state: FeatureState, date: str, n: int, seed: int = 0) -> List[Dict]:
+    """n requests for random scoreable keys of `date` (time_to_expiry 0-2, the key's last base price)."""
+    feats = state.features(date)
+    rng = np.random.default_rng(seed)
+    pick = feats.iloc[rng.integers(0, len(feats), n)]
+    return [{"date": date, "store_nbr": s, "item_nbr": i, "time_to_expiry": int(t), "base_price": float(p)}
+            for s, i, t, p in zip(pick["store_nbr"], pick["item_nbr"], rng.integers(0, 3, n), pick["base_price"])]
+
+
+def load_test(call: Callable[[Dict], Dict], requests: List[Dict], concurrency: int) -> Dict[str, float]:
+    """Fire `requests` from `concurrency` client threads; per-request latency and overall throughput."""
+    lat = np.zeros(len(requests))
+
+    def one(i: int):
+        t0 = time.perf_counter()
+        res = call(requests[i])
+        lat[i] = time.perf_counter() - t0
+        return "error" in res
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        errors = sum(pool.map(one, range(len(requests))))
+    wall = time.perf_counter() - t0
+    ms = lat * 1000.0
+    return {"requests": len(requests), "concurrency": concurrency, "errors": int(errors),
+            "p50_ms": float(np.percentile(ms, 50)), "p99_ms": float(np.percentile(ms, 99)),
+            "mean_ms": float(ms.mean()), "rps": len(requests) / wall if wall > 0 else float("nan")}
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Online pricing service (HTTP) and load-test harness")
+    ap.add_argument("--state_dir", default="state/features", help="feature_state.py state")
+    ap.add_argument("--model_path", default="models/xgb_cat.json", help="XGBoost .json/.ubj or LightGBM .txt")
+    ap.add_argument("--cat_vocab_path", default="models/xgb_cat_vocab.json")
+    ap.add_argument("--predictor", choices=["native", "compiled", "incremental"], default="native")
+    ap.add_argument("--forest_path", default=None, help="Compiled model dir from forest.py")
+    ap.add_argument("--discount_grid", default="0.0,0.1,0.2,0.3,0.4,0.5")
+    ap.add_argument("--max_batch", type=int, default=256, help="Requests per booster call")
+    ap.add_argument("--max_wait_ms", type=float, default=2.0, help="Wait for more requests after the first")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8080)
+    ap.add_argument("--load_test", type=int, default=0,
+                    help="Send N sample requests instead of serving (in-process, or to --url)")
+    ap.add_argument("--concurrency", default="1,8,32", help="Client threads per load-test round")
+    ap.add_argument("--url", default=None, help="Load-test a running service, e.g. http://127.0.0.1:8080")
+    ap.add_argument("--date", default=None, help="Load-test request date (default: day after the state)")
+    ap.add_argument("--report", default=None, help="Write the load-test rounds as JSON")
+    args = ap.parse_args()
+
+    state = FeatureState(args.state_dir)
+    assert state.last_date, f"{args.state_dir}: no feature state (run feature_state.py first)"
+    date = args.date or str(np.datetime64(state.last_date) + 1)
+    requests = sample_requests(state, date, args.load_test) if args.load_test else []
+
+    service = None
+    if not args.url:
+        if args.forest_path:
+            assert args.predictor != "native", "--forest_path needs --predictor compiled or incremental"
+            forest = load_forest(args.forest_path)
+            booster, encoder = None, forest.encoder
+        else:
+            booster = load_booster(args.model_path)
+            encoder = CategoryEncoder.load(args.cat_vocab_path)
+            forest = from_booster(booster, encoder.vocab) if args.predictor != "native" else None
+        predict_grid = (PriceIncrementalPredictor(forest) if args.predictor == "incremental" else
+                        tiled_predictor(forest.predict_frame) if args.predictor == "compiled" else None)
+        grid = [float(x) for x in args.discount_grid.split(",") if x.strip() != ""]
+        service = PricingService(state, booster, encoder, grid, predict_grid, args.max_batch, args.max_wait_ms)
+        t0 = time.time()
+        service.features(date)
+        print(f"[service] {len(service.features(date)):,} scoreable keys for {date} "
+              f"(state {state.last_date}) in {time.time() - t0:.1f}s")
+
+    if not args.load_test:
+        server = ThreadingHTTPServer((args.host, args.port), make_handler(service))
+        print(f"[service] POST http://{args.host}:{args.port}/price  (GET /healthz)")
+        server.serve_forever()
+        return
+
+    call = http_client(args.url) if args.url else service.price
+    call(requests[0])  # warm-up: features / model paths
+    rounds = []
+    for c in [int(x) for x in args.concurrency.split(",") if x.strip()]:
+        sizes0 = len(service.batcher.batch_sizes) if service else 0
+        r = load_test(call, requests, c)
+        if service:
+            sizes = service.batcher.batch_sizes[sizes0:]
+            r["batches"], r["mean_batch"] = len(sizes), float(np.mean(sizes)) if sizes else 0.0
+        rounds.append(r)
+        print(f"[load] c={c:<4} n={r['requests']:,} p50={r['p50_ms']:.2f}ms p99={r['p99_ms']:.2f}ms "
+              f"{r['rps']:,.0f} req/s errors={r['errors']}"
+              + (f" mean_batch={r['mean_batch']:.1f}" if service else ""))
+    if args.report:
+        os.makedirs(os.path.dirname(args.report) or ".", exist_ok=True)
+        with open(args.report, "w") as f:
+            json.dump({"date": date, "url": args.url, "args": vars(args), "rounds": rounds}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+# =============================================================
+# file: ce/src/report.py
+# Purpose: KPI report for any number of model runs in one command
+#  - --run NAME=KIND:ARG, repeatable; KIND is
+#      kpis:<prefix>   <prefix>_policy_kpis_by_date / _by_expiry (policy_kpis.sql)
+#      eval:<table>    a policy_eval table in --source (aggregated here)
+#      store:<path>    a local result store table (result_store.py), e.g. outputs/xgb_policy_eval_test
+#      json:<path>     a sweep KPI artifact (kpi.py)
+#  - Only the needed columns are read; the aggregated frames are cached as
+#    Parquet under --cache_dir, keyed by run spec + input fingerprint
+#    (file sizes / mtimes, or the BigQuery table's last-modified time)
+#  - Per-run charts + side-by-side comparisons render in a process pool
+# =============================================================
+
+#!/usr/bin/env python3
+import os, argparse, glob, hashlib, json, time
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, List, NamedTuple, Tuple
+
+import pandas as pd
+
+from data_source import DataSource, ParquetSource, add_source_args, source_from_args
+from kpi import load_kpis
+import viz_kpis as viz
+
+FRAMES = ["by_date", "by_expiry"]
+KINDS = ["kpis", "eval", "store", "json"]
+
+
+class RunSpec(NamedTuple):
+    name: str
+    kind: str
+    arg: str
+
+
+def parse_run(text: str) -> RunSpec:
+    """'xgb=json:outputs/xgb_policy_eval_test_kpis.json' -> RunSpec('xgb', 'json', ...)"""
+    name, sep, rest = text.partition("=")
+    kind, sep2, arg = rest.partition(":")
+    assert sep and sep2 and name and arg and kind in KINDS, \
+        f"--run {text!r}: expected NAME=KIND:ARG with KIND in {KINDS}"
+    return RunSpec(name, kind, arg)
+
+
+def _files_stamp(paths: List[str]) -> List[Tuple[str, int, int]]:
+    return [(p, os.path.getsize(p), os.stat(p).st_mtime_ns) for p in sorted(paths)]
+
+
+def _table_stamp(source: DataSource, table: str):
+    """Input fingerprint of one table: its files (Parquet mirror) or last-modified time (BigQuery)."""
+    if isinstance(source, ParquetSource):
+        return _files_stamp(glob.glob(os.path.join(source.root, table, "**", "*.parquet"), recursive=True))
+    return str(source.client.get_table(source.table_id(table)).modified)
+
+
+def fingerprint(spec: RunSpec, source: DataSource) -> str:
+    if spec.kind == "json":
+        stamp = _files_stamp([spec.arg])
+    elif spec.kind == "store":
+        stamp = _files_stamp(glob.glob(os.path.join(spec.arg, "**", "*.parquet"), recursive=True))
+    elif spec.kind == "kpis":
+        stamp = [_table_stamp(source, f"{spec.arg}_policy_kpis_{f}") for f in FRAMES]
+    else:
+        stamp = [_table_stamp(source, spec.arg), _table_stamp(source, "scoring_frame_test")]
+    key = json.dumps([spec.kind, spec.arg, type(source).__name__, stamp], default=str)
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+def load_run(spec: RunSpec, source: DataSource) -> Dict[str, pd.DataFrame]:
+    """by_date (date, baseline_rev, policy_rev, uplift_pct) and by_expiry (expiry_bucket, ...) of one run."""
+    if spec.kind == "json":
+        tables = load_kpis(spec.arg)
+        return {f: tables[f] for f in FRAMES}
+    if spec.kind == "kpis":
+        return {
+            "by_date": viz.load_table(source, f"{spec.arg}_policy_kpis_by_date",
+                                      ["date", "baseline_rev", "policy_rev", "uplift_pct"]),
+            "by_expiry": viz.load_table(source, f"{spec.arg}_policy_kpis_by_expiry",
+                                        ["expiry_bucket", "baseline_rev", "policy_rev", "uplift_pct"]),
+        }
+    if spec.kind == "store":
+        root, table = os.path.split(os.path.normpath(spec.arg))
+        daily, exp = viz.kpis_from_results(ParquetSource(root), table, source)
+    else:
+        daily, exp = viz.kpis_from_results(source, spec.arg, source)
+    return {"by_date": daily, "by_expiry": exp}
+
+
+def cached_run(spec: RunSpec, source: DataSource, cache_dir: str, refresh: bool = False) -> Dict[str, pd.DataFrame]:
+    """load_run through a Parquet cache at cache_dir/<name>/<fingerprint>/<frame>.parquet."""
+    run_dir = os.path.join(cache_dir, spec.name, fingerprint(spec, source))
+    paths = {f: os.path.join(run_dir, f"{f}.parquet") for f in FRAMES}
+    if not refresh and all(os.path.exists(p) for p in paths.values()):
+        print(f"[{spec.name}] cached -> {run_dir}")
+        return {f: pd.read_parquet(p) for f, p in paths.items()}
+    t0 = time.time()
+    frames = load_run(spec, source)
+    os.makedirs(run_dir, exist_ok=True)
+    for f, df in frames.items():
+        tmp = f"{paths[f]}.{os.getpid()}.tmp"
+        df.to_parquet(tmp, index=False)
+        os.replace(tmp, paths[f])
+    print(f"[{spec.name}] {spec.kind}:{spec.arg} aggregated in {time.time() - t0:.1f}s -> {run_dir}")
+    return frames
+
+
+def chart_jobs(runs: Dict[str, Dict[str, pd.DataFrame]], outdir: Path) -> List[Tuple[Callable, tuple, dict]]:
+    """(plot fn, args, kwargs) per chart: two per run, plus comparisons when there are several runs."""
+    jobs = []
+    for name, frames in runs.items():
+        jobs.append((viz.plot_daily_revenue, (frames["by_date"], outdir / f"{name}_daily_revenue_baseline_vs_policy.png"),
+                     dict(label=name.upper())))
+        jobs.append((viz.plot_uplift_by_expiry, (frames["by_expiry"], outdir / f"{name}_uplift_by_expiry_bucket.png"),
+                     dict(label=name.upper())))
+    if len(runs) > 1:
+        daily = {n: f["by_date"] for n, f in runs.items()}
+        jobs.append((viz.plot_compare_daily_uplift, (daily, outdir / "compare_daily_uplift.png"), {}))
+        jobs.append((viz.plot_compare_expiry_uplift, ({n: f["by_expiry"] for n, f in runs.items()},
+                                                      outdir / "compare_uplift_by_expiry_bucket.png"), {}))
+        jobs.append((viz.plot_compare_totals, (daily, outdir / "compare_total_revenue.png"), {}))
+    return jobs
+
+
+def _render(job: Tuple[Callable, tuple, dict]) -> str:
+    fn, args, kwargs = job
+    fn(*args, **kwargs)
+    return str(args[-1])
+
+
+def render(jobs: List[Tuple[Callable, tuple, dict]], workers: int) -> List[str]:
+    if workers <= 1:
+        return [_render(j) for j in jobs]
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context("fork")) as pool:
+        return list(pool.map(_render, jobs))
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--project", default=os.getenv("PROJECT"), help="GCP project ID")
+    ap.add_argument("--run", action="append", required=True, metavar="NAME=KIND:ARG",
+                    help=f"Model run to report (repeatable); KIND in {KINDS}, e.g. xgb=json:outputs/"
+                         "xgb_policy_eval_test_kpis.json, lgb=kpis:lgb, bqml=eval:policy_eval_test")
+    ap.add_argument("--outdir", default="reports/viz", help="Directory to save charts")
+    ap.add_argument("--cache_dir", default="reports/cache", help="Aggregated frames per run")
+    ap.add_argument("--refresh", action="store_true", help="Ignore cached aggregates")
+    ap.add_argument("--workers", type=int, default=0, help="Chart render processes (0 = one per CPU)")
+    add_source_args(ap)
+    args = ap.parse_args()
+
+    specs = [parse_run(r) for r in args.run]
+    assert len({s.name for s in specs}) == len(specs), "duplicate run names"
+    # Only table-backed runs need a data source (and credentials)
+    source = source_from_args(args) if any(s.kind in ("kpis", "eval", "store") for s in specs) else None
+
+    t0 = time.time()
+    runs = {s.name: cached_run(s, source, args.cache_dir, args.refresh) for s in specs}
+    jobs = chart_jobs(runs, Path(args.outdir))
+    workers = min(len(jobs), args.workers or os.cpu_count() or 1)
+    for path in render(jobs, workers):
+        print(f"  {path}")
+    print(f"{len(jobs)} charts for {len(runs)} runs in {time.time() - t0:.1f}s -> {Path(args.outdir).resolve()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+# =============================================================
+# file: ce/src/result_store.py
+# Purpose: Date-partitioned Parquet store for the sweep results
+#  - root/<table>/date=YYYY-MM-DD/part-0.parquet: the ParquetSource layout, so
+#    KPI / report code reads it with --source parquet like any mirrored table
+#  - Schema = the BQ policy_eval table: float32 measures, dictionary-encoded
+#    store / item keys, DATE partitions
+#  - write_day: temp file + os.replace -> a rerun atomically replaces the
+#    day's partition (no duplicated rows, no half-written files)
+# =============================================================
+
+import os, glob
+from typing import List, Optional, Tuple
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from data_source import DATE_PART, ParquetSource
+
+KEY_COLS = ["store_nbr","item_nbr"]
+RESULT_SCHEMA = pa.schema(
+    [pa.field("date", pa.date32())]
+    + [pa.field(c, pa.dictionary(pa.int32(), pa.string())) for c in KEY_COLS]
+    + [pa.field(c, pa.float32()) for c in [
+        "baseline_discount_pct","baseline_effective_price","pred_units_baseline","baseline_revenue",
+        "policy_discount_pct","policy_effective_price","pred_units_policy","policy_revenue"]]
+)
+PART_FILE = "part-0.parquet"
+
+
+def to_arrow(df: pd.DataFrame, schema: pa.Schema = RESULT_SCHEMA) -> pa.Table:
+    """Sweep output -> Arrow table in `schema` (keys as strings, like the BQ STRING columns)."""
+    arrays = []
+    for f in schema:
+        s = df[f.name]
+        if pa.types.is_date(f.type):
+            arrays.append(pa.array(pd.to_datetime(s).to_numpy().astype("datetime64[D]"), type=f.type))
+        elif pa.types.is_dictionary(f.type):
+            arrays.append(pa.array(s.astype(str), type=pa.string()).dictionary_encode())
+        else:
+            arrays.append(pa.array(s.to_numpy(dtype=f.type.to_pandas_dtype()), type=f.type))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+class ResultStore:
+    """One sweep result table under a local Parquet root (e.g. outputs/xgb_policy_eval_test)."""
+
+    def __init__(self, root: str, table: str, schema: pa.Schema = RESULT_SCHEMA):
+        self.root = root
+        self.table = table
+        self.schema = schema
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.root, self.table)
+
+    def partition_dir(self, date: str) -> str:
+        return os.path.join(self.path, DATE_PART + str(date))
+
+    def write_day(self, date: str, df: pd.DataFrame) -> str:
+        """Write (or atomically replace) the partition of `date`; returns the file path."""
+        pdir = self.partition_dir(date)
+        os.makedirs(pdir, exist_ok=True)
+        path = os.path.join(pdir, PART_FILE)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        try:
+            pq.write_table(to_arrow(df, self.schema), tmp, compression="zstd")
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        # Files of any other layout in the partition would be read back as extra rows
+        for p in glob.glob(os.path.join(pdir, "*.parquet")):
+            if os.path.basename(p) != PART_FILE:
+                os.remove(p)
+        return path
+
+    def dates(self) -> List[str]:
+        return ParquetSource(self.root).partitions(self.table)
+
+    def read(self,
+             columns: Optional[List[str]] = None,
+             date_range: Optional[Tuple[str, str]] = None) -> pd.DataFrame:
+        return ParquetSource(self.root).read(self.table, columns=columns, date_range=date_range)
@@ -0,0 +1,194 @@
+# =============================================================
+# file: ce/src/sharding.py
+# Purpose: Deterministic (store, item) sharding identical to BigQuery
+#  - fingerprint64: vectorized FarmHash Fingerprint64 == FARM_FINGERPRINT
+#  - shard_ids: MOD(ABS(FARM_FINGERPRINT(CONCAT(store_nbr, '|', item_nbr))), N)
+#    exactly as in ml/bqml/policy_sweep_daily.sql
+#  - shard_indices: all shard row-index arrays from a single pass
+#  - auto_num_shards: smallest shard count whose candidate block fits a budget
+# =============================================================
+
+from typing import List, Sequence
+
+import numpy as np
+import pandas as pd
+
+
+_U = np.uint64
+K0 = _U(0xc3a5c85c97cb3127)
+K1 = _U(0xb492b66fbe98f273)
+K2 = _U(0x9ae16a3b2f90404f)
+
+# Peak bytes per candidate row in a sweep: tiled encoded frame + float32 model matrix
+CANDIDATE_ROW_BYTES = 128
+
+
+def _rot(v, s: int):
+    return v if s == 0 else (v >> _U(s)) | (v << _U(64 - s))
+
+
+def _shift_mix(v):
+    return v ^ (v >> _U(47))
+
+
+def _hash_len16(u, v, mul):
+    a = (u ^ v) * mul
+    a ^= a >> _U(47)
+    b = (v ^ a) * mul
+    b ^= b >> _U(47)
+    return b * mul
+
+
+def _fetch64(B: np.ndarray, o: int):
+    return np.ascontiguousarray(B[:, o:o + 8]).view("<u8")[:, 0]
+
+
+def _fetch32(B: np.ndarray, o: int):
+    return np.ascontiguousarray(B[:, o:o + 4]).view("<u4")[:, 0].astype(np.uint64)
+
+
+def _hash_len0to16(B: np.ndarray, n: int):
+    m = B.shape[0]
+    if n >= 8:
+        mul = K2 + _U(n * 2)
+        a = _fetch64(B, 0) + K2
+        b = _fetch64(B, n - 8)
+        c = _rot(b, 37) * mul + a
+        d = (_rot(a, 25) + b) * mul
+        return _hash_len16(c, d, mul)
+    if n >= 4:
+        mul = K2 + _U(n * 2)
+        a = _fetch32(B, 0)
+        return _hash_len16(_U(n) + (a << _U(3)), _fetch32(B, n - 4), mul)
+    if n > 0:
+        a = B[:, 0].astype(np.uint64)
+        b = B[:, n >> 1].astype(np.uint64)
+        c = B[:, n - 1].astype(np.uint64)
+        y = a + (b << _U(8))
+        z = _U(n) + (c << _U(2))
+        return _shift_mix(y * K2 ^ z * K0) * K2
+    return np.full(m, K2, dtype=np.uint64)
+
+
+def _hash_len17to32(B: np.ndarray, n: int):
+    mul = K2 + _U(n * 2)
+    a = _fetch64(B, 0) * K1
+    b = _fetch64(B, 8)
+    c = _fetch64(B, n - 8) * mul
+    d = _fetch64(B, n - 16) * K2
+    return _hash_len16(_rot(a + b, 43) + _rot(c, 30) + d, a + _rot(b + K2, 18) + c, mul)
+
+
+def _hash_len33to64(B: np.ndarray, n: int):
+    mul = K2 + _U(n * 2)
+    a = _fetch64(B, 0) * K2
+    b = _fetch64(B, 8)
+    c = _fetch64(B, n - 8) * mul
+    d = _fetch64(B, n - 16) * K2
+    y = _rot(a + b, 43) + _rot(c, 30) + d
+    z = _hash_len16(y, a + _rot(b + K2, 18) + c, mul)
+    e = _fetch64(B, 16) * mul
+    f = _fetch64(B, 24)
+    g = (y + _fetch64(B, n - 32)) * mul
+    h = (z + _fetch64(B, n - 24)) * mul
+    return _hash_len16(_rot(e + f, 43) + _rot(g, 30) + h, e + _rot(f + a, 18) + g, mul)
+
+
+def _weak_hash_len32(B: np.ndarray, o: int, a, b):
+    w, x, y, z = _fetch64(B, o), _fetch64(B, o + 8), _fetch64(B, o + 16), _fetch64(B, o + 24)
+    a = a + w
+    b = _rot(b + a + z, 21)
+    c = a
+    a = a + x + y
+    b = b + _rot(a, 44)
+    return a + z, b + c
+
+
+def _hash_len65plus(B: np.ndarray, n: int):
+    m = B.shape[0]
+    seed = _U(81)
+    x = np.full(m, seed, dtype=np.uint64)
+    y = np.full(m, seed * K1 + _U(113), dtype=np.uint64)
+    z = _shift_mix(y * K2 + _U(113)) * K2
+    v0 = v1 = w0 = w1 = np.zeros(m, dtype=np.uint64)
+    x = x * K2 + _fetch64(B, 0)
+    end = ((n - 1) // 64) * 64
+    last64 = end + ((n - 1) & 63) - 63
+    o = 0
+    while True:
+        x = _rot(x + y + v0 + _fetch64(B, o + 8), 37) * K1
+        y = _rot(y + v1 + _fetch64(B, o + 48), 42) * K1
+        x ^= w1
+        y = y + v0 + _fetch64(B, o + 40)
+        z = _rot(z + w0, 33) * K1
+        v0, v1 = _weak_hash_len32(B, o, v1 * K1, x + w0)
+        w0, w1 = _weak_hash_len32(B, o + 32, z + w1, y + _fetch64(B, o + 16))
+        z, x = x, z
+        o += 64
+        if o == end:
+            break
+    mul = K1 + ((z & _U(0xff)) << _U(1))
+    o = last64
+    w0 = w0 + _U((n - 1) & 63)
+    v0 = v0 + w0
+    w0 = w0 + v0
+    x = _rot(x + y + v0 + _fetch64(B, o + 8), 37) * mul
+    y = _rot(y + v1 + _fetch64(B, o + 48), 42) * mul
+    x ^= w1 * _U(9)
+    y = y + v0 * _U(9) + _fetch64(B, o + 40)
+    z = _rot(z + w0, 33) * mul
+    v0, v1 = _weak_hash_len32(B, o, v1 * mul, x + w0)
+    w0, w1 = _weak_hash_len32(B, o + 32, z + w1, y + _fetch64(B, o + 16))
+    z, x = x, z
+    return _hash_len16(_hash_len16(v0, w0, mul) + _shift_mix(y) * K0 + z,
+                       _hash_len16(v1, w1, mul) + x, mul)
+
+
+def fingerprint64(keys: Sequence[str]) -> np.ndarray:
+    """FarmHash Fingerprint64 of each UTF-8 string, as uint64 (BigQuery FARM_FINGERPRINT bit pattern)."""
+    n_rows = len(keys)
+    out = np.empty(n_rows, dtype=np.uint64)
+    if n_rows == 0:
+        return out
+    # Fixed-width, NUL-padded byte matrix (keys never contain NUL)
+    raw = np.array(pd.Series(keys, dtype=object).str.encode("utf-8").tolist(), dtype="S")
+    mat = raw.view(np.uint8).reshape(n_rows, raw.dtype.itemsize)
+    lengths = np.char.str_len(raw)
+    with np.errstate(over="ignore"):
+        for n in np.unique(lengths):
+            rows = np.flatnonzero(lengths == n)
+            B = mat[rows, :max(n, 1)]
+            if n <= 16:
+                h = _hash_len0to16(B, n)
+            elif n <= 32:
+                h = _hash_len17to32(B, n)
+            elif n <= 64:
+                h = _hash_len33to64(B, n)
+            else:
+                h = _hash_len65plus(B, n)
+            out[rows] = h
+    return out
+
+
+def shard_ids(store_nbr, item_nbr, num_shards: int) -> np.ndarray:
+    """MOD(ABS(FARM_FINGERPRINT(CONCAT(store_nbr, '|', item_nbr))), num_shards) per row."""
+    keys = pd.Series(store_nbr).astype(str).to_numpy(dtype=object) + "|" + \
+        pd.Series(item_nbr).astype(str).to_numpy(dtype=object)
+    fp = fingerprint64(keys).view(np.int64)
+    return np.abs(fp) % num_shards
+
+
+def shard_indices(df: pd.DataFrame, num_shards: int) -> List[np.ndarray]:
+    """Positional row indices of every shard (original order kept inside a shard), in one pass."""
+    if num_shards <= 1:
+        return [np.arange(len(df))]
+    sid = shard_ids(df["store_nbr"], df["item_nbr"], num_shards)
+    order = np.argsort(sid, kind="stable")
+    bounds = np.searchsorted(sid[order], np.arange(1, num_shards))
+    return np.split(order, bounds)
+
+
+def auto_num_shards(n_rows: int, grid_size: int, bytes_per_row: float, mem_budget_mb: float) -> int:
+    """Smallest shard count whose (rows x (grid + baseline)) candidate block fits in the budget."""
+    need = n_rows * (grid_size + 1) * bytes_per_row
+    return max(1, int(np.ceil(need / (mem_budget_mb * 1024 ** 2))))
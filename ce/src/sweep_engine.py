@@ -0,0 +1,87 @@
+# =============================================================
+# file: ce/src/sweep_engine.py
+# Purpose: Model-agnostic matrix form of the daily price sweep
+#  - Day features are encoded once by the caller (n rows)
+#  - Candidates are an (n x G) layout: only effective_price / discount_pct
+#    vary, the baseline rides along as column G -> one predict call
+#  - Best discount = row-wise argmax of the (n x G) revenue matrix
+#  - Output schema is identical to the historical CSV / BQ table
+#  - "predict" / "argmax" perf spans (perf.py) cover the two halves
+# =============================================================
+
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from perf import span
+
+
+KEY_COLS = ["date","store_nbr","item_nbr"]
+PRICE_COLS = ["effective_price","discount_pct"]
+OUT_COLS = [
+    "date","store_nbr","item_nbr",
+    "baseline_discount_pct","baseline_effective_price","pred_units_baseline","baseline_revenue",
+    "policy_discount_pct","policy_effective_price","pred_units_policy","policy_revenue"
+]
+
+# (encoded features [n rows], {price col: (n x k) values}) -> predicted units (n x k)
+GridPredictor = Callable[[pd.DataFrame, Dict[str, np.ndarray]], np.ndarray]
+
+
+def candidate_prices(base_price: np.ndarray, discount_grid: List[float]) -> Tuple[np.ndarray, np.ndarray]:
+    """(n x G) candidate effective prices and discounts: round(base_price * (1 - d), 2) like BQML."""
+    factor = (1.0 - np.asarray(discount_grid, dtype=np.float64)).astype(np.float32)
+    price = np.round(np.asarray(base_price, dtype=np.float32)[:, None] * factor[None, :], 2)
+    disc = np.broadcast_to(np.asarray(discount_grid, dtype=np.float32), price.shape)
+    return price, disc
+
+
+def tile_candidates(X: pd.DataFrame, prices: Dict[str, np.ndarray]) -> pd.DataFrame:
+    """Repeat each encoded row k times (row-major) and overwrite only the price columns."""
+    n, k = next(iter(prices.values())).shape
+    cand = X.take(np.repeat(np.arange(n), k))
+    cand.index = pd.RangeIndex(n * k)
+    for c, m in prices.items():
+        cand[c] = np.ascontiguousarray(m, dtype=X[c].dtype).reshape(-1)
+    return cand
+
+
+def tiled_predictor(predict: Callable[[pd.DataFrame], np.ndarray]) -> GridPredictor:
+    """Grid predictor that scores the tiled (n*k)-row block in a single `predict` call."""
+    def predict_grid(X: pd.DataFrame, prices: Dict[str, np.ndarray]) -> np.ndarray:
+        n, k = next(iter(prices.values())).shape
+        return np.asarray(predict(tile_candidates(X, prices)), dtype=np.float32).reshape(n, k)
+    return predict_grid
+
+
+def sweep_day(X: pd.DataFrame,
+              base: pd.DataFrame,
+              discount_grid: List[float],
+              predict_grid: GridPredictor) -> pd.DataFrame:
+    """Baseline + revenue-maximizing candidate per row of `base` (X = its encoded features, same order)."""
+    n, G = len(base), len(discount_grid)
+    cand_price, cand_disc = candidate_prices(base["base_price"].to_numpy(), discount_grid)
+    bl_price = base["baseline_effective_price"].to_numpy(dtype=np.float32)
+    bl_disc = base["baseline_discount_pct"].to_numpy(dtype=np.float32)
+
+    with span("predict", rows=n * (G + 1)):
+        units = predict_grid(X, {
+            "effective_price": np.column_stack([cand_price, bl_price]),
+            "discount_pct": np.column_stack([cand_disc, bl_disc]),
+        })
+    cand_units, bl_units = units[:, :G], units[:, G]
+
+    with span("argmax", rows=n):
+        revenue = cand_price * cand_units
+        best = revenue.argmax(axis=1)  # first max on ties, like idxmax
+        rows = np.arange(n)
+
+        out = base[["date","store_nbr","item_nbr","baseline_discount_pct","baseline_effective_price"]].reset_index(drop=True)
+        out["pred_units_baseline"] = bl_units
+        out["baseline_revenue"] = bl_price * bl_units
+        out["policy_discount_pct"] = cand_disc[rows, best]
+        out["policy_effective_price"] = cand_price[rows, best]
+        out["pred_units_policy"] = cand_units[rows, best]
+        out["policy_revenue"] = revenue[rows, best]
+        return out[OUT_COLS]
@@ -0,0 +1,276 @@
+# =============================================================
+# file: ce/src/synth.py
+# Purpose: Synthetic Favorita-shaped ML tables for benchmarks and local runs
+#  - features_split / scoring_frame_test with the BigQuery columns and types,
+#    written as root/<table>/date=YYYY-MM-DD/part-0.parquet (ParquetSource layout)
+#  - Catalog: 950 perishable items x 54 stores, 9 families, 17 store clusters;
+#    base_price from the family bands + item jitter of int_base_price.sql
+#  - time_to_expiry / discount ladder / effective_price from pricing_rules.py
+#    (the fct_sales_features.sql rules the scoring state and service use too)
+#  - Lags / rolling means / promo recency over a 28-day warm-up, same windows
+#    as features_enriched.sql; splits as features_split.sql
+#  - Scale: --rows 100k .. 30M+; generated one day at a time (bounded memory)
+# =============================================================
+
+#!/usr/bin/env python3
+import os, argparse, math, shutil, time
+from typing import Dict, Iterator, NamedTuple, Tuple
+
+import numpy as np
+import pandas as pd
+
+from data_source import DATE_PART
+from sharding import fingerprint64
+from pricing_rules import DEFAULT_SHELF_LIFE_DAYS, SHELF_LIFE_DAYS, discount_ladder, effective_price, time_to_expiry
+
+# int_base_price.sql
+FAMILY_PRICE_BANDS: Dict[str, Tuple[float, float]] = {
+    "BREAD_BAKERY": (2.40, 4.00),
+    "DAIRY": (4.00, 7.00),
+    "DELI": (5.00, 12.00),
+    "EGGS": (3.00, 5.50),
+    "MEATS": (10.00, 20.00),
+    "POULTRY": (8.00, 15.00),
+    "PREPARED_FOODS": (6.00, 15.00),
+    "PRODUCE": (2.50, 7.00),
+    "SEAFOOD": (15.00, 25.00),
+}
+# Share of perishable items per family (Favorita items.csv) and classes per family
+FAMILY_ITEM_SHARE = {
+    "PRODUCE": 306, "DAIRY": 242, "BREAD_BAKERY": 134, "DELI": 91, "MEATS": 84,
+    "POULTRY": 54, "EGGS": 41, "PREPARED_FOODS": 26, "SEAFOOD": 8,
+}
+FAMILY_CLASSES = {
+    "PRODUCE": 20, "DAIRY": 24, "BREAD_BAKERY": 14, "DELI": 10, "MEATS": 10,
+    "POULTRY": 6, "EGGS": 4, "PREPARED_FOODS": 5, "SEAFOOD": 3,
+}
+# Price response per family (log-units per unit of discount)
+FAMILY_ELASTICITY = {
+    "BREAD_BAKERY": 1.6, "DAIRY": 1.1, "DELI": 1.8, "EGGS": 0.8, "MEATS": 2.2,
+    "POULTRY": 2.0, "PREPARED_FOODS": 2.4, "PRODUCE": 1.4, "SEAFOOD": 2.6,
+}
+
+N_ITEMS, N_STORES, N_CLUSTERS = 950, 54, 17
+HISTORY_DAYS = 28      # features_enriched keeps rows with > 28 days of history
+MAX_UNIT_SALES = 200.0  # fct_sales_features caps spikes at 200
+
+FEATURES_SPLIT_COLS = [
+    "date","store_nbr","item_nbr","class","cluster","family",
+    "unit_sales","log_sales",
+    "base_price","discount_pct","effective_price","time_to_expiry",
+    "dow","month","year",
+    "lag1_log_sales","lag7_log_sales","lag14_log_sales","lag28_log_sales",
+    "rm7_log_sales","rm28_log_sales",
+    "promo_in_last_7d","split"
+]
+
+
+def parse_rows(s: str) -> int:
+    """'100k' / '1.5M' / '30m' / '250000' -> int."""
+    s = str(s).strip().lower().replace("_", "")
+    mult = {"k": 10**3, "m": 10**6, "b": 10**9}.get(s[-1:], 1)
+    return int(float(s[:-1] if mult > 1 else s) * mult)
+
+
+def format_rows(n: int) -> str:
+    for unit, div in (("M", 10**6), ("k", 10**3)):
+        if n >= div and n % (div // 10) == 0:
+            return f"{n / div:g}{unit}"
+    return str(n)
+
+
+class Catalog(NamedTuple):
+    """One row per active (store, item) pair, in generation order."""
+    store_nbr: np.ndarray   # str
+    item_nbr: np.ndarray    # str
+    family: np.ndarray      # str
+    klass: np.ndarray       # str
+    cluster: np.ndarray     # str
+    base_price: np.ndarray  # float64
+    shelf_life: np.ndarray  # int64
+    elasticity: np.ndarray  # float64
+    level: np.ndarray       # float64, mean log demand
+
+
+def base_prices(item_nbr: np.ndarray, family: np.ndarray) -> np.ndarray:
+    """int_base_price.sql: band position 0.5 +- 5% from ABS(MOD(FARM_FINGERPRINT(item), 1e6))."""
+    fp = fingerprint64(item_nbr.tolist()).view(np.int64)
+    u = np.abs(np.fmod(fp, 1_000_000)) / 1_000_000.0
+    lo = np.array([FAMILY_PRICE_BANDS[f][0] for f in family])
+    hi = np.array([FAMILY_PRICE_BANDS[f][1] for f in family])
+    return np.round(lo + (0.50 + (u - 0.5) * 0.10) * (hi - lo), 2)
+
+
+def make_catalog(n_pairs: int,
+                 n_items: int = N_ITEMS,
+                 n_stores: int = N_STORES,
+                 rng: np.random.Generator = None) -> Catalog:
+    """Items (family / class / price) x stores (cluster); the first n_pairs of a fixed shuffle are active."""
+    rng = rng or np.random.default_rng(0)
+    fams = list(FAMILY_ITEM_SHARE)
+    share = np.array([FAMILY_ITEM_SHARE[f] for f in fams], dtype=np.float64)
+    counts = np.floor(share / share.sum() * n_items).astype(int)
+    counts[np.argsort(-share)[:n_items - counts.sum()]] += 1
+    item_family = np.repeat(np.array(fams, dtype=object), counts)
+    item_ids = np.sort(rng.choice(np.arange(96_995, 2_134_245), size=n_items, replace=False)).astype(str)
+    item_ids = item_ids.astype(object)
+
+    # Classes: 4-digit ids per family block, items spread over them
+    item_class = np.empty(n_items, dtype=object)
+    for k, f in enumerate(fams):
+        idx = np.flatnonzero(item_family == f)
+        ids = np.array([str(1000 * (k + 1) + 2 * j + 2) for j in range(FAMILY_CLASSES[f])], dtype=object)
+        item_class[idx] = ids[rng.integers(0, len(ids), len(idx))]
+    item_price = base_prices(item_ids, item_family)
+    item_level = rng.normal(1.2, 0.7, n_items)
+
+    store_ids = np.arange(1, n_stores + 1).astype(str).astype(object)
+    store_cluster = rng.permutation(np.resize(np.arange(1, N_CLUSTERS + 1), n_stores)).astype(str).astype(object)
+    store_level = rng.normal(0.0, 0.3, n_stores)
+
+    n_pairs = min(n_pairs, n_items * n_stores)
+    pairs = rng.permutation(n_items * n_stores)[:n_pairs]
+    # Sorted by (store, item) so day partitions look like the BQ export (clustered by store, item)
+    pairs.sort()
+    s, i = pairs // n_items, pairs % n_items
+    fam = item_family[i]
+    return Catalog(
+        store_nbr=store_ids[s], item_nbr=item_ids[i], family=fam, klass=item_class[i],
+        cluster=store_cluster[s], base_price=item_price[i],
+        shelf_life=np.array([SHELF_LIFE_DAYS.get(f, DEFAULT_SHELF_LIFE_DAYS) for f in fam], dtype=np.int64),
+        elasticity=np.array([FAMILY_ELASTICITY[f] for f in fam]),
+        level=item_level[i] + store_level[s],
+    )
+
+
+def split_of(day: pd.Timestamp, end_date: pd.Timestamp) -> str:
+    """features_split.sql: valid from end-28d, test from end-14d."""
+    if day < end_date - pd.Timedelta(days=28):
+        return "train"
+    return "valid" if day < end_date - pd.Timedelta(days=14) else "test"
+
+
+def bq_dow(days: pd.DatetimeIndex) -> np.ndarray:
+    """EXTRACT(DAYOFWEEK): 1 = Sunday."""
+    return (days.dayofweek.to_numpy() + 1) % 7 + 1
+
+
+def generate_days(cat: Catalog,
+                  start_date: str,
+                  end_date: str,
+                  seed: int = 0) -> Iterator[pd.DataFrame]:
+    """features_split rows per day (all active pairs), after a HISTORY_DAYS warm-up."""
+    rng = np.random.default_rng(seed + 1)
+    n = len(cat.store_nbr)
+    end = pd.Timestamp(end_date)
+    days = pd.date_range(pd.Timestamp(start_date) - pd.Timedelta(days=HISTORY_DAYS), end, freq="D")
+    dows = bq_dow(days)
+    # Ring buffers: log_sales of the last 28 days, discount > 0 of the last 7 (column t % size)
+    hist = np.zeros((n, HISTORY_DAYS), dtype=np.float64)
+    promo = np.zeros((n, 7), dtype=bool)
+    ar = np.zeros(n)
+    for t, day in enumerate(days):
+        dstr = day.date().isoformat()
+        tte = time_to_expiry(cat.store_nbr, cat.item_nbr, dstr, cat.shelf_life)
+        disc = discount_ladder(tte)
+        eff = effective_price(cat.base_price, disc)
+
+        ar = 0.6 * ar + rng.normal(0.0, 0.35, n)
+        weekend = 0.15 if dows[t] in (1, 7) else 0.0
+        mu = cat.level + weekend + cat.elasticity * disc + ar
+        units = np.clip(np.round(np.expm1(np.maximum(mu, 0.0)) * rng.gamma(4.0, 0.25, n), 3), 0, MAX_UNIT_SALES)
+        log_sales = np.log1p(units)
+
+        if t >= HISTORY_DAYS:
+            lag = lambda k: hist[:, (t - k) % HISTORY_DAYS]
+            rm7 = np.stack([lag(k) for k in range(1, 8)], axis=1).mean(axis=1)
+            yield pd.DataFrame({
+                "date": day.date(),
+                "store_nbr": cat.store_nbr, "item_nbr": cat.item_nbr,
+                "class": cat.klass, "cluster": cat.cluster, "family": cat.family,
+                "unit_sales": units, "log_sales": log_sales,
+                "base_price": cat.base_price, "discount_pct": disc, "effective_price": eff,
+                "time_to_expiry": tte,
+                "dow": np.int64(dows[t]), "month": np.int64(day.month), "year": np.int64(day.year),
+                "lag1_log_sales": lag(1), "lag7_log_sales": lag(7),
+                "lag14_log_sales": lag(14), "lag28_log_sales": lag(28),
+                "rm7_log_sales": rm7, "rm28_log_sales": hist.mean(axis=1),
+                "promo_in_last_7d": promo.any(axis=1).astype(np.int64),
+                "split": split_of(day, end),
+            })[FEATURES_SPLIT_COLS]
+        hist[:, t % HISTORY_DAYS] = log_sales
+        promo[:, t % 7] = disc > 0
+
+
+def scoring_frame(day_df: pd.DataFrame) -> pd.DataFrame:
+    """policy_setup_1_scoring_frame.sql: test rows with time_to_expiry <= 2."""
+    df = day_df[(day_df["split"] == "test") & (day_df["time_to_expiry"] <= 2)]
+    return pd.DataFrame({
+        "date": df["date"], "store_nbr": df["store_nbr"], "item_nbr": df["item_nbr"],
+        "base_price": df["base_price"], "time_to_expiry": df["time_to_expiry"],
+        **{c: df[c] for c in ["lag1_log_sales","lag7_log_sales","lag14_log_sales","lag28_log_sales",
+                              "rm7_log_sales","rm28_log_sales","promo_in_last_7d","dow","month","year",
+                              "family","class"]},
+        "store_nbr_cat": df["store_nbr"], "cluster": df["cluster"],
+        "baseline_discount_pct": df["discount_pct"],
+        "baseline_effective_price": df["effective_price"],
+        "observed_unit_sales": df["unit_sales"],
+    }).reset_index(drop=True)
+
+
+def plan(rows: int, days: int = 0, n_items: int = N_ITEMS, n_stores: int = N_STORES) -> Tuple[int, int]:
+    """(days, pairs per day) for ~`rows` features_split rows; >= 60 days so train / valid / test are non-empty."""
+    days = days or max(60, math.ceil(rows / (n_items * n_stores)))
+    return days, min(n_items * n_stores, math.ceil(rows / days))
+
+
+def write_tables(root: str,
+                 rows: int,
+                 days: int = 0,
+                 end_date: str = "2017-08-15",
+                 n_items: int = N_ITEMS,
+                 n_stores: int = N_STORES,
+                 seed: int = 0) -> Dict[str, int]:
+    """Write features_split + scoring_frame_test under root; returns rows per table."""
+    days, n_pairs = plan(rows, days, n_items, n_stores)
+    cat = make_catalog(n_pairs, n_items, n_stores, np.random.default_rng(seed))
+    start = (pd.Timestamp(end_date) - pd.Timedelta(days=days - 1)).date().isoformat()
+    print(f"{days} days x {n_pairs:,} (store, item) pairs from {start} -> {root}")
+    counts = {"features_split": 0, "scoring_frame_test": 0}
+    for table in counts:
+        # A smaller re-run must not leave partitions of the previous one behind
+        shutil.rmtree(os.path.join(root, table), ignore_errors=True)
+    t0 = time.time()
+    for df in generate_days(cat, start, end_date, seed):
+        d = df["date"].iloc[0].isoformat()
+        for table, part in (("features_split", df), ("scoring_frame_test", scoring_frame(df))):
+            if part.empty:
+                continue
+            pdir = os.path.join(root, table, DATE_PART + d)
+            os.makedirs(pdir, exist_ok=True)
+            part.to_parquet(os.path.join(pdir, "part-0.parquet"), index=False)
+            counts[table] += len(part)
+        if d.endswith("-01") or d == end_date:
+            print(f"[{d}] features_split rows={counts['features_split']:,} ({time.time() - t0:.0f}s)")
+    return counts
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Synthetic features_split / scoring_frame_test as local Parquet")
+    ap.add_argument("--out", default="data/synth", help="Parquet root (use as --data_dir with --source parquet)")
+    ap.add_argument("--rows", default="1M", help="features_split rows, e.g. 100k, 1M, 30M")
+    ap.add_argument("--days", type=int, default=0, help="Days of data (default: enough for all 51,300 pairs/day)")
+    ap.add_argument("--end_date", default="2017-08-15")
+    ap.add_argument("--items", type=int, default=N_ITEMS)
+    ap.add_argument("--stores", type=int, default=N_STORES)
+    ap.add_argument("--seed", type=int, default=0)
+    args = ap.parse_args()
+
+    counts = write_tables(args.out, parse_rows(args.rows), args.days, args.end_date,
+                          args.items, args.stores, args.seed)
+    for t, n in counts.items():
+        print(f"Wrote {n:,} rows of {t} to {os.path.join(args.out, t)}")
+
+
+if __name__ == "__main__":
+    main()
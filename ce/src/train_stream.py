@@ -0,0 +1,123 @@
+# =============================================================
+# file: ce/src/train_stream.py
+# Purpose: Chunked training input for splits larger than RAM
+#  - fit_vocab: category vocab from a stream of the categorical columns only
+#    (first-seen order, same as fitting on the full TRAIN frame)
+#  - spill_split: stream a split once from the DataSource, encode each chunk
+#    with the TRAIN vocab and keep it as float32 .npy chunks on local disk
+#    (QuantileDMatrix / lgb.Dataset read their input more than once)
+#  - save_split writes an already encoded frame in the same layout
+#    (dataset_cache.py entries)
+#  - The library adapters (xgboost DataIter, lightgbm Sequence) live in the
+#    training scripts; peak RAM ~ one chunk + the binned training matrix
+#  - Chunk fetch / encode / spill are recorded as "load" / "encode" / "spill" perf spans
+# =============================================================
+
+import os, glob
+from typing import Callable, Dict, Iterator, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from data_source import DataSource
+from encoding import VocabBuilder
+from perf import span, traced_iter
+
+
+class SpilledSplit:
+    """An encoded split on disk: chunk-NNNNN.npy (rows x features, float32) + label.npy."""
+
+    def __init__(self, root: str, feature_names: List[str]):
+        self.root = root
+        self.feature_names = list(feature_names)
+        self.chunk_files = sorted(glob.glob(os.path.join(root, "chunk-*.npy")))
+        self.label = np.load(os.path.join(root, "label.npy"), mmap_mode="r")
+
+    @property
+    def n_rows(self) -> int:
+        return len(self.label)
+
+    def chunks(self) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """(X, y) per chunk, memory-mapped."""
+        start = 0
+        for path in self.chunk_files:
+            X = np.load(path, mmap_mode="r")
+            yield X, self.label[start:start + len(X)]
+            start += len(X)
+
+
+def frame_to_matrix(X: pd.DataFrame, feature_names: List[str]) -> np.ndarray:
+    """float32 matrix in feature order; pandas categoricals become their codes (-1 -> NaN)."""
+    M = np.empty((len(X), len(feature_names)), dtype=np.float32)
+    for j, c in enumerate(feature_names):
+        s = X[c]
+        if isinstance(s.dtype, pd.CategoricalDtype):
+            codes = s.cat.codes.to_numpy()
+            M[:, j] = np.where(codes < 0, np.nan, codes)
+        else:
+            M[:, j] = s.to_numpy(dtype=np.float32, na_value=np.nan)
+    return M
+
+
+def fit_vocab(source: DataSource,
+              table: str,
+              split: str,
+              cat_cols: List[str],
+              chunk_rows: int = 1_000_000) -> Dict[str, List[str]]:
+    """Vocab per categorical column in first-seen order over the split (only cat_cols are read)."""
+    builder = VocabBuilder(cat_cols)
+    for df in traced_iter(source.iter_chunks(table, columns=cat_cols, split=split, chunk_rows=chunk_rows)):
+        with span("vocab", rows=len(df)):
+            builder.update(df)
+    return builder.vocab
+
+
+def spill_split(source: DataSource,
+                table: str,
+                split: str,
+                features: List[str],
+                label: str,
+                encode: Callable[[pd.DataFrame], pd.DataFrame],
+                out_dir: str,
+                chunk_rows: int = 1_000_000) -> SpilledSplit:
+    """Stream `split` once, encode chunk by chunk and write it under out_dir."""
+    os.makedirs(out_dir, exist_ok=True)
+    for p in glob.glob(os.path.join(out_dir, "chunk-*.npy")):
+        os.remove(p)
+    labels: List[np.ndarray] = []
+    n = 0
+    chunks = source.iter_chunks(table, columns=features + [label], split=split, chunk_rows=chunk_rows)
+    for i, df in enumerate(traced_iter(chunks)):
+        if df.empty:
+            continue
+        with span("encode", rows=len(df)):
+            M = frame_to_matrix(encode(df), features)
+        with span("spill", rows=len(df)):
+            np.save(os.path.join(out_dir, f"chunk-{i:05d}.npy"), M)
+        labels.append(df[label].to_numpy(dtype=np.float32))
+        n += len(df)
+        print(f"[{split} chunk {i}] rows={len(df):,} total={n:,}")
+    np.save(os.path.join(out_dir, "label.npy"),
+            np.concatenate(labels) if labels else np.zeros(0, dtype=np.float32))
+    return SpilledSplit(out_dir, features)
+
+
+def save_split(X: pd.DataFrame,
+               y: np.ndarray,
+               features: List[str],
+               out_dir: str,
+               chunk_rows: int = 1_000_000) -> SpilledSplit:
+    """Write an encoded in-memory split in the spill_split layout."""
+    os.makedirs(out_dir, exist_ok=True)
+    with span("spill", rows=len(X)):
+        for i, start in enumerate(range(0, len(X), chunk_rows)):
+            np.save(os.path.join(out_dir, f"chunk-{i:05d}.npy"),
+                    frame_to_matrix(X.iloc[start:start + chunk_rows], features))
+        np.save(os.path.join(out_dir, "label.npy"), np.asarray(y, dtype=np.float32))
+    return SpilledSplit(out_dir, features)
+
+
+def predict_chunks(predict: Callable[[np.ndarray], np.ndarray], split: SpilledSplit) -> np.ndarray:
+    """Concatenated predict(X) over the split's chunks."""
+    preds = [np.asarray(predict(X)) for X, _ in split.chunks()]
+    return np.concatenate(preds) if preds else np.zeros(0, dtype=np.float32)
@@ -4,15 +4,43 @@ import argparse
 from pathlib import Path
 import numpy as np
 import pandas as pd
-from typing import Sequence, Optional
-from pandas_gbq import read_gbq
+from typing import Dict, List, Sequence, Optional, Tuple
+import matplotlib
+matplotlib.use("Agg")  # files only; also safe in the report's worker processes
 import matplotlib.pyplot as plt
 
+from data_source import DataSource, ParquetSource, add_source_args, source_from_args
+from kpi import expiry_bucket, load_kpis
 
-def load_table(project: str, fq_table: str) -> pd.DataFrame:
-    """Load a fully-qualified BigQuery table into a DataFrame."""
-    df = read_gbq(f"SELECT * FROM `{fq_table}`", project_id=project)
-    return df
+
+def load_table(source: DataSource, table: str, columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """Load a KPI table (only `columns`, if given) into a DataFrame."""
+    return source.read(table, columns=columns)
+
+
+def kpis_from_results(results: DataSource,
+                      eval_table: str,
+                      source: DataSource) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Daily and expiry-bucket KPIs (as policy_kpis.sql) straight from the sweep's result partitions.
+
+    time_to_expiry is joined from scoring_frame_test in `source`, over the dates present in the results.
+    """
+    pe = results.read(eval_table, columns=["date", "store_nbr", "item_nbr", "baseline_revenue",
+                                           "policy_revenue", "policy_discount_pct"])
+    daily = pe.groupby("date", as_index=False)[["baseline_revenue", "policy_revenue"]].sum()
+    daily.columns = ["date", "baseline_rev", "policy_rev"]
+    daily["uplift_pct"] = (daily["policy_rev"] - daily["baseline_rev"]) / daily["baseline_rev"].replace(0, np.nan)
+
+    lo, hi = (pd.Timestamp(d).date().isoformat() for d in (pe["date"].min(), pe["date"].max()))
+    sf = source.read("scoring_frame_test", columns=["date", "store_nbr", "item_nbr", "time_to_expiry"],
+                     date_range=(lo, hi))
+    joined = pe.merge(sf, on=["date", "store_nbr", "item_nbr"])
+    joined["expiry_bucket"] = expiry_bucket(joined["time_to_expiry"])
+    exp = (joined.groupby("expiry_bucket", as_index=False)
+           .agg(baseline_rev=("baseline_revenue", "sum"), policy_rev=("policy_revenue", "sum"),
+                avg_policy_discount=("policy_discount_pct", "mean")))
+    exp["uplift_pct"] = (exp["policy_rev"] - exp["baseline_rev"]) / exp["baseline_rev"].replace(0, np.nan)
+    return daily, exp
 
 
 def _add_grid(ax) -> None:
@@ -25,6 +53,7 @@ def plot_daily_revenue(
     df: pd.DataFrame,
     outpath: Path,
     annotate_style: Optional[dict] = None,
+    label: str = "",
 ) -> None:
     """
     Line chart: daily baseline vs policy revenue with gridlines and annotations.
@@ -51,7 +80,7 @@ def plot_daily_revenue(
     _add_grid(ax)
     ax.set_xlabel("Date")
     ax.set_ylabel("Revenue")
-    ax.set_title("XGB Daily Revenue: Baseline vs Policy")
+    ax.set_title(f"{label} Daily Revenue: Baseline vs Policy".strip())
 
     # Prepare annotation style
     ann_style = dict(
@@ -130,6 +159,7 @@ def plot_uplift_by_expiry(
     outpath: Path,
     soft_palette: Optional[Sequence[str]] = None,
     show_value_labels: bool = True,
+    label: str = "",
 ) -> None:
     """
     Bar chart: uplift % by expiry bucket with gridlines, soft tones, and annotation for max.
@@ -170,7 +200,7 @@ def plot_uplift_by_expiry(
     _add_grid(ax)
     ax.set_xlabel("Expiry bucket")
     ax.set_ylabel("Revenue uplift (%)")
-    ax.set_title("XGB Policy Uplift by Time-to-Expiry")
+    ax.set_title(f"{label} Policy Uplift by Time-to-Expiry".strip())
 
     # Highlight the max uplift bar with an annotation/arrow
     max_idx = int(df["uplift_pct_pp"].idxmax())
@@ -204,30 +234,107 @@ def plot_uplift_by_expiry(
     plt.savefig(outpath, dpi=150, bbox_inches="tight")
     plt.close(fig)
 
+def plot_compare_daily_uplift(frames: Dict[str, pd.DataFrame], outpath: Path) -> None:
+    """One line per run: daily uplift % (columns: date, uplift_pct)."""
+    fig, ax = plt.subplots(figsize=(12, 6))
+    for name, df in frames.items():
+        df = df.assign(date=pd.to_datetime(df["date"])).sort_values("date")
+        ax.plot(df["date"], df["uplift_pct"] * 100.0, label=name, linewidth=2.0)
+    ax.axhline(0.0, color="grey", linewidth=0.8)
+    _add_grid(ax)
+    ax.set_xlabel("Date")
+    ax.set_ylabel("Revenue uplift (%)")
+    ax.set_title("Daily Policy Uplift by Model")
+    ax.legend()
+    outpath.parent.mkdir(parents=True, exist_ok=True)
+    plt.tight_layout()
+    plt.savefig(outpath, dpi=150, bbox_inches="tight")
+    plt.close(fig)
+
+
+def plot_compare_expiry_uplift(frames: Dict[str, pd.DataFrame], outpath: Path) -> None:
+    """Grouped bars: uplift % per expiry bucket, one bar per run (columns: expiry_bucket, uplift_pct)."""
+    buckets = sorted(set().union(*(df["expiry_bucket"].astype(str) for df in frames.values())))
+    x = np.arange(len(buckets))
+    width = 0.8 / max(1, len(frames))
+    fig, ax = plt.subplots(figsize=(10, 6))
+    for i, (name, df) in enumerate(frames.items()):
+        up = df.assign(expiry_bucket=df["expiry_bucket"].astype(str)).set_index("expiry_bucket")["uplift_pct"]
+        ax.bar(x + (i - (len(frames) - 1) / 2) * width, up.reindex(buckets).to_numpy() * 100.0, width, label=name)
+    ax.set_xticks(x, buckets)
+    _add_grid(ax)
+    ax.set_xlabel("Expiry bucket")
+    ax.set_ylabel("Revenue uplift (%)")
+    ax.set_title("Policy Uplift by Time-to-Expiry and Model")
+    ax.legend()
+    outpath.parent.mkdir(parents=True, exist_ok=True)
+    plt.tight_layout()
+    plt.savefig(outpath, dpi=150, bbox_inches="tight")
+    plt.close(fig)
+
+
+def plot_compare_totals(frames: Dict[str, pd.DataFrame], outpath: Path) -> None:
+    """Baseline vs policy revenue over the whole window, per run (columns: baseline_rev, policy_rev)."""
+    names = list(frames)
+    base = np.array([frames[n]["baseline_rev"].sum() for n in names])
+    pol = np.array([frames[n]["policy_rev"].sum() for n in names])
+    x = np.arange(len(names))
+    fig, ax = plt.subplots(figsize=(max(6, 1.8 * len(names)), 6))
+    ax.bar(x - 0.2, base, 0.4, label="Baseline revenue")
+    bars = ax.bar(x + 0.2, pol, 0.4, label="Policy revenue")
+    for b, bl, pl in zip(bars, base, pol):
+        ax.text(b.get_x() + b.get_width() / 2, b.get_height(), f"{(pl - bl) / bl:+.1%}" if bl else "",
+                ha="center", va="bottom", fontsize=9)
+    ax.set_xticks(x, names)
+    _add_grid(ax)
+    ax.set_ylabel("Revenue")
+    ax.set_title("Total Revenue by Model: Baseline vs Policy")
+    ax.legend()
+    outpath.parent.mkdir(parents=True, exist_ok=True)
+    plt.tight_layout()
+    plt.savefig(outpath, dpi=150, bbox_inches="tight")
+    plt.close(fig)
 
 
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--project", default=os.getenv("PROJECT"), help="GCP project ID")
-    ap.add_argument("--dataset", default=os.getenv("ML_DATASET", "dynamic_pricing_ml"),
-                    help="BigQuery dataset containing KPI tables")
     ap.add_argument("--outdir", default="reports/viz", help="Directory to save charts")
+    ap.add_argument("--label", default="lgb",
+                    help="Run prefix: reads <label>_policy_kpis_* and names / titles the charts")
+    ap.add_argument("--kpi_json", default=None,
+                    help="KPI artifact written by the sweep (<out_dir>/<table>_kpis.json); no table reads")
+    ap.add_argument("--results_dir", default=None,
+                    help="Compute the KPIs from a local sweep result store (e.g. outputs) instead of "
+                         "reading the BQ KPI tables")
+    ap.add_argument("--eval_table", default=None,
+                    help="Result table under --results_dir (default: <label>_policy_eval_test)")
+    add_source_args(ap)
     args = ap.parse_args()
 
-    assert args.project, "Missing --project (or set PROJECT env var)"
+    # The KPI artifact needs no data source
+    source = None if args.kpi_json else source_from_args(args)
 
-    # Fully-qualified table names
-    t_daily = f"{args.project}.{args.dataset}.lgb_policy_kpis_by_date"
-    t_exp   = f"{args.project}.{args.dataset}.lgb_policy_kpis_by_expiry"
+    # KPI tables (resolved against --dataset for BigQuery, --data_dir for Parquet)
+    t_daily = f"{args.label}_policy_kpis_by_date"
+    t_exp   = f"{args.label}_policy_kpis_by_expiry"
 
     # Load
-    df_daily = load_table(args.project, t_daily)      # expects: date, baseline_rev, policy_rev, uplift_pct
-    df_exp   = load_table(args.project, t_exp)        # expects: expiry_bucket, baseline_rev, policy_rev, uplift_pct
+    if args.kpi_json:
+        tables = load_kpis(args.kpi_json)
+        df_daily, df_exp = tables["by_date"], tables["by_expiry"]
+    elif args.results_dir:
+        df_daily, df_exp = kpis_from_results(ParquetSource(args.results_dir),
+                                              args.eval_table or f"{args.label}_policy_eval_test", source)
+    else:
+        df_daily = load_table(source, t_daily, ["date", "baseline_rev", "policy_rev", "uplift_pct"])
+        df_exp   = load_table(source, t_exp, ["expiry_bucket", "baseline_rev", "policy_rev", "uplift_pct"])
 
     # Plot
     outdir = Path(args.outdir)
-    plot_daily_revenue(df_daily, outdir / "lgb_daily_revenue_baseline_vs_policy.png")
-    plot_uplift_by_expiry(df_exp, outdir / "lgb_uplift_by_expiry_bucket.png")
+    plot_daily_revenue(df_daily, outdir / f"{args.label}_daily_revenue_baseline_vs_policy.png",
+                       label=args.label.upper())
+    plot_uplift_by_expiry(df_exp, outdir / f"{args.label}_uplift_by_expiry_bucket.png", label=args.label.upper())
 
     print(f"Saved charts to: {outdir.resolve()}")
 
@@ -1,20 +1,19 @@
 #!/usr/bin/env python3
-import os, argparse, json
-from typing import Dict, List, Tuple
+import os, argparse, json, shutil, tempfile
+from typing import List, Tuple
 
 import numpy as np
 import pandas as pd
-from google.cloud import bigquery
 import xgboost as xgb
 from sklearn.metrics import mean_absolute_error, mean_squared_error
 import mlflow
 
-
-
-mlflow.set_tracking_uri(f"http://{TRACKING_SERVER_HOST}:5000")
-print(f"tracking URI: '{mlflow.get_tracking_uri()}'")
-
-
+from data_source import DataSource, add_source_args, source_from_args
+from train_stream import SpilledSplit, fit_vocab, frame_to_matrix, save_split, spill_split
+from dataset_cache import add_cache_args, cache_from_args, code_hash
+from encoding import CategoryEncoder
+from arrow_ingest import load_encoded
+from perf import IterationClock, peak_rss_mb, span, tracer
 
 # --- Spec: keep identical to BQML/previous code ---
 FEATURES: List[str] = [
@@ -29,7 +28,8 @@ FEATURES: List[str] = [
     "family","class","store_nbr","cluster"
 ]
 LABEL = "unit_sales"
-BQ_TABLE = "{project}.dynamic_pricing_ml.features_split"
+SPLIT_TABLE = "features_split"
+SPLITS = ["train","valid","test"]
 
 CAT_COLS = ["family","class","store_nbr","cluster"]  # categorical
 FLOAT_COLS = [
@@ -38,137 +38,223 @@ FLOAT_COLS = [
     "rm7_log_sales","rm28_log_sales"
 ]
 INT_COLS = ["time_to_expiry","promo_in_last_7d","dow","month","year"]
+# Target dtypes of the numeric FEATURES (pandas downcast, or Arrow cast at load with --ingest arrow)
+DTYPES = {**{c: np.float32 for c in FLOAT_COLS},
+          "time_to_expiry": np.int16, "promo_in_last_7d": np.int8, "dow": np.int8, "month": np.int8, "year": np.int16}
+
+# Histogram algorithm + categorical
+PARAMS = dict(
+    objective="reg:squarederror",
+    eval_metric="rmse",
+    tree_method="hist",
+    max_bin=256,           # drop to 128 if memory is still tight
+    max_depth=8,          # or use max_leaves with grow_policy='lossguide'
+    subsample=0.8,
+    colsample_bytree=0.8,
+    sampling_method="uniform",  # 'gradient_based' can help on very large data
+    nthread=-1
+)
+NUM_BOOST_ROUND = 1000
 
 def rmse(y, yhat) -> float:
     return float(np.sqrt(mean_squared_error(y, yhat)))
 
-def load_split(project: str, split: str, cols: List[str]) -> pd.DataFrame:
-    client = bigquery.Client(project=project)
-    table = BQ_TABLE.format(project=project)
-    sql = f"""
-    SELECT {", ".join(["date"] + cols + [LABEL, "split"])}
-    FROM `{table}`
-    WHERE split = @split
-    """
-    job = client.query(
-        sql,
-        job_config=bigquery.QueryJobConfig(
-            query_parameters=[bigquery.ScalarQueryParameter("split","STRING",split)]
-        )
-    )
-    # Use BQ Storage API to stream efficiently
-    return job.result().to_dataframe(create_bqstorage_client=True)
-
-def cast_and_categorize_train(df: pd.DataFrame) -> Tuple[pd.DataFrame, Dict[str, List[str]]]:
-    """Down-cast numerics and fit category vocabularies on TRAIN."""
+def load_split(source: DataSource, split: str, cols: List[str]) -> pd.DataFrame:
+    with span("load") as sp:
+        df = source.read(SPLIT_TABLE, columns=["date"] + cols + [LABEL, "split"], split=split)
+        sp.rows = len(df)
+    return df
+
+def downcast(df: pd.DataFrame) -> pd.DataFrame:
+    """FEATURES with numerics down-cast to float32 / small ints."""
     X = df[FEATURES].copy()
+    for c, t in DTYPES.items():
+        X[c] = X[c].astype(t)
+    return X
 
-    # Down-cast
-    for c in FLOAT_COLS:
-        X[c] = X[c].astype(np.float32)
-    # Small integers
-    X["time_to_expiry"] = X["time_to_expiry"].astype(np.int16)
-    X["promo_in_last_7d"] = X["promo_in_last_7d"].astype(np.int8)
-    X["dow"] = X["dow"].astype(np.int8)
-    X["month"] = X["month"].astype(np.int8)
-    X["year"] = X["year"].astype(np.int16)
-
-    # Categorical vocabularies from TRAIN
-    cat_vocab: Dict[str, List[str]] = {}
-    for c in CAT_COLS:
-        s = X[c].astype(str)
-        # Fit vocab from train only
-        vocab = pd.Index(s.unique()).astype(str).tolist()
-        # Make category dtype with known vocab (add UNK slot at the end)
-        vocab_with_unk = vocab + ["__UNK__"]
-        X[c] = pd.Categorical(s, categories=vocab_with_unk)
-        cat_vocab[c] = vocab  # store without UNK for saving
-    return X, cat_vocab
-
-def apply_categories(df: pd.DataFrame, cat_vocab: Dict[str, List[str]]) -> pd.DataFrame:
+def cast_and_categorize_train(df: pd.DataFrame) -> Tuple[pd.DataFrame, CategoryEncoder]:
+    """Down-cast numerics and fit category vocabularies on TRAIN."""
+    X = downcast(df)
+    encoder = CategoryEncoder.fit(X, CAT_COLS)
+    return encoder.encode(X), encoder
+
+def apply_categories(df: pd.DataFrame, encoder: CategoryEncoder) -> pd.DataFrame:
     """Apply train vocabs to VAL/TEST; unseen -> '__UNK__'."""
-    X = df[FEATURES].copy()
+    return encoder.encode(downcast(df))
 
-    # Down-cast numerics
-    for c in FLOAT_COLS:
-        X[c] = X[c].astype(np.float32)
-    X["time_to_expiry"] = X["time_to_expiry"].astype(np.int16)
-    X["promo_in_last_7d"] = X["promo_in_last_7d"].astype(np.int8)
-    X["dow"] = X["dow"].astype(np.int8)
-    X["month"] = X["month"].astype(np.int8)
-    X["year"] = X["year"].astype(np.int16)
-
-    for c in CAT_COLS:
-        s = X[c].astype(str)
-        vocab = cat_vocab[c]
-        # map unseen values to UNK
-        mask = ~s.isin(vocab)
-        if mask.any():
-            s.loc[mask] = "__UNK__"
-        X[c] = pd.Categorical(s, categories=(vocab + ["__UNK__"]))
-    return X
+class IterationSpans(xgb.callback.TrainingCallback):
+    """Records every boosting round (update + eval) as a "train_iter" perf span."""
+
+    def __init__(self, rows: int):
+        self.clock = IterationClock("train_iter", rows)
+        super().__init__()
+
+    def before_iteration(self, model, epoch, evals_log) -> bool:
+        self.clock.start()
+        return False
+
+    def after_iteration(self, model, epoch, evals_log) -> bool:
+        self.clock.stop()
+        return False
+
+class SpilledIter(xgb.DataIter):
+    """Feeds a spilled split to QuantileDMatrix one chunk at a time."""
+
+    def __init__(self, split: SpilledSplit):
+        self.split = split
+        self.types = ["c" if c in CAT_COLS else "q" for c in split.feature_names]
+        self._it = None
+        super().__init__()
+
+    def reset(self):
+        self._it = None
+
+    def next(self, input_data) -> bool:
+        if self._it is None:
+            self._it = self.split.chunks()
+        chunk = next(self._it, None)
+        if chunk is None:
+            return False
+        X, y = chunk
+        input_data(data=X, label=y, feature_names=self.split.feature_names, feature_types=self.types)
+        return True
 
 def main():
     ap = argparse.ArgumentParser()
-    ap.add_argument("--project", required=True)
+    ap.add_argument("--project", default=os.getenv("PROJECT"))
     ap.add_argument("--mlflow_server", required=True)
     ap.add_argument("--model_out", default="models/xgb_cat.json")
     ap.add_argument("--cat_vocab_out", default="models/xgb_cat_vocab.json")
     ap.add_argument("--experiment", default="peri-price-xgb-cat")
+    ap.add_argument("--stream", action="store_true",
+                    help="Stream splits in chunks into a QuantileDMatrix instead of loading them into pandas")
+    ap.add_argument("--chunk_rows", type=int, default=1_000_000)
+    ap.add_argument("--spill_dir", default=None, help="Local dir for encoded chunks (default: temp dir, removed)")
+    ap.add_argument("--params_json", default=None,
+                    help="Search results JSON (hparam_search.py); its best_params override PARAMS")
+    ap.add_argument("--eval_only", action="store_true",
+                    help="Evaluate the saved --model_out on valid / test instead of training")
+    ap.add_argument("--ingest", choices=["arrow","pandas"], default="arrow",
+                    help="arrow: record batches cast to DTYPES / encoded at the source; pandas: read() + downcast")
+    add_cache_args(ap)
+    add_source_args(ap)
     args = ap.parse_args()
 
     os.makedirs(os.path.dirname(args.model_out), exist_ok=True)
     os.makedirs(os.path.dirname(args.cat_vocab_out), exist_ok=True)
     TRACKING_SERVER_HOST = args.mlflow_server
+    mlflow.set_tracking_uri(f"http://{TRACKING_SERVER_HOST}:5000")
+    print(f"tracking URI: '{mlflow.get_tracking_uri()}'")
 
+    source = source_from_args(args)
     mlflow.set_experiment(args.experiment)
 
-    with mlflow.start_run(run_name="xgb_cat_train"):
-        # 1) Load splits
-        df_tr = load_split(args.project, "train", FEATURES)
-        df_va = load_split(args.project, "valid", FEATURES)
-        df_te = load_split(args.project, "test",  FEATURES)
-
-        # 2) Build y and memory-optimal X with native categorical dtype
-        ytr = df_tr[LABEL].astype(np.float32).values
-        yva = df_va[LABEL].astype(np.float32).values
-        yte = df_te[LABEL].astype(np.float32).values
-
-        Xtr, cat_vocab = cast_and_categorize_train(df_tr)
-        Xva = apply_categories(df_va, cat_vocab)
-        Xte = apply_categories(df_te, cat_vocab)
-
-        # 3) DMatrix with enable_categorical=True
-        dtrain = xgb.DMatrix(Xtr, label=ytr, enable_categorical=True)
-        dvalid = xgb.DMatrix(Xva, label=yva, enable_categorical=True)
-        dtest  = xgb.DMatrix(Xte, label=yte, enable_categorical=True)
-
-        # 4) Train (histogram algorithm + categorical)
-        params = dict(
-            objective="reg:squarederror",
-            eval_metric="rmse",
-            tree_method="hist",
-            max_bin=256,           # drop to 128 if memory is still tight
-            max_depth=8,          # or use max_leaves with grow_policy='lossguide'
-            subsample=0.8,
-            colsample_bytree=0.8,
-            sampling_method="uniform",  # 'gradient_based' can help on very large data
-            nthread=-1
-        )
+    params = dict(PARAMS)
+    if args.params_json:
+        with open(args.params_json) as f:
+            params.update(json.load(f)["best_params"])
+
+    # Encoded splits are cached before binning (QuantileDMatrix cannot be saved), so max_bin is not in the key
+    cache = cache_from_args(args)
+    key = cache.key(model="xgb", table=SPLIT_TABLE, features=FEATURES, label=LABEL,
+                    source={s: source.fingerprint(SPLIT_TABLE, FEATURES + [LABEL], s) for s in SPLITS},
+                    casts=dict(dtypes=DTYPES, category=CAT_COLS,
+                               code=code_hash(downcast, CategoryEncoder, frame_to_matrix))) if cache else None
+    entry = cache.get(key) if cache else None
+    build = None
+    spill_root = args.spill_dir or (tempfile.mkdtemp(prefix="xgb_spill_") if args.stream and not cache else None)
+
+    with mlflow.start_run(run_name="xgb_cat_eval" if args.eval_only else "xgb_cat_train"):
+        if entry:
+            # 1-3) Cache hit: vocab + encoded splits memory-mapped from the entry
+            encoder = CategoryEncoder.load(os.path.join(entry, "vocab.json"))
+            spilled = {s: SpilledSplit(os.path.join(entry, s), FEATURES) for s in SPLITS}
+        elif args.stream:
+            # 1-3) Vocab pass on the categorical columns, then one streamed pass per split;
+            # QuantileDMatrix bins chunk by chunk (peak RAM ~ one chunk + binned matrix)
+            build = cache.build(key) if cache else spill_root
+            encoder = CategoryEncoder(fit_vocab(source, SPLIT_TABLE, "train", CAT_COLS, args.chunk_rows))
+            spilled = {s: spill_split(source, SPLIT_TABLE, s, FEATURES, LABEL,
+                                      lambda df: apply_categories(df, encoder),
+                                      os.path.join(build, s), args.chunk_rows)
+                       for s in SPLITS}
+        else:
+            spilled = None
+            rss0 = peak_rss_mb()
+            if args.ingest == "arrow":
+                # 1-2) Arrow batches cast to DTYPES at load; vocab + categoricals encoded on the Arrow columns
+                X, y, encoder = load_encoded(source, SPLIT_TABLE, FEATURES, LABEL, DTYPES, CAT_COLS, SPLITS)
+                (Xtr, Xva, Xte), (ytr, yva, yte) = [X[s] for s in SPLITS], [y[s] for s in SPLITS]
+            else:
+                # 1) Load splits
+                df_tr = load_split(source, "train", FEATURES)
+                df_va = load_split(source, "valid", FEATURES)
+                df_te = load_split(source, "test",  FEATURES)
+
+                # 2) Build y and memory-optimal X with native categorical dtype
+                ytr = df_tr[LABEL].astype(np.float32).values
+                yva = df_va[LABEL].astype(np.float32).values
+                yte = df_te[LABEL].astype(np.float32).values
+
+                with span("encode", rows=len(df_tr) + len(df_va) + len(df_te)):
+                    Xtr, encoder = cast_and_categorize_train(df_tr)
+                    Xva = apply_categories(df_va, encoder)
+                    Xte = apply_categories(df_te, encoder)
+                del df_tr, df_va, df_te
+            n_rows = len(Xtr) + len(Xva) + len(Xte)
+            print(f"[ingest] {args.ingest}: {n_rows:,} rows, peak RSS {rss0:.0f} -> {peak_rss_mb():.0f} MB "
+                  f"over load + encode")
+            mlflow.log_metric("ingest_peak_rss_mb", peak_rss_mb())
+
+            if cache:
+                build = cache.build(key)
+                for s, X, y in [("train", Xtr, ytr), ("valid", Xva, yva), ("test", Xte, yte)]:
+                    save_split(X, y, FEATURES, os.path.join(build, s), args.chunk_rows)
+
+        if args.eval_only and encoder.vocab != CategoryEncoder.load(args.cat_vocab_out).vocab:
+            raise SystemExit(f"{args.cat_vocab_out} was not fitted on this data; retrain instead of --eval_only")
+
+        if spilled:
+            yva, yte = spilled["valid"].label, spilled["test"].label
+            with span("dmatrix", rows=sum(s.n_rows for s in spilled.values())):
+                dtrain = xgb.QuantileDMatrix(SpilledIter(spilled["train"]), max_bin=params["max_bin"],
+                                             enable_categorical=True)
+                dvalid = xgb.QuantileDMatrix(SpilledIter(spilled["valid"]), ref=dtrain, max_bin=params["max_bin"],
+                                             enable_categorical=True)
+                dtest  = xgb.QuantileDMatrix(SpilledIter(spilled["test"]),  ref=dtrain, max_bin=params["max_bin"],
+                                             enable_categorical=True)
+        else:
+            # 3) DMatrix with enable_categorical=True
+            with span("dmatrix", rows=n_rows):
+                dtrain = xgb.DMatrix(Xtr, label=ytr, enable_categorical=True)
+                dvalid = xgb.DMatrix(Xva, label=yva, enable_categorical=True)
+                dtest  = xgb.DMatrix(Xte, label=yte, enable_categorical=True)
+
+        if cache and not entry:
+            encoder.save(os.path.join(build, "vocab.json"))
+            cache.commit(key, build, model="xgb", rows=dtrain.num_row() + dvalid.num_row() + dtest.num_row())
+
+        # 4) Train (or load the saved model with --eval_only)
         mlflow.log_params(params)
 
-        booster = xgb.train(
-            params,
-            dtrain,
-            num_boost_round=1000,
-            evals=[(dtrain, "train"), (dvalid, "valid")],
-            early_stopping_rounds=50,
-            verbose_eval=50
-        )
+        if args.eval_only:
+            booster = xgb.Booster(model_file=args.model_out)
+        else:
+            with span("train", rows=dtrain.num_row()):
+                booster = xgb.train(
+                    params,
+                    dtrain,
+                    num_boost_round=NUM_BOOST_ROUND,
+                    evals=[(dtrain, "train"), (dvalid, "valid")],
+                    early_stopping_rounds=50,
+                    verbose_eval=50,
+                    callbacks=[IterationSpans(dtrain.num_row())]
+                )
 
         # 5) Eval
-        val_pred = booster.predict(dvalid)
-        test_pred = booster.predict(dtest)
+        with span("predict", rows=dvalid.num_row() + dtest.num_row()):
+            val_pred = booster.predict(dvalid)
+            test_pred = booster.predict(dtest)
 
         metrics = {
             "valid_mae": float(mean_absolute_error(yva, val_pred)),
@@ -181,14 +267,23 @@ def main():
             mlflow.log_metric(k, v)
 
         # 6) Save model + vocab
-        booster.save_model(args.model_out)
-        mlflow.log_artifact(args.model_out)
+        if not args.eval_only:
+            with span("write"):
+                booster.save_model(args.model_out)
+                encoder.save(args.cat_vocab_out)
+            mlflow.log_artifact(args.model_out)
+            mlflow.log_artifact(args.cat_vocab_out)
 
-        with open(args.cat_vocab_out, "w") as f:
-            json.dump(cat_vocab, f, indent=2)
-        mlflow.log_artifact(args.cat_vocab_out)
+        # 7) Per-stage time / rows/s / peak RSS
+        perf_path = os.path.splitext(args.model_out)[0] + ("_eval_perf.json" if args.eval_only else "_perf.json")
+        tracer.write_json(perf_path, script=os.path.basename(__file__), metrics=metrics)
+        mlflow.log_metrics(tracer.metrics())
+        mlflow.log_artifact(perf_path)
 
         print("Eval:", metrics)
 
+    if spill_root and not args.spill_dir:
+        shutil.rmtree(spill_root, ignore_errors=True)
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -10,6 +10,7 @@ DECLARE start_date DATE DEFAULT DATE('2017-08-01');
 DECLARE end_date   DATE DEFAULT DATE('2017-08-15');
 
 -- Sharding to keep each job small 
+-- (Python sweeps with --num_shards N process exactly the same slices, see ce/src/sharding.py)
 DECLARE NUM_SHARDS INT64 DEFAULT 16;
 
 -- Loop vars